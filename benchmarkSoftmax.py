@@ -0,0 +1,67 @@
+import ffBuilder as builder
+import numpy as np
+import tensorflow as tf
+import argparse, time, json
+
+# Benchmark the training step time of the translator encoder/decoder with the full softmax and sampled softmax losses, over several target vocabulary sizes
+
+def createBenchmarkGraph(args, vocabSize, numSampled=None):
+	# same construction as translator.createSession, with random embeddings and without attention
+	srcEmbedding = tf.Variable(tf.random_uniform([args.src_vocab_size, args.layer_size], -1.0, 1.0), name='input_embedding')
+	tgtEmbedding = tf.Variable(tf.random_uniform([vocabSize, args.layer_size], -1.0, 1.0), name='output_mbedding')
+	input = tf.placeholder(shape=[None, None], dtype=tf.int32, name='input')
+	output = tf.placeholder(shape=[None, None], dtype=tf.int32, name='output')
+	outputLengthList = tf.placeholder(shape=[None], dtype=tf.int32, name='output_length')
+	batchSize = tf.placeholder(shape=(), dtype=tf.int32, name='batch_size')
+	dropout = tf.placeholder_with_default(1.0, shape=(), name='dropout')
+	settingDict = {'inputType':tf.nn.embedding_lookup(srcEmbedding, input), 'layerSize':args.layer_size, 'layerDepth':args.layer_depth, 'inputSize':None, 'dropout':dropout, 'bidirectional':True}
+	_, _, encoderState, _ = builder.createEncoder(settingDict)
+	settingDict['startTokenId'] = 0; settingDict['endTokenId'] = 1
+	settingDict['correctResult'] = output; settingDict['outputEmbedding'] = tgtEmbedding
+	settingDict['correctResultLen'] = outputLengthList; settingDict['encoderState'] = encoderState; settingDict['decoderOutputSize'] = vocabSize
+	settingDict['batchSize'] = batchSize; settingDict['maximumDecoderLength'] = args.sentence_length
+	if(numSampled is not None):
+		settingDict['sampledSoftmax'] = numSampled
+	_, loss, _, _ = builder.createDecoder(settingDict)
+	trainOp = tf.train.GradientDescentOptimizer(0.1).minimize(loss)
+	return (input, output, outputLengthList, batchSize), loss, trainOp
+
+def benchmarkStepTime(args, vocabSize, numSampled=None):
+	tf.reset_default_graph()
+	inputs, loss, trainOp = createBenchmarkGraph(args, vocabSize, numSampled)
+	input, output, outputLengthList, batchSize = inputs
+	feed_dict = {input:np.random.randint(2, args.src_vocab_size, size=[args.batch_size, args.sentence_length]), output:np.random.randint(2, vocabSize, size=[args.batch_size, args.sentence_length]),
+		outputLengthList:np.full([args.batch_size], args.sentence_length, dtype=np.int32), batchSize:args.batch_size}
+	with tf.Session() as session:
+		session.run(tf.global_variables_initializer())
+		for _ in range(args.warmup_steps):
+			session.run(trainOp, feed_dict=feed_dict)
+		timer = time.time()
+		for _ in range(args.steps):
+			session.run([loss, trainOp], feed_dict=feed_dict)
+		return (time.time() - timer) / args.steps
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Benchmark the training step time of full softmax against sampled softmax.')
+	parser.add_argument('--vocab_sizes', type=lambda s: [int(size) for size in s.split(',')], default=[5000, 10000, 30000, 60000], help='Comma separated target vocabulary sizes. Default 5000,10000,30000,60000.')
+	parser.add_argument('--num_sampled', type=int, default=512, help='Number of sampled words for sampled softmax. Default 512.')
+	parser.add_argument('--src_vocab_size', type=int, default=10000, help='Source vocabulary size. Default 10000.')
+	parser.add_argument('--layer_size', type=int, default=128, help='Size of hidden layer in each cell. Default 128.')
+	parser.add_argument('--layer_depth', type=int, default=2, help='Number of layers. Default 2.')
+	parser.add_argument('--batch_size', type=int, default=64, help='Sentences per batch. Default 64.')
+	parser.add_argument('--sentence_length', type=int, default=30, help='Length of the synthetic sentences. Default 30.')
+	parser.add_argument('--steps', type=int, default=20, help='Timed steps per configuration. Default 20.')
+	parser.add_argument('--warmup_steps', type=int, default=3, help='Untimed steps before timing. Default 3.')
+	parser.add_argument('--output', type=str, default=None, help='If specified, write the results as JSON to this file.')
+	args = parser.parse_args()
+
+	results = []
+	print("%10s %14s %14s %8s" % ("vocab", "softmax (ms)", "sampled (ms)", "speedup"))
+	for vocabSize in args.vocab_sizes:
+		fullTime = benchmarkStepTime(args, vocabSize)
+		sampledTime = benchmarkStepTime(args, vocabSize, args.num_sampled)
+		results.append({'vocab_size':vocabSize, 'softmax_step_time':fullTime, 'sampled_softmax_step_time':sampledTime})
+		print("%10d %14.2f %14.2f %7.2fx" % (vocabSize, fullTime * 1000.0, sampledTime * 1000.0, fullTime / sampledTime))
+	if(args.output):
+		with open(args.output, 'w') as outputFile:
+			json.dump({'settings':vars(args), 'results':results}, outputFile, indent=2)
@@ -0,0 +1,107 @@
+import translator
+import numpy as np
+import tensorflow as tf
+import argparse, time, json, itertools, platform
+
+# Benchmark the translator training and greedy decoding on synthetic data, across a matrix of model settings, batch sizes and sentence lengths
+# the results are written as JSON so runs can be compared between changes
+
+def listOf(type):
+	return lambda s: [type(value) for value in s.split(',')]
+
+def createSyntheticVocab(size, prefix, specialTokens):
+	# (wordToId, idToWord, None) as the vocab read_mode, the embedding being created by createSession
+	idToWord = list(specialTokens) + ['%s%d' % (prefix, i) for i in range(size - len(specialTokens))]
+	return {word:idx for idx, word in enumerate(idToWord)}, idToWord, None
+
+def createSyntheticBatches(numBatches, batchSize, sentenceLength, vocabSizes, numSpecial, paddingTuple, lengthJitter=0.2):
+	# sentences of sentenceLength +- lengthJitter, with random non-special word ids
+	batches = []
+	for _ in range(numBatches):
+		lengths = np.random.randint(max(int(sentenceLength * (1.0 - lengthJitter)), 1), int(sentenceLength * (1.0 + lengthJitter)) + 1, size=[2, batchSize])
+		srcBatch = [np.random.randint(numSpecial, vocabSizes[0], size=length).tolist() for length in lengths[0]]
+		tgtBatch = [np.random.randint(numSpecial, vocabSizes[1], size=length).tolist() for length in lengths[1]]
+		batches.append(translator.createBatchFromIdSentences(srcBatch, tgtBatch, paddingTuple))
+	return batches
+
+def createModelArgs(layerSize, layerDepth, attention, loss):
+	# default translator arguments, with the model settings of this run
+	args = translator.createArgumentParser().parse_args(['--src', 'src', '--tgt', 'tgt'])
+	args.read_mode, args.train_embedding, args.mode = 'vocab', True, 'train'
+	args.layer_size, args.layer_depth, args.attention, args.loss = layerSize, layerDepth, attention, loss
+	args.learning_rate = 0.001 if(args.optimizer == 'adam') else 1.0
+	args.epoch, args.global_steps = 1, 0
+	args.print_verbose = lambda *argv, **kwargs: None
+	timer = time.time()
+	args.time_passed = lambda: time.time() - timer
+	# inference path settings normally filled by translator main
+	args.decode_length_setting, args.shortlist_table, args.replica_pool, args.translation_cache = None, None, None, None
+	return args
+
+def getPercentiles(values):
+	values = np.array(values, dtype=np.float64) * 1000.0
+	return {'p50_ms':float(np.percentile(values, 50)), 'p90_ms':float(np.percentile(values, 90)), 'p99_ms':float(np.percentile(values, 99))}
+
+def benchmarkModel(benchArgs, layerSize, layerDepth, attention, loss):
+	args = createModelArgs(layerSize, layerDepth, attention, loss)
+	specialTokens = [args.unknown_word, args.start_token, args.end_token]
+	embeddingTuple = (createSyntheticVocab(benchArgs.src_vocab_size, 'src', specialTokens), createSyntheticVocab(benchArgs.tgt_vocab_size, 'tgt', specialTokens))
+	paddingTuple = (embeddingTuple[0][0][args.end_token], embeddingTuple[1][0][args.end_token], embeddingTuple[1][0][args.start_token])
+	vocabSizes = (benchArgs.src_vocab_size, benchArgs.tgt_vocab_size)
+	tf.reset_default_graph()
+	args.maximum_sentence_length = int(max(benchArgs.sentence_lengths) * 1.2) + 1
+	timer = time.time()
+	sessionTuple = translator.createSession(args, embeddingTuple)
+	buildTime = time.time() - timer
+	results = []
+	for batchSize, sentenceLength in itertools.product(benchArgs.batch_sizes, benchArgs.sentence_lengths):
+		args.batch_size = batchSize
+		batches = createSyntheticBatches(benchArgs.steps, batchSize, sentenceLength, vocabSizes, len(specialTokens), paddingTuple)
+		# warm up the graph on this batch shape before timing
+		translator.trainSession(args, sessionTuple, batches[:benchArgs.warmup_steps])
+		timer = time.time()
+		translator.trainSession(args, sessionTuple, batches)
+		trainTime = time.time() - timer
+		realTokens = sum(translator.getBatchPaddingCount(batch)[0] for batch in batches)
+		# greedy decoding, decoding up to the source length as the random model rarely output the end token
+		args.maximum_sentence_length = sentenceLength
+		for batch in batches[:benchArgs.warmup_steps]:
+			translator.decodeBatch(args, sessionTuple, batch[0], batch[2])
+		latencies = []
+		for batch in batches:
+			timer = time.time()
+			translator.decodeBatch(args, sessionTuple, batch[0], batch[2])
+			latencies.append(time.time() - timer)
+		args.maximum_sentence_length = int(max(benchArgs.sentence_lengths) * 1.2) + 1
+		result = {'layer_size':layerSize, 'layer_depth':layerDepth, 'attention':attention, 'loss':loss, 'batch_size':batchSize, 'sentence_length':sentenceLength,
+			'train_steps_per_sec':len(batches) / trainTime, 'train_tokens_per_sec':realTokens / trainTime,
+			'decode_sentences_per_sec':len(batches) * batchSize / sum(latencies), 'decode_batch_latency':getPercentiles(latencies), 'graph_build_time':buildTime}
+		results.append(result)
+		print("size %4d depth %d attention %-8s loss %-15s batch %4d length %3d: train %7.2f steps/s %9.1f tokens/s, decode %8.1f sentences/s p50 %.1fms p99 %.1fms" % (layerSize, layerDepth, attention, loss, batchSize, sentenceLength,
+			result['train_steps_per_sec'], result['train_tokens_per_sec'], result['decode_sentences_per_sec'], result['decode_batch_latency']['p50_ms'], result['decode_batch_latency']['p99_ms']))
+	sessionTuple[0].close()
+	return results
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Benchmark the translator training and greedy decoding on synthetic corpora.')
+	parser.add_argument('--layer_sizes', type=listOf(int), default=[128], help='Comma separated layer_size values. Default 128.')
+	parser.add_argument('--layer_depths', type=listOf(int), default=[2], help='Comma separated layer_depth values (even, as the encoder is bidirectional). Default 2.')
+	parser.add_argument('--attentions', type=listOf(str), default=['none', 'luong'], help='Comma separated attention types, none for no attention. Default none,luong.')
+	parser.add_argument('--losses', type=listOf(str), default=['softmax'], help='Comma separated training losses (softmax|sampled_softmax). Default softmax.')
+	parser.add_argument('--batch_sizes', type=listOf(int), default=[32, 128], help='Comma separated batch sizes. Default 32,128.')
+	parser.add_argument('--sentence_lengths', type=listOf(int), default=[10, 30], help='Comma separated average sentence lengths. Default 10,30.')
+	parser.add_argument('--src_vocab_size', type=int, default=10000, help='Size of the synthetic source vocabulary. Default 10000.')
+	parser.add_argument('--tgt_vocab_size', type=int, default=10000, help='Size of the synthetic target vocabulary. Default 10000.')
+	parser.add_argument('--steps', type=int, default=20, help='Timed batches per configuration. Default 20.')
+	parser.add_argument('--warmup_steps', type=int, default=2, help='Untimed batches before timing. Default 2.')
+	parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic data. Default 0.')
+	parser.add_argument('-o', '--output', type=str, default='benchmark.json', help='JSON file to write the results in. Default benchmark.json.')
+	benchArgs = parser.parse_args()
+
+	np.random.seed(benchArgs.seed)
+	results = []
+	for layerSize, layerDepth, attention, loss in itertools.product(benchArgs.layer_sizes, benchArgs.layer_depths, benchArgs.attentions, benchArgs.losses):
+		results.extend(benchmarkModel(benchArgs, layerSize, layerDepth, None if(attention == 'none') else attention, loss))
+	with open(benchArgs.output, 'w') as outputFile:
+		json.dump({'settings':vars(benchArgs), 'platform':{'machine':platform.machine(), 'processor':platform.processor(), 'python':platform.python_version(), 'tensorflow':tf.__version__}, 'results':results}, outputFile, indent=2)
+	print("Results written to %s" % benchArgs.output)
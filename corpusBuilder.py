@@ -0,0 +1,427 @@
+import numpy as np
+import tensorflow as tf
+import os, io, json, time, itertools, collections
+import concurrent.futures, multiprocessing
+
+# The compiled corpus is a directory of .npy files. Sentences are stored back to back in flat int32 arrays, indexed by offset/length arrays
+# batchOffsets mark the sentence index where each batch start, since the batches are contiguous slices of the length-sorted corpus
+CORPUS_ARRAYS = ['srcIds', 'srcOffsets', 'srcLengths', 'tgtIds', 'tgtOffsets', 'tgtLengths', 'batchOffsets']
+CORPUS_INFO_FILE = 'corpus.json'
+
+def isCorpusDirectory(corpusDir):
+	return corpusDir is not None and os.path.isfile(os.path.join(corpusDir, CORPUS_INFO_FILE))
+
+def readCorpusInfo(corpusDir):
+	infoFile = io.open(os.path.join(corpusDir, CORPUS_INFO_FILE), 'r', encoding='utf-8')
+	info = json.loads(infoFile.read())
+	infoFile.close()
+	return info
+
+def lengthsToOffsets(lengths):
+	# offsets of each sentence within the flat array, using int64 as the flat array can be larger than int32 range
+	offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+	np.cumsum(lengths, out=offsets[1:])
+	return offsets
+
+def createNpyFile(npyPath, dtype, count):
+	# .npy file of count values opened as a writable memmap. Empty arrays cannot be memory-mapped everywhere, so they are saved directly
+	if(count == 0):
+		np.save(npyPath, np.zeros([0], dtype=dtype))
+		return None
+	return np.lib.format.open_memmap(npyPath, mode='w+', dtype=dtype, shape=(count,))
+
+def convertRawToNpy(rawPath, npyPath, chunkSize=1 << 24):
+	# copy the raw int32 values of rawPath into a .npy file chunk by chunk, then remove rawPath
+	count = os.path.getsize(rawPath) // np.dtype(np.int32).itemsize
+	output = createNpyFile(npyPath, np.int32, count)
+	if(output is not None):
+		raw = np.memmap(rawPath, dtype=np.int32, mode='r')
+		for start in range(0, count, chunkSize):
+			output[start:start+chunkSize] = raw[start:start+chunkSize]
+		output.flush()
+		del output, raw
+	os.remove(rawPath)
+	return count
+
+def writeOffsetsFromLengths(lengthsPath, offsetsPath, count, chunkSize=1 << 24):
+	# same as lengthsToOffsets, reading the lengths from their .npy file chunk by chunk
+	lengths = np.load(lengthsPath, mmap_mode='r') if(count > 0) else np.zeros([0], dtype=np.int32)
+	offsets = createNpyFile(offsetsPath, np.int64, count + 1)
+	offsets[0] = total = 0
+	for start in range(0, len(lengths), chunkSize):
+		chunk = np.cumsum(lengths[start:start+chunkSize], dtype=np.int64) + total
+		offsets[start+1:start+1+len(chunk)] = chunk
+		total = int(chunk[-1])
+	offsets.flush()
+	del offsets, lengths
+
+def saveBatchesToCorpus(batches, corpusDir, vocabSize=None, sources=None):
+	# batches in the format of generateBatchesFromSentences: (srcBatch, tgtBatch, inputLengthList, outputLengthList, tgtInputBatch)
+	# sources describe the files and settings the batches were made from, so a stale corpus can be detected
+	# each batch is appended to raw files as it comes, so the corpus is never held in memory. The .npy files and offsets are built from them at the end
+	if(not os.path.isdir(corpusDir)):
+		os.makedirs(corpusDir)
+	infoPath = os.path.join(corpusDir, CORPUS_INFO_FILE)
+	if(os.path.isfile(infoPath)):
+		# the corpus being overwritten is incomplete until the new info file is written
+		os.remove(infoPath)
+	rawPaths = dict((name, os.path.join(corpusDir, name + '.raw')) for name in ['srcIds', 'srcLengths', 'tgtIds', 'tgtLengths', 'batchSizes'])
+	rawFiles = dict((name, io.open(path, 'wb')) for name, path in rawPaths.items())
+	try:
+		for srcBatch, tgtBatch, inputLengthList, outputLengthList, _ in batches:
+			# remove the padding with a length mask, the kept ids are in row-major order
+			srcBatch, tgtBatch = np.asarray(srcBatch, dtype=np.int32), np.asarray(tgtBatch, dtype=np.int32)
+			inputLengthList, outputLengthList = np.asarray(inputLengthList, dtype=np.int32), np.asarray(outputLengthList, dtype=np.int32)
+			srcBatch[np.arange(srcBatch.shape[1]) < inputLengthList[:, None]].tofile(rawFiles['srcIds'])
+			tgtBatch[np.arange(tgtBatch.shape[1]) < outputLengthList[:, None]].tofile(rawFiles['tgtIds'])
+			inputLengthList.tofile(rawFiles['srcLengths'])
+			outputLengthList.tofile(rawFiles['tgtLengths'])
+			np.array([len(inputLengthList)], dtype=np.int32).tofile(rawFiles['batchSizes'])
+	finally:
+		for rawFile in rawFiles.values():
+			rawFile.close()
+	counts = dict((name, convertRawToNpy(rawPaths[name], os.path.join(corpusDir, name + '.npy'))) for name in ['srcIds', 'srcLengths', 'tgtIds', 'tgtLengths'])
+	writeOffsetsFromLengths(os.path.join(corpusDir, 'srcLengths.npy'), os.path.join(corpusDir, 'srcOffsets.npy'), counts['srcLengths'])
+	writeOffsetsFromLengths(os.path.join(corpusDir, 'tgtLengths.npy'), os.path.join(corpusDir, 'tgtOffsets.npy'), counts['tgtLengths'])
+	# the batch sizes are only needed for their offsets
+	batchSizes = np.fromfile(rawPaths['batchSizes'], dtype=np.int32)
+	os.remove(rawPaths['batchSizes'])
+	np.save(os.path.join(corpusDir, 'batchOffsets.npy'), lengthsToOffsets(batchSizes))
+	# write info file last, its existence marks a completed corpus
+	info = {'sentences': counts['srcLengths'], 'batches': len(batchSizes), 'vocabSize': vocabSize, 'sources': sources}
+	infoFile = io.open(infoPath, 'w', encoding='utf-8')
+	infoFile.write(json.dumps(info))
+	infoFile.close()
+	return info
+
+def createPaddedMatrix(flatIds, lengths, paddingToken):
+	# fill a preallocated matrix with the flat ids using a length mask, row-major order matches the flat order
+	maxLen = int(lengths.max()) if(len(lengths) > 0) else 0
+	matrix = np.full((len(lengths), maxLen), paddingToken, dtype=np.int32)
+	matrix[np.arange(maxLen) < lengths[:, None]] = flatIds
+	return matrix
+
+def createDecoderInput(tgtMatrix, startToken):
+	# the decoder input is the correct output shifted right by one, with startToken at the front
+	decoderInput = np.empty_like(tgtMatrix)
+	decoderInput[:, 0:1] = startToken
+	decoderInput[:, 1:] = tgtMatrix[:, :-1]
+	return decoderInput
+
+class CorpusBatches:
+	# Read-only, list-like view of the compiled corpus. Batches are only assembled when accessed
+	def __init__(self, corpusDir, paddingTuple):
+		self.info = readCorpusInfo(corpusDir)
+		for name in CORPUS_ARRAYS:
+			setattr(self, name, np.load(os.path.join(corpusDir, name + '.npy'), mmap_mode='r'))
+		# padding of input, padding of output, start token of decoder input
+		self.paddingTuple = paddingTuple
+
+	def __len__(self):
+		return len(self.batchOffsets) - 1
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+	def __getitem__(self, idx):
+		if(idx < 0):
+			idx += len(self)
+		if(idx < 0 or idx >= len(self)):
+			raise IndexError("Batch index {} out of range in corpus of {} batches".format(idx, len(self)))
+		inputPadding, outputPadding, outputStartToken = self.paddingTuple
+		start, end = self.batchOffsets[idx], self.batchOffsets[idx+1]
+		# the sentences of a batch are contiguous, so are their ids in the flat arrays
+		inputLengthList, outputLengthList = np.array(self.srcLengths[start:end]), np.array(self.tgtLengths[start:end])
+		srcBatch = createPaddedMatrix(self.srcIds[self.srcOffsets[start]:self.srcOffsets[end]], inputLengthList, inputPadding)
+		tgtBatch = createPaddedMatrix(self.tgtIds[self.tgtOffsets[start]:self.tgtOffsets[end]], outputLengthList, outputPadding)
+		tgtInputBatch = createDecoderInput(tgtBatch, outputStartToken)
+		return srcBatch, tgtBatch, inputLengthList, outputLengthList, tgtInputBatch
+
+	def iterateSentences(self):
+		# yield (srcIds, tgtIds) of every sentence as slices of the flat arrays, in the stored order
+		for i in range(len(self.srcLengths)):
+			yield self.srcIds[self.srcOffsets[i]:self.srcOffsets[i+1]], self.tgtIds[self.tgtOffsets[i]:self.tgtOffsets[i+1]]
+
+	def getMaximumIds(self):
+		# vectorized check on the flat arrays instead of the assembled batches
+		srcMax = int(self.srcIds.max()) if(len(self.srcIds) > 0) else -1
+		tgtMax = int(self.tgtIds.max()) if(len(self.tgtIds) > 0) else -1
+		return srcMax, tgtMax
+
+def getBucketBatchSizes(maximumLength, bucketWidth, batchSize, batchTokens=0):
+	# boundaries of the length buckets, and the number of sentences per batch in each bucket
+	# with batchTokens, every bucket is filled up to batchTokens padded tokens at its longest length
+	bucketBoundaries = list(range(bucketWidth + 1, maximumLength + 1, bucketWidth))
+	bucketUpperLengths = [boundary - 1 for boundary in bucketBoundaries] + [maximumLength]
+	if(batchTokens > 0):
+		bucketBatchSizes = [max(batchTokens // max(length, 1), 1) for length in bucketUpperLengths]
+	else:
+		bucketBatchSizes = [batchSize] * len(bucketUpperLengths)
+	return bucketBoundaries, bucketBatchSizes
+
+def createCorpusDataset(corpus, paddingTuple, bucketTuple, prefetchDepth=1, shuffleBuffer=0):
+	# tf.data pipeline reading the compiled corpus, with batches bucketed by sentence length and padded in graph
+	# output in the format of the batches (input, output, decoderInput, inputLength, outputLength), except decoderInput being at index 2
+	# the flat arrays are fed as placeholders when initializing the iterator, so each sentence is sliced in graph without going through python
+	# return the dataset, the feed_dict of the iterator initializer and the placeholder of the shuffle seed (None without shuffle), fed with it
+	inputPadding, outputPadding, outputStartToken = paddingTuple
+	bucketBoundaries, bucketBatchSizes = bucketTuple
+	srcIds, tgtIds = tf.placeholder(tf.int32, shape=[None], name='corpus_src_ids'), tf.placeholder(tf.int32, shape=[None], name='corpus_tgt_ids')
+	srcOffsets, tgtOffsets = tf.placeholder(tf.int64, shape=[None], name='corpus_src_offsets'), tf.placeholder(tf.int64, shape=[None], name='corpus_tgt_offsets')
+	srcLengths, tgtLengths = tf.placeholder(tf.int32, shape=[None], name='corpus_src_lengths'), tf.placeholder(tf.int32, shape=[None], name='corpus_tgt_lengths')
+	initializerFeed = {srcIds:corpus.srcIds, tgtIds:corpus.tgtIds, srcOffsets:corpus.srcOffsets[:-1], tgtOffsets:corpus.tgtOffsets[:-1], srcLengths:corpus.srcLengths, tgtLengths:corpus.tgtLengths}
+	dataset = tf.data.Dataset.from_tensor_slices((srcOffsets, srcLengths, tgtOffsets, tgtLengths))
+	shuffleSeed = None
+	if(shuffleBuffer > 0):
+		# shuffle the (offset, length) pairs, cheaper than shuffling the sentences. The seed is fed for each epoch, so the order can be repeated
+		shuffleSeed = tf.placeholder(tf.int64, shape=(), name='corpus_shuffle_seed')
+		dataset = dataset.shuffle(shuffleBuffer, seed=shuffleSeed)
+	def sliceSentence(srcOffset, srcLen, tgtOffset, tgtLen):
+		src = tf.slice(srcIds, [srcOffset], [tf.cast(srcLen, tf.int64)])
+		tgt = tf.slice(tgtIds, [tgtOffset], [tf.cast(tgtLen, tf.int64)])
+		return src, tgt, srcLen, tgtLen
+	dataset = dataset.map(sliceSentence, num_parallel_calls=max(prefetchDepth, 1))
+	dataset = dataset.apply(tf.contrib.data.bucket_by_sequence_length(
+		lambda src, tgt, srcLen, tgtLen: tf.maximum(srcLen, tgtLen), bucketBoundaries, bucketBatchSizes,
+		padded_shapes=([None], [None], [], []),
+		padding_values=(tf.constant(inputPadding, dtype=tf.int32), tf.constant(outputPadding, dtype=tf.int32), 0, 0)))
+	def addDecoderInput(src, tgt, srcLen, tgtLen):
+		# same as createDecoderInput, shift right with outputStartToken in front
+		decoderInput = tf.concat((tf.fill([tf.shape(tgt)[0], 1], outputStartToken), tgt[:, :-1]), axis=1)
+		return src, tgt, decoderInput, srcLen, tgtLen
+	dataset = dataset.map(addDecoderInput)
+	return dataset.prefetch(max(prefetchDepth, 1)), initializerFeed, shuffleSeed
+
+def prepareTrainingBatch(batch):
+	# convert the batch into contiguous int32 arrays, and precompute the maximum unrolling needed by the feed_dict
+	input, output, inputLengthList, outputLengthList, decoderInput = [np.ascontiguousarray(item, dtype=np.int32) for item in batch]
+	return (input, output, inputLengthList, outputLengthList, decoderInput), int(outputLengthList.max())
+
+class BatchPrefetcher:
+	# Producer/consumer pipeline: worker threads run prepareFunc on the next queueDepth keys while the consumer uses the current result
+	# results are returned in the order of the keys. queueDepth <= 0 run prepareFunc synchronously instead
+	def __init__(self, prepareFunc, queueDepth=4, workers=1):
+		self.prepareFunc = prepareFunc
+		self.queueDepth = queueDepth
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) if(queueDepth > 0) else None
+		# time the consumer spent waiting for a batch, and number of batches delivered
+		self.stallTime = 0.0
+		self.fetched = 0
+
+	def iterate(self, keys):
+		keys = iter(keys)
+		if(self.executor is None):
+			for key in keys:
+				timer = time.time()
+				result = self.prepareFunc(key)
+				self.stallTime += time.time() - timer
+				self.fetched += 1
+				yield result
+			return
+		pending = collections.deque(self.executor.submit(self.prepareFunc, key) for key in itertools.islice(keys, self.queueDepth))
+		while(len(pending) > 0):
+			future = pending.popleft()
+			# refill the queue before waiting, so the workers are never idle
+			for key in itertools.islice(keys, 1):
+				pending.append(self.executor.submit(self.prepareFunc, key))
+			timer = time.time()
+			result = future.result()
+			self.stallTime += time.time() - timer
+			self.fetched += 1
+			yield result
+
+	def close(self):
+		if(self.executor is not None):
+			self.executor.shutdown(wait=False)
+
+def countLinesInRange(task):
+	fileDir, start, end = task
+	file = io.open(fileDir, 'rb')
+	file.seek(start)
+	count = file.read(end - start).count(b'\n')
+	file.close()
+	return count
+
+def getLineStartOffsets(fileDir, lineNumbers, chunkCounts, chunkBoundaries):
+	# byte offsets where each of the (sorted) lineNumbers start, using the newline counts of each byte chunk
+	fileSize = chunkBoundaries[-1]
+	cumulativeCounts = np.concatenate(([0], np.cumsum(chunkCounts)))
+	file = io.open(fileDir, 'rb')
+	offsets = []
+	for lineNumber in lineNumbers:
+		if(lineNumber == 0 or lineNumber > cumulativeCounts[-1]):
+			# start of file, or the last line that have no newline at the end
+			offsets.append(0 if(lineNumber == 0) else fileSize)
+			continue
+		# the line start right after the lineNumber-th newline, located in chunk idx
+		idx = int(np.searchsorted(cumulativeCounts, lineNumber) - 1)
+		file.seek(chunkBoundaries[idx])
+		chunk = np.frombuffer(file.read(chunkBoundaries[idx+1] - chunkBoundaries[idx]), dtype=np.uint8)
+		newlinePositions = np.flatnonzero(chunk == ord('\n'))
+		offsets.append(chunkBoundaries[idx] + int(newlinePositions[lineNumber - cumulativeCounts[idx] - 1]) + 1)
+	file.close()
+	return offsets
+
+def countLinesInParallel(fileDir, numChunks, pool):
+	fileSize = os.path.getsize(fileDir)
+	chunkBoundaries = [fileSize * i // numChunks for i in range(numChunks + 1)]
+	chunkCounts = pool.map(countLinesInRange, [(fileDir, chunkBoundaries[i], chunkBoundaries[i+1]) for i in range(numChunks)])
+	numLines = sum(chunkCounts)
+	if(fileSize > 0):
+		# last line may not end with newline
+		file = io.open(fileDir, 'rb')
+		file.seek(fileSize - 1)
+		if(file.read(1) != b'\n'):
+			numLines += 1
+		file.close()
+	return numLines, chunkCounts, chunkBoundaries
+
+# vocab received once per worker process by the pool initializer
+encoderWorkerSetting = None
+
+def initializeEncoderWorker(setting):
+	global encoderWorkerSetting
+	encoderWorkerSetting = setting
+
+def readLinesInRange(fileDir, start, end):
+	file = io.open(fileDir, 'rb')
+	file.seek(start)
+	lines = file.read(end - start).decode('utf-8').split('\n')
+	file.close()
+	if(len(lines) > 0 and lines[-1] == ''):
+		# split leave an empty piece after the last newline
+		lines.pop()
+	return lines
+
+def encodeShard(task):
+	# convert a shard of both files into flat id arrays, same filtering and conversion as translator.readSentenceCouplingFromFiles
+	srcFileDir, srcStart, srcEnd, tgtFileDir, tgtStart, tgtEnd = task
+	srcWordToId, tgtWordToId, srcUnknownID, tgtUnknownID, maximumLength, splitToken = encoderWorkerSetting
+	srcLines, tgtLines = readLinesInRange(srcFileDir, srcStart, srcEnd), readLinesInRange(tgtFileDir, tgtStart, tgtEnd)
+	if(len(srcLines) != len(tgtLines)):
+		raise Exception("Mismatched number of lines in shard ({}:{}-{}, {}:{}-{})".format(srcFileDir, srcStart, srcEnd, tgtFileDir, tgtStart, tgtEnd))
+	srcIds, tgtIds, srcLengths, tgtLengths = [], [], [], []
+	for srcLine, tgtLine in zip(srcLines, tgtLines):
+		srcSentence, tgtSentence = srcLine.strip().split(splitToken), tgtLine.strip().split(splitToken)
+		if(len(srcSentence) > maximumLength or len(tgtSentence) > maximumLength):
+			continue
+		srcIds.extend(srcWordToId.get(word, srcUnknownID) for word in srcSentence)
+		tgtIds.extend(tgtWordToId.get(word, tgtUnknownID) for word in tgtSentence)
+		srcLengths.append(len(srcSentence))
+		tgtLengths.append(len(tgtSentence))
+	return len(srcLines), np.array(srcIds, dtype=np.int32), np.array(srcLengths, dtype=np.int32), np.array(tgtIds, dtype=np.int32), np.array(tgtLengths, dtype=np.int32)
+
+def encodeCouplingInParallel(srcFileDir, tgtFileDir, encoderSetting, workers, counter=None, shardsPerWorker=4):
+	# Split both files into shards of the same lines by byte ranges, encode them in worker processes and yield (srcIds, tgtIds) in the file order
+	# encoderSetting is (srcWordToId, tgtWordToId, srcUnknownID, tgtUnknownID, maximumLength, splitToken)
+	if(counter is None):
+		counter = {}
+	counter['read'], counter['accepted'] = 0, 0
+	pool = multiprocessing.Pool(workers, initializer=initializeEncoderWorker, initargs=(encoderSetting,))
+	try:
+		numShards = workers * shardsPerWorker
+		srcNumLines, srcChunkCounts, srcChunkBoundaries = countLinesInParallel(srcFileDir, numShards, pool)
+		tgtNumLines, tgtChunkCounts, tgtChunkBoundaries = countLinesInParallel(tgtFileDir, numShards, pool)
+		if(srcNumLines != tgtNumLines):
+			raise Exception("Mismatched number of lines between {}({}) and {}({})".format(srcFileDir, srcNumLines, tgtFileDir, tgtNumLines))
+		# shards have the same lines in both files
+		lineBoundaries = [srcNumLines * i // numShards for i in range(numShards + 1)]
+		srcOffsets = getLineStartOffsets(srcFileDir, lineBoundaries, srcChunkCounts, srcChunkBoundaries)
+		tgtOffsets = getLineStartOffsets(tgtFileDir, lineBoundaries, tgtChunkCounts, tgtChunkBoundaries)
+		tasks = [(srcFileDir, srcOffsets[i], srcOffsets[i+1], tgtFileDir, tgtOffsets[i], tgtOffsets[i+1]) for i in range(numShards)]
+		# imap keep the order of the shards, and only hold the finished shards waiting to be yielded
+		for numRead, srcIds, srcLengths, tgtIds, tgtLengths in pool.imap(encodeShard, tasks):
+			counter['read'] += numRead
+			counter['accepted'] += len(srcLengths)
+			srcIds, tgtIds = srcIds.tolist(), tgtIds.tolist()
+			srcOffset, tgtOffset = 0, 0
+			for srcLength, tgtLength in zip(srcLengths.tolist(), tgtLengths.tolist()):
+				yield srcIds[srcOffset:srcOffset+srcLength], tgtIds[tgtOffset:tgtOffset+tgtLength]
+				srcOffset += srcLength; tgtOffset += tgtLength
+	finally:
+		pool.terminate()
+
+def countCooccurrenceChunk(chunk, tgtVocabSize):
+	# count the (src, tgt) word pairs appearing in the same sentence pair, each pair counted once per sentence
+	keys = []
+	for srcSentence, tgtSentence in chunk:
+		srcWords, tgtWords = np.unique(np.asarray(srcSentence, dtype=np.int64)), np.unique(np.asarray(tgtSentence, dtype=np.int64))
+		keys.append((srcWords[:, None] * tgtVocabSize + tgtWords[None, :]).ravel())
+	return np.unique(np.concatenate(keys), return_counts=True) if(len(keys) > 0) else (np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64))
+
+def mergeKeyCounts(keys, counts, newKeys, newCounts):
+	# merge two (sorted unique keys, counts) pairs into one, summing the counts of the shared keys
+	mergedKeys = np.union1d(keys, newKeys)
+	mergedCounts = np.zeros(len(mergedKeys), dtype=np.int64)
+	mergedCounts[np.searchsorted(mergedKeys, keys)] += counts
+	mergedCounts[np.searchsorted(mergedKeys, newKeys)] += newCounts
+	return mergedKeys, mergedCounts
+
+def buildShortlistTable(coupling, srcVocabSize, tgtVocabSize, topK=20, chunkSize=10000):
+	# Word translation table from the co-occurrences of the id sentence pairs in coupling
+	# each source word keep the topK target words by dice score 2*count(s,t)/(count(s)+count(t)), -1 padded
+	srcCounts, tgtCounts = np.zeros(srcVocabSize, dtype=np.int64), np.zeros(tgtVocabSize, dtype=np.int64)
+	# running co-occurrence counts, the chunks are merged into them as they come so only the table and one chunk are in memory
+	keys, counts = np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64)
+	coupling = iter(coupling)
+	while(True):
+		chunk = list(itertools.islice(coupling, chunkSize))
+		if(len(chunk) == 0):
+			break
+		for srcSentence, tgtSentence in chunk:
+			srcCounts[np.unique(srcSentence)] += 1
+			tgtCounts[np.unique(tgtSentence)] += 1
+		keys, counts = mergeKeyCounts(keys, counts, *countCooccurrenceChunk(chunk, tgtVocabSize))
+	candidates = np.full([srcVocabSize, topK], -1, dtype=np.int32)
+	if(len(keys) == 0):
+		return candidates, tgtCounts
+	srcWords, tgtWords = keys // tgtVocabSize, keys % tgtVocabSize
+	scores = 2.0 * counts / (srcCounts[srcWords] + tgtCounts[tgtWords])
+	# sort by source word then decreasing score, and keep the first topK of each source word
+	order = np.lexsort((-scores, srcWords))
+	srcWords, tgtWords = srcWords[order], tgtWords[order]
+	groupStart = np.searchsorted(srcWords, srcWords, side='left')
+	rank = np.arange(len(srcWords)) - groupStart
+	kept = rank < topK
+	candidates[srcWords[kept], rank[kept]] = tgtWords[kept]
+	return candidates, tgtCounts
+
+def saveShortlistTable(fileDir, candidates, tgtCounts, topK):
+	with io.open(fileDir, 'wb') as tableFile:
+		np.savez(tableFile, candidates=candidates, tgtCounts=tgtCounts, topK=np.int32(topK))
+
+def loadShortlistTable(fileDir, numFrequent=1000):
+	# return the candidates table, the numFrequent most frequent target ids and the topK the table was built with (None for older tables)
+	table = np.load(fileDir)
+	tgtCounts = table['tgtCounts']
+	frequentIds = np.argsort(-tgtCounts, kind='mergesort')[:numFrequent].astype(np.int32)
+	topK = int(table['topK']) if('topK' in table.files) else None
+	return table['candidates'], frequentIds, topK
+
+def createBatchShortlist(candidates, frequentIds, srcBatch, shortlistSize, specialIds=()):
+	# union of the special ids, the candidates of the batch words (best ranked first) and the frequent ids, cut or padded to shortlistSize
+	batchWords = np.unique(np.asarray(srcBatch))
+	batchCandidates = candidates[batchWords].T.ravel()
+	ids = np.concatenate([np.asarray(specialIds, dtype=np.int32), batchCandidates[batchCandidates >= 0], frequentIds])
+	# unique while keeping the first occurence order
+	_, firstIdx = np.unique(ids, return_index=True)
+	ids = ids[np.sort(firstIdx)][:shortlistSize]
+	if(len(ids) < shortlistSize):
+		# pad by repeating the first id, duplicates do not change the argmax
+		ids = np.concatenate([ids, np.full([shortlistSize - len(ids)], ids[0], dtype=np.int32)])
+	return ids.astype(np.int32)
+
+def estimateLengthRatio(srcLengths, tgtLengths, margin, coverage=0.99):
+	# smallest ratio such that ratio * srcLength + margin cover the target length of coverage of the sentence pairs
+	srcLengths, tgtLengths = np.asarray(srcLengths, dtype=np.float64), np.asarray(tgtLengths, dtype=np.float64)
+	valid = srcLengths > 0
+	if(not np.any(valid)):
+		return 1.0
+	neededRatio = (tgtLengths[valid] - margin) / srcLengths[valid]
+	return max(float(np.percentile(neededRatio, coverage * 100.0)), 0.0)
+
+def getDecodeLengthLimit(inputLengths, ratio, margin, maximumLength):
+	# per-sentence decode limit from the source lengths, capped at maximumLength
+	limit = np.ceil(np.asarray(inputLengths, dtype=np.float64) * ratio + margin).astype(np.int32)
+	return np.clip(limit, 1, maximumLength)
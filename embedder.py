@@ -406,8 +406,15 @@ def exportEmbedding(exportMode, outputDir, outputExt, wordDict, resultMatrixTupl
 		file = io.open(outputDir + '.' + outputExt, "wb")
 		pickle.dump(normalDict if exportMode == "binary" else (normalDict, normalizedDict), file)
 		file.close()
+	elif(exportMode == "compiled" or exportMode == "compiled_full"):
+		# float32 matrix in .npy with a .vocab word list, can be memory-mapped upon loading. The normalized version have the .normalized suffix
+		listWords = [word for word in wordDict if not (tagDictForRemoval and word in tagDictForRemoval)]
+		listIdx = [wordDict[word] for word in listWords]
+		writeCompiledEmbedding(outputDir + '.' + outputExt, listWords, np.asarray(resultMatrixTuple[0])[listIdx])
+		if("full" in exportMode):
+			writeCompiledEmbedding(outputDir + '.' + outputExt + '.normalized', listWords, np.asarray(resultMatrixTuple[1])[listIdx])
 	else:
-		raise Exception("Wrong mode @exportEmbedding, must be all|both|default|normalized|binary|binary_full")
+		raise Exception("Wrong mode @exportEmbedding, must be all|both|default|normalized|binary|binary_full|compiled|compiled_full")
 
 def writeWordToFile(file, word, vector, dimensionFormat="%.6f"):
 	file.write(word + '\t')
@@ -458,7 +465,7 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Create training examples from resource data.')
 	parser.add_argument('-i','--inputdir', type=str, default=None, required=True, help='location of the input files')
 	parser.add_argument('-m', '--mode', type=modeStringToTuple, required=True, help='the mode to embed the word2vec in, must be in format (dependency|normal)_(skipgram|cbow)_wordWindow(only if in normal mode)')
-	parser.add_argument('-x', '--export_mode', required=True, type=str, help='exporting the values to an outside file, must be (all|both|default|normalized|binary|binary_full|vocab)')
+	parser.add_argument('-x', '--export_mode', required=True, type=str, help='exporting the values to an outside file, must be (all|both|default|normalized|binary|binary_full|compiled|compiled_full|vocab)')
 	parser.add_argument('-o','--outputdir', type=str, default=None, help='location of the output file')
 	parser.add_argument('-t','--tagdir', type=str, default="all_tag.txt", help='location of the tag file containing both POStag and dependency, default all_tag.txt')
 	parser.add_argument('--input_extension', type=str, default="conllx", help='file extension for input file, default conllx')
@@ -482,6 +489,8 @@ if __name__ == "__main__":
 	if(args.output_extension is None):
 		if('binary' in args.export_mode):
 			args.output_extension = "embedding.bin"
+		elif('compiled' in args.export_mode):
+			args.output_extension = "embedding"
 		else:
 			args.output_extension = "embedding.txt"
 	embeddingSize = args.embedding_size
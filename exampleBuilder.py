@@ -1,4 +1,5 @@
-import sys, re, argparse, io, time
+import sys, re, argparse, io, time, os, pickle
+import numpy as np
 
 blankLineRegex = re.compile("^\s*$")
 PACFormatString = u"PAC {}, ({} {} {}) ({} {} {}) {} {} {}\n"
@@ -395,6 +396,10 @@ def getTagFromFile(filetagDir, combined=False):
 		return (posTag, dependencyTag)
 	
 def createWordDictFromFile(filewordDir):
+	if(isCompiledEmbedding(filewordDir)):
+		# rows of the mapped matrix, no parsing needed
+		idToWord, matrix = readCompiledEmbedding(filewordDir)
+		return dict((word, matrix[idx]) for idx, word in enumerate(idToWord))
 	fileword = io.open(filewordDir, 'r', encoding='utf-8')
 	line = fileword.readline()
 	wordDict = {}
@@ -423,6 +428,15 @@ def createRefDictFromListTree(treeList):
 	return refDict
 
 def createMinimalWordDictFromFile(filewordDir, refDict):
+	if(isCompiledEmbedding(filewordDir)):
+		# only look up the words in refDict, which are removed from it when found like the text version
+		idToWord, matrix = readCompiledEmbedding(filewordDir)
+		wordDict = {}
+		for idx, word in enumerate(idToWord):
+			if(word in refDict):
+				wordDict[word] = matrix[idx]
+				refDict.pop(word)
+		return wordDict
 	fileword = io.open(filewordDir, 'r', encoding='utf-8')
 	line = fileword.readline()
 	wordDict = {}
@@ -445,6 +459,62 @@ def createMinimalWordDictFromFile(filewordDir, refDict):
 		line = fileword.readline()
 	return wordDict
 	
+def getCompiledEmbeddingPaths(fileDir):
+	# the compiled embedding is a float32 matrix in .npy and its words in .vocab, one per line in the same order
+	return fileDir + '.npy', fileDir + '.vocab'
+
+def isCompiledEmbedding(fileDir):
+	matrixPath, vocabPath = getCompiledEmbeddingPaths(fileDir)
+	return os.path.isfile(matrixPath) and os.path.isfile(vocabPath)
+
+def writeCompiledEmbedding(fileDir, listWords, matrix):
+	matrixPath, vocabPath = getCompiledEmbeddingPaths(fileDir)
+	assert len(listWords) == len(matrix)
+	np.save(matrixPath, np.ascontiguousarray(matrix, dtype=np.float32))
+	file = io.open(vocabPath, 'w', encoding='utf-8')
+	for word in listWords:
+		file.write(word + '\n')
+	file.close()
+
+def readCompiledEmbedding(fileDir, mmap=True):
+	# return the words as list (id to word) and the matrix, memory-mapped by default
+	matrixPath, vocabPath = getCompiledEmbeddingPaths(fileDir)
+	matrix = np.load(matrixPath, mmap_mode='r' if(mmap) else None)
+	file = io.open(vocabPath, 'r', encoding='utf-8')
+	idToWord = [word.rstrip('\n') for word in file]
+	file.close()
+	if(len(idToWord) != len(matrix)):
+		raise Exception("Compiled embedding {} has {} words but {} vectors".format(fileDir, len(idToWord), len(matrix)))
+	return idToWord, matrix
+	
+def getEmbeddingFromFile(fileDir, useDefault=True):
+	file = io.open(fileDir, 'rb')
+	dictTuple = pickle.load(file)
+	file.close()
+	if(isinstance(dictTuple, dict)):
+		return dictTuple
+	elif(isinstance(dictTuple, (tuple, list))):
+		return dictTuple[0 if useDefault else 1]
+	else:
+		raise Exception("Wrong type during pickle read file")
+	
+def getEmbeddingTupleFromFile(fileDir, useDefault=True, compileEmbedding=False):
+	# Use the compiled embedding (memory-mapped matrix + vocab list) if it exist beside the pickled dict, else read the pickled dict
+	compiledDir = fileDir if(useDefault) else fileDir + '.normalized'
+	if(isCompiledEmbedding(compiledDir)):
+		idToWord, embeddingVector = readCompiledEmbedding(compiledDir)
+	else:
+		embeddingDict = getEmbeddingFromFile(fileDir, useDefault)
+		# TODO Print a warning here for normal dict, since it may change order each time it is used. Then again, we are using OrderedDict and python3 stated that it preserve the sequence of words. So low priority.
+		idToWord = list(embeddingDict.keys())
+		embeddingVector = np.array(list(embeddingDict.values()), dtype=np.float32)
+		del embeddingDict
+		if(compileEmbedding):
+			# write once, later runs will load the compiled version instead
+			writeCompiledEmbedding(compiledDir, idToWord, embeddingVector)
+	wordToId = dict((word, idx) for idx, word in enumerate(idToWord))
+	return wordToId, idToWord, embeddingVector
+	
 def createFormatPAC(separator):
 	formatPAC = separator.join(['%s' for i in range(5)])
 	def formatter(string, parent, child):
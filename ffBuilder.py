@@ -1,4 +1,7 @@
+import numpy as np
 import tensorflow as tf
+import os, io, json, threading, queue
+from tensorflow.python.client import timeline
 
 def createRandomArray(size):
 	if(not isinstance(size, tuple) and not isinstance(size, list)):
@@ -255,7 +258,9 @@ def createDecoder(settingDict):
 	else:
 		trainHelper = tf.contrib.seq2seq.ScheduledEmbeddingTrainingHelper(decoderTrainingInput, correctResultLen, outputEmbedding, settingDict['samplingVariable'])
 	# Helper for feeding the output of the current timespan for the inference mode
-	inferHelper = tf.contrib.seq2seq.GreedyEmbeddingHelper(outputEmbedding, tf.fill([batchSize], startToken), endToken)
+	# each sentence may have its own decode length limit (decoderLengthLimit), on top of maximumDecoderLength for the batch
+	decoderLengthLimit = settingDict.get('decoderLengthLimit', None)
+	inferHelper = LengthLimitedGreedyEmbeddingHelper(outputEmbedding, tf.fill([batchSize], startToken), endToken, decoderLengthLimit)
 	# Projection layer
 	projectionLayer = tf.layers.Dense(decoderOutputSize, name=prefix+'_projection') if(layerSize != decoderOutputSize) else None
 	# create the initial state out by cloning
@@ -269,11 +274,23 @@ def createDecoder(settingDict):
 	#	initialState = initialState.clone(cell_state=encoderState)
 	# depending on the mode being training or infer, use either Helper as fit
 	inferDecoder = tf.contrib.seq2seq.BasicDecoder(decoderCells, inferHelper, initialState, output_layer=projectionLayer)
-	trainDecoder = tf.contrib.seq2seq.BasicDecoder(decoderCells, trainHelper, initialState, output_layer=projectionLayer)
+	# with sampled softmax, the training decoder output the hidden states and the loss only project the sampled ids
+	numSampled = settingDict.get('sampledSoftmax', None)
+	if(numSampled is not None and projectionLayer is None):
+		raise Exception("Sampled softmax need a projection layer, but layerSize is the same as the vocabulary size")
+	if(numSampled is not None and 'samplingVariable' in settingDict):
+		raise Exception("Sampled softmax cannot be used with scheduled sampling, which sample the next ids from the projected output")
+	trainDecoder = tf.contrib.seq2seq.BasicDecoder(decoderCells, trainHelper, initialState, output_layer=projectionLayer if(numSampled is None) else None)
 	# Another bunch of stuff I don't understand. Apparently the outputs and state are being created automatically. Yay.
 	inferOutput, _, _ = tf.contrib.seq2seq.dynamic_decode(inferDecoder, maximum_iterations=maximumDecoderLength)
 	trainOutput, _, _ = tf.contrib.seq2seq.dynamic_decode(trainDecoder)
 	trainLogits = trainOutput.rnn_output
+	shortlist = settingDict.get('shortlist', None)
+	if(shortlist is not None):
+		# greedy decoder restricted to the shortlist ids, reusing the cells and projection built by the decoders above
+		shortlistHelper = ShortlistGreedyEmbeddingHelper(outputEmbedding, tf.fill([batchSize], startToken), endToken, shortlist, decoderLengthLimit)
+		shortlistDecoder = tf.contrib.seq2seq.BasicDecoder(decoderCells, shortlistHelper, initialState, output_layer=ShortlistProjection(projectionLayer, shortlist, name=prefix+'_shortlist_projection'))
+		inferOutput, _, _ = tf.contrib.seq2seq.dynamic_decode(shortlistDecoder, maximum_iterations=maximumDecoderLength)
 	# inferLogits = inferOutput.rnn_output
 	'''if(decoderOutputSize != layerSize):
 		trainLogits = tf.layers.dense(trainLogits, decoderOutputSize, name='shared_projection', reuse=None)
@@ -282,9 +299,18 @@ def createDecoder(settingDict):
 	# sample_id = trainOutput.sample_id
 	# correctResult in bareMode are [batchSize, maximumDecoderLength, vectorSize] represent correct value expected.
 	# correctResult in bareMode are [batchSize, maximumDecoderLength] represent correct ids expected.
-	lossOp, crossent = createSoftmaxDecoderLossOperation(trainLogits, correctResult, correctResultLen, batchSize, maximumDecoderLength)
+	if(numSampled is None):
+		lossOp, crossent, tokenLoss = createSoftmaxDecoderLossOperation(trainLogits, correctResult, correctResultLen, batchSize, maximumDecoderLength)
+		trainIds = trainOutput.sample_id
+	else:
+		# the projection is built by the inference decoder. Its kernel is (layerSize, vocab) while the loss need (vocab, layerSize)
+		sampledSoftmax = (tf.transpose(projectionLayer.kernel), projectionLayer.bias, numSampled, decoderOutputSize)
+		lossOp, crossent, tokenLoss = createSoftmaxDecoderLossOperation(trainLogits, correctResult, correctResultLen, batchSize, maximumDecoderLength, sampledSoftmax)
+		# full projection for the evaluation ids, only computed when fetched
+		trainIds = tf.argmax(projectionLayer(trainLogits), axis=-1, output_type=tf.int32)
 	# secondaryLossOp, secondaryCrossent = createSoftmaxDecoderLossOperation(inferLogits, correctResult, correctResultLen, batchSize, maximumDecoderLength)
-	return trainLogits, lossOp, (trainOutput.sample_id, inferOutput.sample_id), crossent
+	settingDict['tokenLoss'] = tokenLoss
+	return trainLogits, lossOp, (trainIds, inferOutput.sample_id), crossent
 	
 def createSingleDecoder(isTrainingMode, settingDict):
 	prefix = settingDict.get('prefix', 'decoder')
@@ -369,18 +395,23 @@ def createOptimizer(settingDict):
 									true_fn=lambda: tf.train.exponential_decay(trainingRate,(globalSteps - decayThreshold), decayStep, decayFactor, staircase=True),
 									false_fn=lambda: trainingRate)
 		
+		settingDict['currentTrainingRate'] = trainingRate
 		return tf.train.GradientDescentOptimizer(trainingRate)
 	elif(mode.lower() == 'adam'):
 		if('trainingRate' not in settingDict):
+			settingDict['currentTrainingRate'] = 0.001
 			return tf.train.AdamOptimizer()
 		else:
 			trainingRate = settingDict['trainingRate']
+			settingDict['currentTrainingRate'] = trainingRate
 			return tf.train.AdamOptimizer(trainingRate)
 	else:
 		raise Exception("Optimizer not specified.")
 	
 def configureGradientOptions(optimizer, settingDict):
 	assert all(key in settingDict for key in ['colocateGradient', 'clipGradient', 'globalSteps', 'loss'])
+	if(settingDict.get('accumulateSteps', 1) > 1):
+		return configureAccumulatedGradients(optimizer, settingDict)
 	loss = settingDict['loss']
 	colocateGradient = settingDict['colocateGradient']
 	# The gradient of all params affected 
@@ -390,10 +421,49 @@ def configureGradientOptions(optimizer, settingDict):
 	# The maximum value of gradient allowed
 	gradientClipValue = settingDict['clipGradient']
 	gradientClipValue, globalNorm = tf.clip_by_global_norm(gradients, gradientClipValue)
+	settingDict['gradientGlobalNorm'] = globalNorm
 	zippedGradientList = list(zip(gradientClipValue, affectedParams))
 	# print(zippedGradientList[0])
 	globalSteps = settingDict['globalSteps']
 	return optimizer.apply_gradients(zippedGradientList, global_step=globalSteps)
+
+def configureAccumulatedGradients(optimizer, settingDict):
+	# return the op adding the gradients of a micro-batch to the accumulators, the op applying them is put in settingDict['applyGradient']
+	# the accumulated gradients are of the loss summed over tokens, then divided by the tokens of all the micro-batches before clipping
+	tokenLoss, tokenCount = settingDict['tokenLoss']
+	gradients, affectedParams = zip(*[(gradient, param) for gradient, param in optimizer.compute_gradients(tokenLoss) if gradient is not None])
+	# local variables, so they are neither saved with the model nor restored from it
+	with tf.variable_scope('gradient_accumulators'):
+		accumulators = [tf.Variable(tf.zeros(param.shape, dtype=param.dtype.base_dtype), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name=param.op.name.replace('/', '_')) for param in affectedParams]
+		accumulatedTokens = tf.Variable(0.0, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name='tokens')
+	# norm of the token-normalized gradient of the current micro-batch, only computed when fetched
+	settingDict['gradientGlobalNorm'] = tf.global_norm(gradients) / tf.maximum(tokenCount, 1.0)
+	accumulateOps = [accumulatedTokens.assign_add(tokenCount)]
+	for accumulator, gradient in zip(accumulators, gradients):
+		if(isinstance(gradient, tf.IndexedSlices)):
+			# embedding gradients only touch the rows looked up
+			accumulateOps.append(tf.scatter_add(accumulator, gradient.indices, gradient.values))
+		else:
+			accumulateOps.append(accumulator.assign_add(gradient))
+	normalizedGradients = [accumulator / tf.maximum(accumulatedTokens, 1.0) for accumulator in accumulators]
+	clippedGradients, globalNorm = tf.clip_by_global_norm(normalizedGradients, settingDict['clipGradient'])
+	# the global step is only increased by the apply, so warmup and decay follow the updates as with the large batch
+	applyOp = optimizer.apply_gradients(list(zip(clippedGradients, affectedParams)), global_step=settingDict['globalSteps'])
+	with tf.control_dependencies([applyOp]):
+		resetOps = [accumulator.assign(tf.zeros_like(accumulator)) for accumulator in accumulators] + [accumulatedTokens.assign(0.0)]
+	settingDict['applyGradient'] = tf.group(*resetOps)
+	return tf.group(*accumulateOps)
+	
+def createHealthOperations(variables=None):
+	# per-variable minimum, maximum, norm and all-finite flag stacked in vectors, and the global norm, so a single fetch return all of them
+	variables = variables if(variables is not None) else tf.trainable_variables()
+	with tf.name_scope('health'):
+		minimums = tf.stack([tf.reduce_min(variable) for variable in variables])
+		maximums = tf.stack([tf.reduce_max(variable) for variable in variables])
+		norms = tf.stack([tf.norm(variable) for variable in variables])
+		finites = tf.stack([tf.reduce_all(tf.is_finite(variable)) for variable in variables])
+		globalNorm = tf.global_norm(variables)
+	return [variable.name for variable in variables], (minimums, maximums, norms, finites, globalNorm)
 	
 def createDecoderLossOperation(logits, correctResult, sequenceLengthList, batchSize, maxUnrolling, extraWeightTowardTop=False):
 	# the maximum unrolling and batchSize for the encoder during the entire batch. correctResult should be [batchSize, sentenceSize, vectorSize], hence [1] and [0]
@@ -413,11 +483,18 @@ def createDecoderLossOperation(logits, correctResult, sequenceLengthList, batchS
 	loss = tf.reduce_sum(tf.multiply(subtract, target_weights, name="subtract")) / tf.to_float(batchSize)
 	return loss, target_weights
 	
-def createSoftmaxDecoderLossOperation(logits, correctIds, sequenceLengthList, batchSize, maxUnrolling):
+def createSoftmaxDecoderLossOperation(logits, correctIds, sequenceLengthList, batchSize, maxUnrolling, sampledSoftmax=None):
 	# logits are undoing softmax, compare it with correctIds. the correctIds will converted to onehot upon use
 	# raise the values in logits to prevent 0. May work or may not
 	# logits = tf.clip_by_value(logits, 1e-10, 1e10)
-	crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=correctIds, logits=logits)
+	if(sampledSoftmax is None):
+		crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=correctIds, logits=logits)
+	else:
+		# logits are the decoder outputs before projection, only the logits of the correct and numSampled sampled ids are computed
+		weights, biases, numSampled, numClasses = sampledSoftmax
+		outputSize = tf.shape(logits)[-1]
+		crossent = tf.nn.sampled_softmax_loss(weights=weights, biases=biases, labels=tf.reshape(correctIds, [-1, 1]), inputs=tf.reshape(logits, [-1, outputSize]), num_sampled=numSampled, num_classes=numClasses)
+		crossent = tf.reshape(crossent, tf.shape(correctIds))
 	# subtract = tf.reduce_mean(tf.square(tf.subtract(correctResult, logits)), axis=2)
 	# mask to only calculate loss on the length of the sequence, not the padding
 	target_weights = tf.sequence_mask(sequenceLengthList, maxUnrolling, dtype=tf.float32)
@@ -425,7 +502,10 @@ def createSoftmaxDecoderLossOperation(logits, correctIds, sequenceLengthList, ba
 	target_weights = tf.transpose(tf.transpose(target_weights) / tf.to_float(sequenceLengthList))
 	# the loss function being the reduce mean of the entire batch
 	loss = tf.reduce_sum(tf.multiply(crossent, target_weights, name="crossent")) / tf.to_float(batchSize)
-	return loss, target_weights
+	# the loss summed over the real tokens and their count, for normalizing by tokens across several batches
+	tokenMask = tf.sequence_mask(sequenceLengthList, maxUnrolling, dtype=tf.float32)
+	tokenLoss = (tf.reduce_sum(crossent * tokenMask), tf.reduce_sum(tokenMask))
+	return loss, target_weights, tokenLoss
 	
 def createRNNLayers(cellType, layerSize, layerDepth, forgetBias, dropout=None, name='RNN'):
 	layers = []
@@ -478,6 +558,50 @@ class CustomGreedyEmbeddingHelper(tf.contrib.seq2seq.GreedyEmbeddingHelper):
 		next_inputs = tf.cond(time > 0, lambda: outputs, lambda: self._embedding_fn(sample_ids))
 		return finished, next_inputs, state
 
+class LengthLimitedGreedyEmbeddingHelper(tf.contrib.seq2seq.GreedyEmbeddingHelper):
+	# GreedyEmbeddingHelper which also finish each sentence once it has output lengthLimit[batchIdx] ids
+	def __init__(self, embedding, start_tokens, end_token, lengthLimit=None):
+		super(LengthLimitedGreedyEmbeddingHelper, self).__init__(embedding, start_tokens, end_token)
+		self._length_limit = lengthLimit
+	
+	def next_inputs(self, time, outputs, state, sample_ids, name=None):
+		finished, next_inputs, state = super(LengthLimitedGreedyEmbeddingHelper, self).next_inputs(time, outputs, state, sample_ids, name=name)
+		if(self._length_limit is not None):
+			finished = tf.logical_or(finished, time + 1 >= self._length_limit)
+		return finished, next_inputs, state
+
+class ShortlistGreedyEmbeddingHelper(LengthLimitedGreedyEmbeddingHelper):
+	# The outputs are the logits of the shortlist ids only (ShortlistProjection), map the argmax back to the vocabulary id
+	def __init__(self, embedding, start_tokens, end_token, shortlist, lengthLimit=None):
+		super(ShortlistGreedyEmbeddingHelper, self).__init__(embedding, start_tokens, end_token, lengthLimit)
+		self._shortlist = shortlist
+	
+	def sample(self, time, outputs, state, name=None):
+		del time, state  # unused by sample_fn
+		return tf.gather(self._shortlist, tf.argmax(outputs, axis=-1, output_type=tf.int32))
+
+class ShortlistProjection(tf.layers.Layer):
+	# Compute only the logits of the shortlist ids, using the kernel/bias of the already built projectionLayer
+	# the shortlist must have a static size, as the decoder need a known output size
+	def __init__(self, projectionLayer, shortlist, name='shortlist_projection'):
+		super(ShortlistProjection, self).__init__(name=name)
+		self._projectionLayer = projectionLayer
+		self._shortlist = shortlist
+		if(projectionLayer is not None):
+			# gather once outside of the decoding loop
+			self._kernel = tf.gather(projectionLayer.kernel, shortlist, axis=1)
+			self._bias = tf.gather(projectionLayer.bias, shortlist) if(projectionLayer.use_bias) else None
+	
+	def call(self, inputs):
+		if(self._projectionLayer is None):
+			# no projection, the cell output are the logits
+			return tf.gather(inputs, self._shortlist, axis=1)
+		logits = tf.matmul(inputs, self._kernel)
+		return tf.nn.bias_add(logits, self._bias) if(self._bias is not None) else logits
+	
+	def compute_output_shape(self, input_shape):
+		return tf.TensorShape(input_shape)[:-1].concatenate(self._shortlist.shape[0])
+
 def createHashDict(hashType, keyValueTensorOrTypeTuple=None, defaultValue=-1, inputTensor=None):
 	if(inputTensor is None):
 		inputTensor = tf.placeholder(tf.int32)
@@ -635,3 +759,198 @@ def loadFromPath(session, path):
 	except tf.errors.NotFoundError:
 		print("Skip the load process @ path {} due to file not existing.".format(path))
 	return session
+
+def snapshotVariables(session, variables=None):
+	# values of all variables at this moment, keyed by name. Must run between training steps for a consistent snapshot
+	variables = variables if(variables is not None) else tf.global_variables()
+	return dict(zip([variable.name for variable in variables], session.run(variables)))
+
+def restoreVariables(session, values, variables=None):
+	# load the values by name without adding ops to the graph, return the names of variables not in values
+	variables = variables if(variables is not None) else tf.global_variables()
+	missing = []
+	for variable in variables:
+		if(variable.name in values):
+			variable.load(values[variable.name], session)
+		else:
+			missing.append(variable.name)
+	return missing
+
+CHECKPOINT_INFO_FILE = 'checkpoint.json'
+
+class AsyncCheckpointWriter:
+	# Write the variable snapshots to checkpointDir in a background thread, keeping only the newest keep checkpoints
+	# save block only when the previous snapshots are still being written, so the memory stay bounded
+	def __init__(self, checkpointDir, keep=5):
+		self.checkpointDir = checkpointDir
+		self.keep = keep
+		if(not os.path.isdir(checkpointDir)):
+			os.makedirs(checkpointDir)
+		self.queue = queue.Queue(maxsize=1)
+		self.error = None
+		self.thread = threading.Thread(target=self.run, name='AsyncCheckpointWriter')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def save(self, values, info):
+		if(self.error is not None):
+			raise Exception("Checkpoint writer failed: %s" % self.error)
+		self.queue.put((values, info))
+
+	def run(self):
+		while(True):
+			item = self.queue.get()
+			if(item is None):
+				break
+			try:
+				self.write(*item)
+			except Exception as e:
+				self.error = e
+
+	def write(self, values, info):
+		fileName = 'step-%d.npz' % info['global_steps']
+		# write to a temporary name first, so a crash never leave a partial checkpoint listed
+		tempPath = os.path.join(self.checkpointDir, fileName + '.tmp')
+		with io.open(tempPath, 'wb') as checkpointFile:
+			np.savez(checkpointFile, **values)
+		os.replace(tempPath, os.path.join(self.checkpointDir, fileName))
+		checkpoints = [checkpoint for checkpoint in readCheckpointList(self.checkpointDir) if checkpoint['file'] != fileName]
+		checkpoints.append(dict(info, file=fileName))
+		for checkpoint in checkpoints[:-self.keep]:
+			if(os.path.isfile(os.path.join(self.checkpointDir, checkpoint['file']))):
+				os.remove(os.path.join(self.checkpointDir, checkpoint['file']))
+		checkpoints = checkpoints[-self.keep:]
+		tempPath = os.path.join(self.checkpointDir, CHECKPOINT_INFO_FILE + '.tmp')
+		with io.open(tempPath, 'w', encoding='utf-8') as infoFile:
+			infoFile.write(json.dumps(checkpoints, indent=2))
+		os.replace(tempPath, os.path.join(self.checkpointDir, CHECKPOINT_INFO_FILE))
+
+	def close(self):
+		# wait for the pending snapshots to be written
+		self.queue.put(None)
+		self.thread.join()
+		if(self.error is not None):
+			raise Exception("Checkpoint writer failed: %s" % self.error)
+
+def readCheckpointList(checkpointDir):
+	infoPath = os.path.join(checkpointDir, CHECKPOINT_INFO_FILE)
+	if(not os.path.isfile(infoPath)):
+		return []
+	with io.open(infoPath, 'r', encoding='utf-8') as infoFile:
+		return json.load(infoFile)
+
+def loadLatestCheckpoint(checkpointDir):
+	# return (values, info) of the newest checkpoint, or None
+	checkpoints = readCheckpointList(checkpointDir)
+	if(len(checkpoints) == 0):
+		return None
+	info = checkpoints[-1]
+	with np.load(os.path.join(checkpointDir, info['file'])) as checkpointFile:
+		values = {name:checkpointFile[name] for name in checkpointFile.files}
+	return values, info
+
+def freezeGraph(session, outputNames):
+	# convert the variables to constants, keeping only the ops needed to compute outputNames
+	return tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), outputNames)
+
+def writeGraphDef(graphDef, path):
+	with tf.gfile.GFile(path, 'wb') as graphFile:
+		graphFile.write(graphDef.SerializeToString())
+
+def quantizeGraphDef(graphDef, minimumSize=1024):
+	# Replace the float matrices constants of a frozen graph by int8 constants with per-channel scales, dequantized by a Cast and Mul under the original name
+	# kernels (dense/LSTM, [input, output]) have a scale per output column, embeddings ([vocab, size]) a scale per word
+	# this only compress the stored graph: the dequantization is constant-folded back to float32 when the graph is loaded, so memory use and decode speed are unchanged
+	quantizedGraphDef = tf.GraphDef()
+	quantizedGraphDef.versions.CopyFrom(graphDef.versions)
+	quantizedGraphDef.library.CopyFrom(graphDef.library)
+	quantizedNames, originalBytes, quantizedBytes = [], 0, 0
+	for node in graphDef.node:
+		isMatrix = node.op == 'Const' and node.attr['dtype'].type == tf.float32.as_datatype_enum and len(node.attr['value'].tensor.tensor_shape.dim) == 2
+		if(not isMatrix or np.prod([dim.size for dim in node.attr['value'].tensor.tensor_shape.dim]) < minimumSize):
+			quantizedGraphDef.node.extend([node])
+			continue
+		weights = tf.make_ndarray(node.attr['value'].tensor)
+		scale = np.max(np.abs(weights), axis=0 if(node.name.endswith('kernel')) else 1, keepdims=True) / 127.0
+		scale[scale == 0.0] = 1.0
+		quantized = np.clip(np.round(weights / scale), -127, 127).astype(np.int8)
+		quantizedNode = tf.NodeDef(name=node.name + '/quantized', op='Const', device=node.device)
+		quantizedNode.attr['dtype'].CopyFrom(tf.AttrValue(type=tf.int8.as_datatype_enum))
+		quantizedNode.attr['value'].CopyFrom(tf.AttrValue(tensor=tf.make_tensor_proto(quantized)))
+		scaleNode = tf.NodeDef(name=node.name + '/scale', op='Const', device=node.device)
+		scaleNode.attr['dtype'].CopyFrom(tf.AttrValue(type=tf.float32.as_datatype_enum))
+		scaleNode.attr['value'].CopyFrom(tf.AttrValue(tensor=tf.make_tensor_proto(scale.astype(np.float32))))
+		castNode = tf.NodeDef(name=node.name + '/dequantize', op='Cast', input=[quantizedNode.name], device=node.device)
+		castNode.attr['SrcT'].CopyFrom(tf.AttrValue(type=tf.int8.as_datatype_enum))
+		castNode.attr['DstT'].CopyFrom(tf.AttrValue(type=tf.float32.as_datatype_enum))
+		mulNode = tf.NodeDef(name=node.name, op='Mul', input=[castNode.name, scaleNode.name], device=node.device)
+		mulNode.attr['T'].CopyFrom(tf.AttrValue(type=tf.float32.as_datatype_enum))
+		quantizedGraphDef.node.extend([quantizedNode, scaleNode, castNode, mulNode])
+		quantizedNames.append(node.name)
+		originalBytes += weights.nbytes
+		quantizedBytes += quantized.nbytes + scale.size * 4
+	return quantizedGraphDef, (quantizedNames, originalBytes, quantizedBytes)
+
+def loadFrozenGraph(path):
+	graphDef = tf.GraphDef()
+	with tf.gfile.GFile(path, 'rb') as graphFile:
+		graphDef.ParseFromString(graphFile.read())
+	graph = tf.Graph()
+	with graph.as_default():
+		tf.import_graph_def(graphDef, name='')
+	return graph
+
+class StepProfiler:
+	# Run the selected steps with a full trace, write their Chrome trace timelines and aggregate the op costs of all the traced steps
+	# steps are counted per tag (train, infer, ...) unless the caller give its own step number
+	def __init__(self, profileSteps, outputDir):
+		self.profileSteps = set(profileSteps)
+		self.outputDir = outputDir
+		os.makedirs(outputDir, exist_ok=True)
+		self.counters = {}
+		# tag => {node name: [op type, calls, total microseconds]}
+		self.opCosts = {}
+
+	def run(self, session, fetches, feed_dict=None, tag='train', step=None):
+		if(step is None):
+			step = self.counters[tag] = self.counters.get(tag, 0) + 1
+		if(step not in self.profileSteps):
+			return session.run(fetches, feed_dict=feed_dict)
+		runOptions = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+		runMetadata = tf.RunMetadata()
+		result = session.run(fetches, feed_dict=feed_dict, options=runOptions, run_metadata=runMetadata)
+		self.record(runMetadata, tag, step)
+		return result
+
+	def record(self, runMetadata, tag, step):
+		traceFile = io.open(os.path.join(self.outputDir, "timeline_%s_%d.json" % (tag, step)), 'w', encoding='utf-8')
+		traceFile.write(timeline.Timeline(runMetadata.step_stats).generate_chrome_trace_format())
+		traceFile.close()
+		opCosts = self.opCosts.setdefault(tag, {})
+		for deviceStats in runMetadata.step_stats.dev_stats:
+			for nodeStats in deviceStats.node_stats:
+				# the label is "name = OpType(inputs)". The ops in the dynamic_decode while loops are counted once per iteration
+				label = nodeStats.timeline_label
+				opType = label.split(' = ', 1)[1].split('(', 1)[0] if(' = ' in label) else nodeStats.node_name
+				cost = opCosts.setdefault(nodeStats.node_name, [opType, 0, 0])
+				cost[1] += 1
+				cost[2] += nodeStats.all_end_rel_micros
+		return opCosts
+
+	def writeReport(self, numLines=30):
+		# per-op table sorted by total time for each tag, return the file names
+		reportFiles = []
+		for tag, opCosts in self.opCosts.items():
+			totalMicros = max(sum(cost[2] for cost in opCosts.values()), 1)
+			reportDir = os.path.join(self.outputDir, "op_costs_%s.tsv" % tag)
+			reportFile = io.open(reportDir, 'w', encoding='utf-8')
+			reportFile.write("node\top\tcalls\ttotal_ms\tmean_ms\tpercent\n")
+			sortedCosts = sorted(opCosts.items(), key=lambda item: -item[1][2])
+			for name, (opType, calls, micros) in sortedCosts:
+				reportFile.write("%s\t%s\t%d\t%.3f\t%.4f\t%.2f\n" % (name, opType, calls, micros / 1000.0, micros / 1000.0 / calls, 100.0 * micros / totalMicros))
+			reportFile.close()
+			reportFiles.append(reportDir)
+			print("Most costly ops of the traced %s steps (%s):" % (tag, reportDir))
+			for name, (opType, calls, micros) in sortedCosts[:numLines]:
+				print("%10.2fms %6.2f%% %6d calls  %-20s %s" % (micros / 1000.0, 100.0 * micros / totalMicros, calls, opType, name))
+		return reportFiles
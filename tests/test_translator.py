@@ -0,0 +1,80 @@
+import os, io, json, argparse
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+import ffBuilder as builder
+import translator
+
+def writeDummyInferenceGraph(graphPath, srcVocabSize=5, tgtVocabSize=7):
+	# minimal graph with the signature written by exportInferenceGraph
+	graph = tf.Graph()
+	with graph.as_default():
+		input = tf.placeholder(tf.int32, shape=[None, None], name='input')
+		tf.placeholder(tf.int32, shape=[], name='batch_size')
+		tf.placeholder(tf.int32, shape=[], name='decoder_maximum_length')
+		tf.identity(input, name=translator.INFERENCE_OUTPUT_NAME)
+	builder.writeGraphDef(graph.as_graph_def(), graphPath)
+	signature = {'inputs': {name:name + ':0' for name in ['input', 'batch_size', 'decoder_maximum_length']}, 'outputs': {'output_ids':translator.INFERENCE_OUTPUT_NAME + ':0'},
+		'src_vocab_size': srcVocabSize, 'tgt_vocab_size': tgtVocabSize, 'start_token': '<s>', 'end_token': '<\\s>', 'shortlist_size': 0}
+	with io.open(graphPath + '.json', 'w', encoding='utf-8') as signatureFile:
+		signatureFile.write(json.dumps(signature))
+
+def createEmbeddingTuple(srcVocabSize, tgtVocabSize):
+	return (None, ['w%d' % i for i in range(srcVocabSize)], None), (None, ['w%d' % i for i in range(tgtVocabSize)], None)
+
+def test_loadInferenceGraphWithoutEmbedding(tmp_path):
+	# the session replicas load the graph with embeddingTuple None
+	graphPath = str(tmp_path / 'model.inference.pb')
+	writeDummyInferenceGraph(graphPath)
+	args = argparse.Namespace(intra_op_threads=0, inter_op_threads=0)
+	session, inputOutputTuple, configTuple, trainTuple = translator.loadInferenceGraph(args, None, graphPath)
+	assert trainTuple is None
+	assert inputOutputTuple[0].name == 'input:0'
+	assert args.shortlist_input is None and args.shortlist_size == 0
+	session.close()
+
+def test_loadInferenceGraphVocabularyMismatch(tmp_path):
+	graphPath = str(tmp_path / 'model.inference.pb')
+	writeDummyInferenceGraph(graphPath, 5, 7)
+	args = argparse.Namespace(intra_op_threads=0, inter_op_threads=0)
+	translator.loadInferenceGraph(args, createEmbeddingTuple(5, 7), graphPath)[0].close()
+	with pytest.raises(Exception):
+		translator.loadInferenceGraph(args, createEmbeddingTuple(5, 8), graphPath)
+
+def test_evaluateCheckpointsFinalCheckpointRewritten(tmp_path, monkeypatch):
+	# the final checkpoint reuse the name of the last periodic one, marked complete. The evaluator must still stop on it
+	checkpointDir = str(tmp_path / 'model.checkpoints')
+	writer = builder.AsyncCheckpointWriter(checkpointDir, keep=5)
+	writer.write({'w:0':[1.0]}, {'global_steps':10, 'epoch':0, 'cursor':10, 'shuffle_seed':0, 'complete':False})
+	monkeypatch.setattr(builder, 'restoreVariables', lambda session, values: [])
+	monkeypatch.setattr(translator, 'calculateBleuOnBatches', lambda args, sessionTuple, batches: 0.5)
+	args = argparse.Namespace(evaluator_poll_secs=0.01)
+	metricsPath = str(tmp_path / 'model.metrics.jsonl')
+	calls = []
+	def sleep(seconds):
+		# first poll after evaluating step-10: the trainer rewrite it as the complete checkpoint
+		calls.append(seconds)
+		if(len(calls) == 1):
+			writer.write({'w:0':[2.0]}, {'global_steps':10, 'epoch':1, 'cursor':0, 'shuffle_seed':0, 'complete':True})
+			# a distinct mtime, whatever the resolution of the file system
+			os.utime(os.path.join(checkpointDir, 'step-10.npz'), (1e9, 1e9))
+	monkeypatch.setattr(translator.time, 'sleep', sleep)
+	translator.evaluateCheckpoints(args, (None,), [([[1, 2]],)], checkpointDir, metricsPath)
+	with io.open(metricsPath, 'r', encoding='utf-8') as metricsFile:
+		records = [json.loads(line) for line in metricsFile]
+	assert [record['complete'] for record in records] == [False, True]
+	writer.close()
+
+def test_evaluateCheckpointsStopWithoutParent(tmp_path, monkeypatch):
+	# an evaluator whose trainer is gone must exit instead of polling forever
+	checkpointDir = str(tmp_path / 'model.checkpoints')
+	writer = builder.AsyncCheckpointWriter(checkpointDir, keep=5)
+	writer.write({'w:0':[1.0]}, {'global_steps':10, 'epoch':0, 'cursor':10, 'shuffle_seed':0, 'complete':False})
+	monkeypatch.setattr(translator, 'calculateBleuOnBatches', lambda args, sessionTuple, batches: 0.5)
+	metricsPath = str(tmp_path / 'model.metrics.jsonl')
+	translator.evaluateCheckpoints(argparse.Namespace(evaluator_poll_secs=0.01), (None,), [([[1, 2]],)], checkpointDir, metricsPath, parentPid=-1)
+	assert not os.path.isfile(metricsPath)
+	writer.close()
+
+def test_removeOptions():
+	assert translator.removeOptions(['--mode', 'train', '--profile_steps', '5,10', '--profile_dir=out', '-e', '3'], ['--profile_steps', '--profile_dir']) == ['--mode', 'train', '-e', '3']
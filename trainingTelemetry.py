@@ -0,0 +1,56 @@
+import numpy as np
+import tensorflow as tf
+import io, json, time, collections
+
+# Per-step training telemetry: time waiting for the batch, time in session.run, tokens, learning rate and gradient norm
+# the steps are aggregated every interval steps into a line of the JSONL log, and optionally into TF summaries for tensorboard
+
+class TrainingTelemetry:
+	def __init__(self, logFile, summaryDir=None, interval=100):
+		self.logFile = io.open(logFile, 'a', encoding='utf-8')
+		self.summaryWriter = tf.summary.FileWriter(summaryDir) if(summaryDir) else None
+		self.interval = max(interval, 1)
+		# each item is (data wait, run time, real tokens, padded tokens, loss, learning rate, gradient norm)
+		self.steps = []
+		# time spent outside the steps (evaluation, BLEU), written with the next aggregate
+		self.events = collections.OrderedDict()
+
+	def recordStep(self, globalStep, dataWait, runTime, realTokens, paddedTokens, loss, learningRate, gradientNorm):
+		self.steps.append((dataWait, runTime, realTokens, paddedTokens, loss, learningRate, gradientNorm))
+		if(len(self.steps) >= self.interval):
+			self.flush(globalStep)
+
+	def recordEvent(self, name, duration):
+		self.events[name] = self.events.get(name, 0.0) + duration
+
+	def flush(self, globalStep):
+		if(len(self.steps) == 0 and len(self.events) == 0):
+			return
+		record = {'time':time.time(), 'global_step':globalStep, 'steps':len(self.steps)}
+		if(len(self.steps) > 0):
+			dataWait, runTime, realTokens, paddedTokens, loss, learningRate, gradientNorm = np.array(self.steps, dtype=np.float64).T
+			stepTime = dataWait + runTime
+			record.update({
+				'data_wait':float(dataWait.sum()), 'run_time':float(runTime.sum()),
+				'run_time_p50':float(np.percentile(runTime, 50)), 'run_time_max':float(runTime.max()),
+				'data_wait_ratio':float(dataWait.sum() / max(stepTime.sum(), 1e-9)),
+				'tokens':int(realTokens.sum()), 'tokens_per_sec':float(realTokens.sum() / max(stepTime.sum(), 1e-9)),
+				'padding_ratio':float(1.0 - realTokens.sum() / max(paddedTokens.sum(), 1.0)),
+				'loss':float(np.mean(loss)), 'learning_rate':float(learningRate[-1]),
+				'gradient_norm':float(np.mean(gradientNorm)), 'gradient_norm_max':float(np.max(gradientNorm))
+			})
+		for name, duration in self.events.items():
+			record[name + '_time'] = duration
+		self.logFile.write(json.dumps(record) + '\n')
+		self.logFile.flush()
+		if(self.summaryWriter is not None):
+			values = [tf.Summary.Value(tag='telemetry/' + key, simple_value=float(value)) for key, value in record.items() if(key not in ['time', 'global_step'])]
+			self.summaryWriter.add_summary(tf.Summary(value=values), globalStep)
+			self.summaryWriter.flush()
+		self.steps, self.events = [], collections.OrderedDict()
+
+	def close(self, globalStep):
+		self.flush(globalStep)
+		self.logFile.close()
+		if(self.summaryWriter is not None):
+			self.summaryWriter.close()
@@ -0,0 +1,79 @@
+import os, io, hashlib, sqlite3, threading, collections
+
+# Cache of the translations keyed by the source id sentence, valid for a single checkpoint
+# the memory tier is a LRU of cacheSize entries, the disk tier a sqlite file which is cleared when opened with a different fingerprint
+
+def getFileFingerprint(fileDir, extra=''):
+	if(not os.path.isfile(fileDir)):
+		return None
+	hasher = hashlib.sha1()
+	with io.open(fileDir, 'rb') as hashFile:
+		for block in iter(lambda: hashFile.read(1 << 20), b''):
+			hasher.update(block)
+	# settings which change the decoding result without changing the weights
+	hasher.update(extra.encode('utf-8'))
+	return hasher.hexdigest()
+
+def getSourceKey(idSentence):
+	return ' '.join(map(str, idSentence))
+
+class TranslationCache:
+	def __init__(self, fingerprint, cacheFile=None, cacheSize=100000):
+		self.fingerprint = fingerprint
+		self.cacheSize = cacheSize
+		self.memory = collections.OrderedDict()
+		self.hits = self.misses = 0
+		# serve mode use the cache from the batching thread
+		self.lock = threading.Lock()
+		self.database = None
+		if(cacheFile):
+			self.database = sqlite3.connect(cacheFile, check_same_thread=False)
+			self.database.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+			self.database.execute("CREATE TABLE IF NOT EXISTS translations (source TEXT PRIMARY KEY, translation TEXT)")
+			row = self.database.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+			if(row is None or row[0] != fingerprint):
+				# checkpoint changed, the stored translations are invalid
+				self.database.execute("DELETE FROM translations")
+				self.database.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+			self.database.commit()
+
+	def remember(self, key, translation):
+		self.memory[key] = translation
+		self.memory.move_to_end(key)
+		if(len(self.memory) > self.cacheSize):
+			self.memory.popitem(last=False)
+
+	def lookup(self, idSentences):
+		# return the list of translations, None for those not in the cache
+		with self.lock:
+			result = []
+			for idSentence in idSentences:
+				key = getSourceKey(idSentence)
+				translation = self.memory.get(key)
+				if(translation is None and self.database is not None):
+					row = self.database.execute("SELECT translation FROM translations WHERE source = ?", (key,)).fetchone()
+					translation = row[0] if(row is not None) else None
+				if(translation is None):
+					self.misses += 1
+				else:
+					self.hits += 1
+					self.remember(key, translation)
+				result.append(translation)
+			return result
+
+	def store(self, idSentences, translations):
+		with self.lock:
+			items = [(getSourceKey(idSentence), translation) for idSentence, translation in zip(idSentences, translations)]
+			for key, translation in items:
+				self.remember(key, translation)
+			if(self.database is not None):
+				self.database.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?)", items)
+				self.database.commit()
+
+	def getHitRate(self):
+		return float(self.hits) / max(self.hits + self.misses, 1)
+
+	def close(self):
+		if(self.database is not None):
+			self.database.close()
+			self.database = None
@@ -1,97 +1,165 @@
 import ffBuilder as builder
+import exampleBuilder
+import corpusBuilder
+import translatorServer
+import translationCache
+import translatorReplicas
+import translatorWorkers
+import trainingTelemetry
 import numpy as np
 import tensorflow as tf
-import sys, os, pickle, argparse, io, time, random, json
+import sys, os, pickle, argparse, io, time, random, json, heapq, itertools, tempfile, subprocess
 from calculatebleu import *
 
+# the inference graph keep only these inputs and the greedy decoder output
+INFERENCE_INPUT_NAMES = ['input', 'input_length', 'batch_size', 'decoder_maximum_length', 'dropout', 'shortlist', 'decoder_length_limit']
+INFERENCE_OUTPUT_NAME = 'inference_output_ids'
+
 def getVocabFromVocabFile(fileDir):
 	file = io.open(fileDir, 'r', encoding='utf-8')
 	listVocab = [word.strip("\n ") for word in file.readlines()]
 	file.close()
 	return listVocab
 
-def getEmbeddingFromFile(fileDir, useDefault=True):
-	file = io.open(fileDir, 'rb')
-	dictTuple = pickle.load(file)
-	file.close()
-	if(isinstance(dictTuple, dict)):
-		return dictTuple
-	elif(isinstance(dictTuple, (tuple, list))):
-		return dictTuple[0 if useDefault else 1]
-	else:
-		raise Exception("Wrong type during pickle read file")
-		
 def getSentencesFromFile(fileDir, splitToken=' '):
+	return list(readSentencesFromFile(fileDir, splitToken))
+
+def readSentencesFromFile(fileDir, splitToken=' '):
+	# generator version of getSentencesFromFile, only keep the current line in memory
 	file = io.open(fileDir, 'r', encoding='utf-8')
-	lines = file.readlines()
-	file.close()
-	result = []
-	for line in lines:
-		if(line.find(splitToken) >= 0):
-			result.append(line.strip().split(splitToken))
-		else:
-			result.append([line.strip()])
-	return result
-	
-def createSentenceCouplingFromFile(args):
-	srcSentences = getSentencesFromFile(os.path.join(args.directory, args.src_file))
-	tgtSentences = getSentencesFromFile(os.path.join(args.directory, args.tgt_file))
-	assert len(srcSentences) == len(tgtSentences)
-	args.print_verbose('Sentences read from training files: %d' % len(srcSentences))
-	coupling = []
-	for i in range(len(srcSentences)):
+	try:
+		for line in file:
+			yield line.strip().split(splitToken)
+	finally:
+		file.close()
+
+def readSentenceCouplingFromFiles(args, srcFileDir, tgtFileDir, embeddingTuple=None, counter=None):
+	# read both files in lockstep, filter those which are too long and convert to ids on the fly if embeddingTuple is specified
+	if(embeddingTuple is not None):
+		srcWordToId, tgtWordToId = embeddingTuple[0][0], embeddingTuple[1][0]
+		srcUnknownID, tgtUnknownID = srcWordToId[args.unknown_word], tgtWordToId[args.unknown_word]
+	if(counter is None):
+		counter = {}
+	counter['read'], counter['accepted'] = 0, 0
+	for srcSentence, tgtSentence in itertools.zip_longest(readSentencesFromFile(srcFileDir), readSentencesFromFile(tgtFileDir)):
+		if(srcSentence is None or tgtSentence is None):
+			raise Exception("Mismatched number of lines between {} and {} after {} lines".format(srcFileDir, tgtFileDir, counter['read']))
+		counter['read'] += 1
 		# filter out those which are too long
-		if(len(srcSentences[i]) <= args.maximum_sentence_length and len(tgtSentences[i]) <= args.maximum_sentence_length):
-			coupling.append((srcSentences[i], tgtSentences[i]))
-	args.print_verbose('Sentences accepted from training files: %d' % len(coupling))
-	# Sort by number of words in output sentences
-	coupling = sorted(coupling, key=lambda couple: (len(couple[1]), len(couple[0])))
-	if(args.dev_file_name):
-		# Try to get testing values
-		srcDev = args.src + args.dev_file_name if(args.prefix) else args.dev_file_name + '.' + args.src
-		srcDev = getSentencesFromFile(os.path.join(args.directory, srcDev))
-		tgtDev = args.tgt + args.dev_file_name if(args.prefix) else args.dev_file_name + '.' + args.tgt
-		tgtDev = getSentencesFromFile(os.path.join(args.directory, tgtDev))
-		assert len(srcDev) == len(tgtDev)
-		args.print_verbose('Sentences read from dev files: %d' % len(srcDev))
-		otherCoupling = []
-		
-		for i in range(len(srcDev)):
-			if(len(srcDev[i]) <= args.maximum_sentence_length and len(tgtDev[i]) <= args.maximum_sentence_length):
-				otherCoupling.append((srcDev[i], tgtDev[i]))
-				
-		args.print_verbose('Sentences accepted from dev files: %d' % len(otherCoupling))
+		if(len(srcSentence) > args.maximum_sentence_length or len(tgtSentence) > args.maximum_sentence_length):
+			continue
+		counter['accepted'] += 1
+		if(embeddingTuple is not None):
+			srcSentence = [srcWordToId.get(word, srcUnknownID) for word in srcSentence]
+			tgtSentence = [tgtWordToId.get(word, tgtUnknownID) for word in tgtSentence]
+		yield srcSentence, tgtSentence
+
+def getCouplingLengthKey(couple):
+	# Sort by number of words in output sentences, then input sentences
+	return len(couple[1]), len(couple[0])
+
+def sortCouplingByLength(coupling, bufferSize, spillBlockSize=1024):
+	# External merge sort: chunks of bufferSize couples are sorted in memory and spilled to temporary files, then merged lazily
+	# the spilling is done immediately, only the merging is deferred to the returned generator
+	spillFiles, buffer = [], []
+	for couple in coupling:
+		buffer.append(couple)
+		if(len(buffer) >= bufferSize):
+			spillFiles.append(spillSortedCoupling(buffer, spillBlockSize))
+			buffer = []
+	if(len(spillFiles) == 0):
+		# everything fit in the buffer, no need to touch the disk
+		buffer.sort(key=getCouplingLengthKey)
+		return iter(buffer)
+	if(len(buffer) > 0):
+		spillFiles.append(spillSortedCoupling(buffer, spillBlockSize))
+	# heapq.merge is stable toward the order of the spill files, so the result is the same as sorted() on the whole set
+	return heapq.merge(*[readSpilledCoupling(file) for file in spillFiles], key=getCouplingLengthKey)
+
+def spillSortedCoupling(buffer, spillBlockSize):
+	buffer.sort(key=getCouplingLengthKey)
+	file = tempfile.TemporaryFile()
+	# pickle in blocks, one pickle per couple is too slow
+	for i in range(0, len(buffer), spillBlockSize):
+		pickle.dump(buffer[i:i+spillBlockSize], file, pickle.HIGHEST_PROTOCOL)
+	file.seek(0)
+	return file
+
+def readSpilledCoupling(file):
+	try:
+		while(True):
+			try:
+				block = pickle.load(file)
+			except EOFError:
+				break
+			for couple in block:
+				yield couple
+	finally:
+		# TemporaryFile is deleted upon closing
+		file.close()
+	
+def createSentenceCouplingFromFile(args, embeddingTuple=None):
+	# the training coupling is a generator sorted by length and never held in memory as a whole. If embeddingTuple is specified, the couples are converted to ids
+	counter = {}
+	srcFileDir, tgtFileDir = os.path.join(args.directory, args.src_file), os.path.join(args.directory, args.tgt_file)
+	if(embeddingTuple is not None and args.encode_workers > 1):
+		# convert to ids in worker processes, each encoding a shard of the files
+		srcWordToId, tgtWordToId = embeddingTuple[0][0], embeddingTuple[1][0]
+		encoderSetting = (srcWordToId, tgtWordToId, srcWordToId[args.unknown_word], tgtWordToId[args.unknown_word], args.maximum_sentence_length, ' ')
+		coupling = corpusBuilder.encodeCouplingInParallel(srcFileDir, tgtFileDir, encoderSetting, args.encode_workers, counter)
 	else:
-		otherCoupling = None
+		coupling = readSentenceCouplingFromFiles(args, srcFileDir, tgtFileDir, embeddingTuple, counter)
+	coupling = sortCouplingByLength(coupling, args.sort_buffer_size)
+	args.print_verbose('Sentences read from training files: %d' % counter['read'])
+	args.print_verbose('Sentences accepted from training files: %d' % counter['accepted'])
+	otherCoupling = createDevCouplingFromFile(args, embeddingTuple)
 	return coupling, otherCoupling
 
+def getCorpusSources(args, embeddingTuple):
+	# the training files (path, size, modified time) and the settings the compiled corpus depend on. Missing files have no size and time
+	files = []
+	for fileName in [args.src_file, args.tgt_file]:
+		filePath = os.path.abspath(os.path.join(args.directory, fileName))
+		stat = os.stat(filePath) if(os.path.isfile(filePath)) else None
+		files.append([filePath, stat.st_size if(stat) else None, stat.st_mtime if(stat) else None])
+	return {'files': files, 'vocabSize': [len(embeddingTuple[0][1]), len(embeddingTuple[1][1])],
+		'maximum_sentence_length': args.maximum_sentence_length, 'batch_size': args.batch_size, 'batch_tokens': args.batch_tokens, 'bucket_width': args.bucket_width}
+
+def compileTrainingCorpus(args, embeddingTuple, corpusDir):
+	# compile the training files into corpusDir, unless it already hold a corpus made from the same files and settings
+	sources = getCorpusSources(args, embeddingTuple)
+	if(corpusBuilder.isCorpusDirectory(corpusDir)):
+		compiledSources = corpusBuilder.readCorpusInfo(corpusDir).get('sources')
+		if(compiledSources == sources):
+			return
+		if(any(size is None for _, size, _ in sources['files'])):
+			# cannot rebuild without the training files, keep the compiled corpus as is
+			print("Warning: training files missing, using the compiled corpus %s as is" % corpusDir)
+			return
+		print("Compiled corpus %s was made from other training files or settings, rebuilding it" % corpusDir)
+	# The sorted sentences are batched and written as they come, never held as a whole
+	batchesCoupling, _ = createSentenceCouplingFromFile(args, embeddingTuple)
+	corpusInfo = corpusBuilder.saveBatchesToCorpus(iterateBatchesFromSentences(args, batchesCoupling, embeddingTuple, isIdData=True), corpusDir, tuple(sources['vocabSize']), sources)
+	args.print_verbose("Compiled corpus saved to %s: %d sentences, %d batches" % (corpusDir, corpusInfo['sentences'], corpusInfo['batches']))
+
+def createDevCouplingFromFile(args, embeddingTuple=None):
+	if(not args.dev_file_name):
+		return None
+	# Try to get testing values
+	counter = {}
+	srcDev = args.src + args.dev_file_name if(args.prefix) else args.dev_file_name + '.' + args.src
+	tgtDev = args.tgt + args.dev_file_name if(args.prefix) else args.dev_file_name + '.' + args.tgt
+	otherCoupling = list(readSentenceCouplingFromFiles(args, os.path.join(args.directory, srcDev), os.path.join(args.directory, tgtDev), embeddingTuple, counter))
+	args.print_verbose('Sentences read from dev files: %d' % counter['read'])
+	args.print_verbose('Sentences accepted from dev files: %d' % counter['accepted'])
+	return otherCoupling
+
 	
 def createEmbeddingCouplingFromFile(args):
-	srcDict = getEmbeddingFromFile(os.path.join(args.directory, args.src_dict_file), args.import_default_dict)
-	tgtDict = getEmbeddingFromFile(os.path.join(args.directory, args.tgt_dict_file), args.import_default_dict)
-	# TODO Print a warning here for normal dict, since it may change order each time it is used. Then again, we are using OrderedDict and python3 stated that it preserve the sequence of words. So low priority.
 	# Convert the src/tgt dict into normal (word to id), ref (id to word), embeddingVector (id to vector)
-	counter = 0
-	srcWordToId, srcIdToWord = {}, {}
-	srcEmbeddingVector = []
-	for key in srcDict:
-		assert len(srcEmbeddingVector) == counter
-		srcWordToId[key] = counter
-		srcIdToWord[counter] = key
-		srcEmbeddingVector.append(srcDict[key])
-		counter += 1
-	
-	counter = 0
-	tgtWordToId, tgtIdToWord = {}, {}
-	tgtEmbeddingVector = []
-	for key in tgtDict:
-		assert len(tgtEmbeddingVector) == counter
-		tgtWordToId[key] = counter
-		tgtIdToWord[counter] = key
-		tgtEmbeddingVector.append(tgtDict[key])
-		counter += 1
-	
-	return (srcWordToId, srcIdToWord, np.array(srcEmbeddingVector)), (tgtWordToId, tgtIdToWord, np.array(tgtEmbeddingVector))
+	srcEmbeddingTuple = exampleBuilder.getEmbeddingTupleFromFile(os.path.join(args.directory, args.src_dict_file), args.import_default_dict, args.compile_embedding)
+	tgtEmbeddingTuple = exampleBuilder.getEmbeddingTupleFromFile(os.path.join(args.directory, args.tgt_dict_file), args.import_default_dict, args.compile_embedding)
+	return srcEmbeddingTuple, tgtEmbeddingTuple
 
 def createCouplingFromVocabFile(args):
 	srcWord = getVocabFromVocabFile(os.path.join(args.directory, args.src_dict_file))
@@ -131,7 +199,17 @@ def createCouplingFromVocabFile(args):
 	
 	return (srcWordToId, srcIdToWord, None), (tgtWordToId, tgtIdToWord, None)
 	
-def createSession(args, embedding):
+def createSessionConfig(args):
+	config = tf.ConfigProto()
+	config.gpu_options.allow_growth = True
+	# 0 let TensorFlow choose the number of threads
+	if(args.intra_op_threads > 0):
+		config.intra_op_parallelism_threads = args.intra_op_threads
+	if(args.inter_op_threads > 0):
+		config.inter_op_parallelism_threads = args.inter_op_threads
+	return config
+
+def createSession(args, embedding, dataset=None):
 	srcEmbedding, tgtEmbedding = embedding
 	srcEmbeddingDict, _, srcEmbeddingVector = srcEmbedding
 	tgtEmbeddingDict, _, tgtEmbeddingVector = tgtEmbedding
@@ -155,9 +233,7 @@ def createSession(args, embedding):
 	srcEmbeddingVector = tf.Variable(srcEmbeddingVector, dtype=tf.float32, trainable=args.train_embedding, name='input_embedding')
 	tgtEmbeddingVector = tf.Variable(tgtEmbeddingVector, dtype=tf.float32, trainable=args.train_embedding, name='output_mbedding')
 	
-	config = tf.ConfigProto()
-	config.gpu_options.allow_growth = True
-	session = tf.Session(config=config)
+	session = tf.Session(config=createSessionConfig(args))
 	# set the initializer to the entire session according to args.vocab_init
 	minVal, maxVal = args.initialize_range
 	initializer = tf.random_normal_initializer(mean=(maxVal+minVal)/2, stddev=(maxVal-minVal)/2) if(args.vocab_init in ['gaussian', 'normal', 'xavier']) \
@@ -167,8 +243,22 @@ def createSession(args, embedding):
 	tf.get_variable_scope().set_initializer(initializer)
 	# dropout value, used for training. Must reset to 1.0(all) when infer
 	dropout = tf.placeholder_with_default(1.0, shape=(), name='dropout')
+	if(dataset is not None):
+		# dataset input pipeline: the placeholders default to the iterator values, so training need no feed_dict while evaluation/inference still feed them
+		iterator = dataset.make_initializable_iterator()
+		iteratorInput, iteratorOutput, iteratorDecoderInput, iteratorInputLength, iteratorOutputLength = iterator.get_next()
+		# token counts for reporting the padding ratio
+		realTokens = tf.reduce_sum(iteratorInputLength) + tf.reduce_sum(iteratorOutputLength)
+		paddedTokens = tf.size(iteratorInput) + tf.size(iteratorOutput)
+		args.dataset_pipeline = (iterator.initializer, realTokens, paddedTokens)
+		createInputTensor = lambda default, shape, name: tf.placeholder_with_default(default, shape=shape, name=name)
+		iteratorValues = {'input':iteratorInput, 'output':iteratorOutput, 'input_decoder':iteratorDecoderInput, 'input_length':iteratorInputLength, 'output_length':iteratorOutputLength,
+			'batch_size':tf.shape(iteratorInput)[0], 'decoder_maximum_length':tf.reduce_max(iteratorOutputLength)}
+	else:
+		createInputTensor = lambda default, shape, name: tf.placeholder(shape=shape, dtype=tf.int32, name=name)
+		iteratorValues = {}
 	# input in shape (batchSize, inputSize) - not using timemayor
-	input = tf.placeholder(shape=[None, None], dtype=tf.int32, name='input')
+	input = createInputTensor(iteratorValues.get('input'), [None, None], 'input')
 	# input are lookup from the known srcEmbeddingVector, shape (batchSize, inputSize, embeddingSize)
 	inputVector = tf.nn.embedding_lookup(srcEmbeddingVector, input, name='input_encoder_vectors')
 	# craft the encoder depend on the input vector. Currently using default values for all version
@@ -176,15 +266,17 @@ def createSession(args, embedding):
 	inputFromEncoder, encoderOutput, encoderState, dropoutFromEncoder = builder.createEncoder(settingDict)
 	assert inputFromEncoder is inputVector and dropoutFromEncoder is dropout
 	# craft the output in shape (batchSize, outputSize)
-	output = tf.placeholder(shape=[None, None], dtype=tf.int32, name='output')
-	decoderInput = tf.placeholder(shape=[None, None], dtype=tf.int32, name='input_decoder')
+	output = createInputTensor(iteratorValues.get('output'), [None, None], 'output')
+	decoderInput = createInputTensor(iteratorValues.get('input_decoder'), [None, None], 'input_decoder')
 	# the inputLengthList is the length of the encoding sentence, necessary for attention to accurately select within the correct input sentence
-	inputLengthList = tf.placeholder(shape=[None], dtype=tf.int32, name='input_length')
+	inputLengthList = createInputTensor(iteratorValues.get('input_length'), [None], 'input_length')
 	# the outputLengthList is the length of the sentence supposed to be output. Used to create somewhat more accurate loss function
-	outputLengthList = tf.placeholder(shape=[None], dtype=tf.int32, name='output_length')
+	outputLengthList = createInputTensor(iteratorValues.get('output_length'), [None], 'output_length')
 	# These are the dimension of the batch in decoder. Needed for retarded high-level decoder functions.
-	batchSize = tf.placeholder(shape=(), dtype=tf.int32, name='batch_size')
-	maximumUnrolling = tf.placeholder_with_default(args.maximum_sentence_length, shape=(), name='decoder_maximum_length')
+	batchSize = createInputTensor(iteratorValues.get('batch_size'), (), 'batch_size')
+	maximumUnrolling = tf.placeholder_with_default(iteratorValues.get('decoder_maximum_length', args.maximum_sentence_length), shape=(), name='decoder_maximum_length')
+	# per-sentence limit of the greedy decoder, fed from the source lengths during inference
+	args.decode_length_input = tf.placeholder_with_default(tf.fill([batchSize], maximumUnrolling), shape=[None], name='decoder_length_limit')
 	# likewise, the output will be looked up into shape (batchSize, inputSize, embeddingSize)
 	# outputVector = tf.nn.embedding_lookup(tgtEmbeddingVector, output)
 	# stop using decoderInputVector as a test
@@ -199,7 +291,7 @@ def createSession(args, embedding):
 	settingDict['startTokenId'] = startTokenId; settingDict['endTokenId'] = endTokenId
 	settingDict['correctResult'] = output; settingDict['outputEmbedding'] = tgtEmbeddingVector;
 	settingDict['correctResultLen'] = outputLengthList; settingDict['encoderState'] = encoderState; settingDict['decoderOutputSize'] = tgtNumWords
-	settingDict['batchSize'] = batchSize; settingDict['maximumDecoderLength'] = maximumUnrolling; # settingDict['decoderInput'] = decoderInputVector
+	settingDict['batchSize'] = batchSize; settingDict['maximumDecoderLength'] = maximumUnrolling; settingDict['decoderLengthLimit'] = args.decode_length_input; # settingDict['decoderInput'] = decoderInputVector
 	if(args.attention):
 		# Duplicate spotted
 		# inputLengthList = tf.placeholder(shape=[None], dtype=tf.int32, name='')
@@ -224,7 +316,21 @@ def createSession(args, embedding):
 			k = args.scheduled_sampling_rate
 			settingDict['samplingVariable'] = k / (k + tf.exp(stairStep / k))
 	
+	if(args.loss == 'sampled_softmax'):
+		# the training decoder output hidden states with sampled softmax, which the scheduled sampling would take as logits for its next ids
+		if('samplingVariable' in settingDict):
+			raise Exception("--loss sampled_softmax cannot be used with --scheduled_sampling_rate")
+		settingDict['sampledSoftmax'] = args.num_sampled
+	# outside of training, the greedy decoder can be restricted to a shortlist of target ids fed for each batch
+	if(args.shortlist_size > 0 and args.mode != 'train'):
+		args.shortlist_input = tf.placeholder(shape=[args.shortlist_size], dtype=tf.int32, name='shortlist')
+		settingDict['shortlist'] = args.shortlist_input
+	else:
+		args.shortlist_input = None
+	
 	logits, loss, outputIds, _ = builder.createDecoder(settingDict)
+	# name the greedy ids for the inference graph export
+	outputIds = (outputIds[0], tf.identity(outputIds[1], name=INFERENCE_OUTPUT_NAME))
 	# TrainingOp function, built on the loss function
 	settingDict['mode'] = args.optimizer
 	settingDict['trainingRate'] = args.learning_rate
@@ -250,8 +356,19 @@ def createSession(args, embedding):
 		# All ops will return (optimizer, incrementGlobalStep) tuple, the second one only available in sgd warmup/decay
 		settingDict['colocateGradient'] = args.colocate
 		settingDict['clipGradient'] = args.gradient_clipping
+		# with accumulate_steps, the training op only accumulate the gradients, and args.apply_gradient_op apply them
+		settingDict['accumulateSteps'] = args.accumulate_steps
 		trainingGradient = builder.configureGradientOptions(trainingTrainOp, settingDict)
-		trainingTrainOp = tf.group(trainingGradient, settingDict['incrementGlobalStep'])
+		args.apply_gradient_op = settingDict.get('applyGradient', None)
+		if(args.apply_gradient_op is None):
+			trainingTrainOp = tf.group(trainingGradient, settingDict['incrementGlobalStep'])
+		else:
+			# the global step count the applied updates rather than the micro-batches
+			trainingTrainOp = trainingGradient
+			args.apply_gradient_op = tf.group(args.apply_gradient_op, settingDict['incrementGlobalStep'])
+		args.gradient_norm = settingDict['gradientGlobalNorm']
+		# learning rate after warmup/decay, for the telemetry
+		args.learning_rate_op = tf.convert_to_tensor(settingDict['currentTrainingRate'], dtype=tf.float32)
 	else:
 		# optimizerName = 'SGD' if args.optimizer.lower()=='sgd' else 'Adam' if args.optimizer.lower()=='adam' else None
 		if(args.decay_threshold >= 0):
@@ -265,8 +382,11 @@ def createSession(args, embedding):
 		
 		trainingTrainOp = tf.contrib.layers.optimize_loss(loss, tf.train.get_global_step(), args.learning_rate, args.optimizer,
 				clip_gradients=args.gradient_clipping, learning_rate_decay_fn=decayFunction, colocate_gradients_with_ops=args.colocate, name='optimizer')
+	# numeric health of the variables, fetched every debug_steps and when the loss goes nan
+	args.health_names, args.health_ops = builder.createHealthOperations()
 	# initiate the session
 	session.run(tf.global_variables_initializer())
+	session.run(tf.local_variables_initializer())
 	
 	if(args.verbose):
 		for key in settingDict:
@@ -278,42 +398,328 @@ def createSession(args, embedding):
 	
 	return session, inputOutputTuple, configTuple, trainTuple
 	
+def startCheckpointing(args, session):
+	# start the periodic checkpoint writer, and restore the newest unfinished checkpoint. Return the (epoch, batch cursor) to continue from
+	if(args.shuffle_seed is None):
+		args.shuffle_seed = np.random.randint(1 << 30)
+	args.checkpoint_writer, args.last_checkpoint_time = None, time.time()
+	if(args.save_path is None):
+		return (0, 0)
+	checkpointDir = os.path.join(args.directory, args.save_path + ".checkpoints")
+	checkpoint = builder.loadLatestCheckpoint(checkpointDir)
+	startTuple = (0, 0)
+	if(checkpoint is not None and not checkpoint[1]['complete']):
+		values, info = checkpoint
+		missing = builder.restoreVariables(session, values)
+		if(len(missing) > 0):
+			print("Warning: variables not in checkpoint %s: %s" % (info['file'], missing))
+		args.global_steps, args.shuffle_seed = info['global_steps'], info['shuffle_seed']
+		startTuple = (info['epoch'], info['cursor'])
+		print("Resumed from checkpoint %s: global step %d, epoch %d, batch %d" % (info['file'], info['global_steps'], info['epoch'] + 1, info['cursor']))
+	if(args.checkpoint_steps > 0 or args.checkpoint_secs > 0):
+		args.checkpoint_writer = builder.AsyncCheckpointWriter(checkpointDir, args.keep_checkpoints)
+	return startTuple
+
+def saveTrainingCheckpoint(args, session, epoch, cursor, complete=False, force=False):
+	# snapshot the variables between steps and leave the writing to the background writer
+	if(args.checkpoint_writer is None):
+		return
+	# args.global_steps count the micro-batches, checkpoint_steps the updates
+	isDue = (args.checkpoint_steps > 0 and args.global_steps % (args.checkpoint_steps * args.accumulate_steps) == 0) or (args.checkpoint_secs > 0 and time.time() - args.last_checkpoint_time >= args.checkpoint_secs)
+	# the gradient accumulators are not saved, so the checkpoints are only taken once the accumulated gradients are applied
+	isApplied = args.global_steps % args.accumulate_steps == 0
+	if(not force and not (isDue and isApplied)):
+		return
+	info = {'global_steps':args.global_steps, 'epoch':epoch, 'cursor':cursor, 'shuffle_seed':args.shuffle_seed, 'complete':complete}
+	args.checkpoint_writer.save(builder.snapshotVariables(session), info)
+	args.last_checkpoint_time = time.time()
+
+def stopCheckpointing(args, session):
+	# the run is finished, the last checkpoint is marked complete so a new run do not resume from it
+	if(args.checkpoint_writer is not None):
+		saveTrainingCheckpoint(args, session, args.epoch, 0, complete=True, force=True)
+		args.checkpoint_writer.close()
+		args.checkpoint_writer = None
+
+def getBatchOrder(args, numBatches, epoch):
+	# seeded by epoch, so a resumed run see the same order
+	if(args.shuffle_batches):
+		order = np.random.RandomState((args.shuffle_seed + epoch) % (1 << 32)).permutation(numBatches)
+	else:
+		order = np.arange(numBatches)
+	if(getattr(args, 'worker_shard', None) is not None):
+		# data-parallel worker: every worker take the same number of batches, so they reach the synchronizations together
+		workerIdx, numWorkers = args.worker_shard
+		order = order[workerIdx::numWorkers][:numBatches // numWorkers]
+	return order
+
+def applyAccumulatedGradients(args, session, loss, force=False):
+	# apply the accumulated gradients every accumulate_steps micro-batches. force apply the leftover micro-batches at the end of training
+	if(getattr(args, 'apply_gradient_op', None) is None):
+		return
+	if((args.global_steps % args.accumulate_steps == 0) != force):
+		session.run(args.apply_gradient_op, feed_dict={args.dynamic_clipping:loss} if(args.dynamic_clipping is not False) else None)
+
+def runSession(args, session, fetches, feed_dict, tag, step=None):
+	# session.run, traced by the profiler when step (default counted per tag) is one of --profile_steps
+	if(getattr(args, 'profiler', None) is None):
+		return session.run(fetches, feed_dict=feed_dict)
+	return args.profiler.run(session, fetches, feed_dict, tag, step)
+
+def runTrainingStep(args, session, fetches, feed_dict, step, checkHealth=False):
+	# run fetches with the health values when checkHealth, and the telemetry values when it is enabled. Return (fetched values, health values, telemetry values)
+	extraFetches = [(args.health_ops, args.gradient_norm) if(checkHealth) else [], [args.learning_rate_op, args.gradient_norm] if(getattr(args, 'telemetry', None) is not None) else []]
+	values = runSession(args, session, list(fetches) + [extraFetches], feed_dict, 'train', step)
+	healthValues, telemetryValues = values.pop()
+	return values, healthValues or None, telemetryValues or None
+
+def runEvaluation(args, evaluationFunction, extraArgs):
+	# the evaluation and BLEU time is recorded in the telemetry, as training is stopped meanwhile
+	timer = time.time()
+	evaluationFunction(extraArgs)
+	if(getattr(args, 'telemetry', None) is not None):
+		args.telemetry.recordEvent('evaluation', time.time() - timer)
+
 def trainSession(args, sessionTuple, batches, evaluationFunction=None):
+	if(args.input_pipeline == 'dataset'):
+		# batches are read by the tf.data iterator within the graph instead
+		return trainSessionOnDataset(args, sessionTuple, len(batches), evaluationFunction)
 	session, inputOutputTuple, configTuple, trainTuple = sessionTuple
 	input, output, decoderInput = inputOutputTuple
 	inputLengthList, outputLengthList, batchSize, maximumUnrolling, dropout, _ = configTuple
 	avgLosses = [0]
 	loss = 1.0
-	for step in range(args.epoch):
+	# batches are prepared by background threads, prefetch_depth batches ahead of the running step
+	prefetcher = corpusBuilder.BatchPrefetcher(lambda idx: corpusBuilder.prepareTrainingBatch(batches[idx]), args.prefetch_depth, args.prefetch_workers)
+	startEpoch, startCursor = startCheckpointing(args, session)
+	for step in range(startEpoch, args.epoch):
+		realTokens, paddedTokens = 0, 0
+		stallTime, epochTimer = prefetcher.stallTime, time.time()
+		# a resumed epoch skip the batches done before the checkpoint
+		cursor = startCursor if(step == startEpoch) else 0
+		batchOrder = getBatchOrder(args, len(batches), step)
 		#if(not args.train_greedy):
 		#	args.print_verbose(("Use TrainingHelper in iteration %d" if(useTrainingHelper) else "Use GreedyEmbeddingHelper in iteration %d") % step)
-		for batch in batches:
+		waitTimer = time.time()
+		for batch, maximumOutputLength in prefetcher.iterate(batchOrder[cursor:]):
 			args.global_steps += 1
+			runTimer = time.time()
 			trainInput, trainCorrectOutput, trainInputLengthList, trainOutputLengthList, trainDecoderInput = batch
 			feed_dict = {input:trainInput, output:trainCorrectOutput, decoderInput:trainDecoderInput, inputLengthList:trainInputLengthList, outputLengthList:trainOutputLengthList, \
-				batchSize:len(trainInput), maximumUnrolling:max(trainOutputLengthList), dropout:args.dropout}
+				batchSize:len(trainInput), maximumUnrolling:maximumOutputLength, dropout:args.dropout}
 			if(args.dynamic_clipping is not False):
 				feed_dict[args.dynamic_clipping] = loss
-			loss, _ = session.run(trainTuple, feed_dict=feed_dict)
+			checkHealth = args.debug and args.global_steps % (args.debug_steps * args.accumulate_steps) == 0
+			(loss, _), healthValues, telemetryValues = runTrainingStep(args, session, trainTuple, feed_dict, args.global_steps, checkHealth)
+			runTime = time.time() - runTimer
 			if(np.isnan(loss)):
-				print("Loss nan @ global_steps {}, feed_dict {}".format(args.global_steps, feed_dict))
-				findNanSession(args, session)
+				print("Loss nan @ global_steps %d, batch id %d (position %d of epoch %d)" % (args.global_steps, batchOrder[cursor], cursor, step+1))
+				reportSessionHealth(args, session.run(args.health_ops))
 				sys.exit(0)
+			applyAccumulatedGradients(args, session, loss)
+			synchronizeWorkers(args, session)
 			#else:
 			#	args.print_verbose("Loss %.4f @ global_steps %d" % (loss, args.global_steps))
 			avgLosses[-1] += loss
+			batchRealTokens, batchPaddedTokens = getBatchPaddingCount(batch)
+			realTokens += batchRealTokens; paddedTokens += batchPaddedTokens
+			if(telemetryValues is not None):
+				args.telemetry.recordStep(args.global_steps, runTimer - waitTimer, runTime, batchRealTokens, batchPaddedTokens, loss, *telemetryValues)
 			if(args.verbose):
 				if(args.global_steps % 100 == 0):
 					args.print_verbose("Global step %d, last loss on batch %2.4f, time passed %.2f" % (args.global_steps, loss, args.time_passed()))
-			if((args.global_steps+1) % args.debug_steps == 0 and args.debug):
-				debugSession(args, session)
-		avgLosses[-1] = avgLosses[-1] / len(batches)
+			if(checkHealth):
+				reportSessionHealth(args, *healthValues, printFunc=args.print_verbose)
+			cursor += 1
+			saveTrainingCheckpoint(args, session, step, cursor)
+			waitTimer = time.time()
+		avgLosses[-1] = avgLosses[-1] / max(len(batchOrder), 1)
+		args.trained_tokens = getattr(args, 'trained_tokens', 0) + realTokens
+		args.print_verbose("Epoch %d, padding ratio %.2f%% (%d real tokens in %d padded tokens)" % (step+1, 100.0 * (1.0 - float(realTokens) / max(paddedTokens, 1)), realTokens, paddedTokens))
+		stallTime, epochTimer = prefetcher.stallTime - stallTime, time.time() - epochTimer
+		args.print_verbose("Epoch %d, waited %.2fs for input batches (%.2f%% of %.2fs)" % (step+1, stallTime, 100.0 * stallTime / max(epochTimer, 1e-6), epochTimer))
 		if(evaluationFunction and (step+1) % args.evaluation_step == 0):
 			# run evaluationFunction every evaluation_step epoch
-			evaluationFunction((step+1,avgLosses))
+			runEvaluation(args, evaluationFunction, (step+1,avgLosses))
 		avgLosses.append(0)
+	prefetcher.close()
+	applyAccumulatedGradients(args, session, loss, force=True)
+	synchronizeWorkers(args, session, force=True)
+	stopCheckpointing(args, session)
 	return avgLosses
 	
+def getAveragedVariables():
+	# the variables kept identical between the data-parallel workers: weights and optimizer slots
+	return [variable for variable in tf.global_variables() if variable.dtype.base_dtype == tf.float32]
+
+def synchronizeWorkers(args, session, force=False):
+	# in a data-parallel worker, average the variables with the other workers every sync_steps steps. force average if the last step did not
+	averager = getattr(args, 'parameter_averager', None)
+	if(averager is None):
+		return
+	if((args.global_steps % args.sync_steps == 0) != force):
+		variables = args.averaged_variables
+		flatValues = averager.average(translatorWorkers.flattenValues(session.run(variables)))
+		for variable, value in zip(variables, translatorWorkers.unflattenValues(flatValues, [variable.shape.as_list() for variable in variables])):
+			variable.load(value, session)
+
+def measureTrainingThroughput(args, sessionTuple, batches, numSteps):
+	# real tokens per second of this session on the first numSteps batches. The variables are restored afterward
+	session, inputOutputTuple, configTuple, trainTuple = sessionTuple
+	input, output, decoderInput = inputOutputTuple
+	inputLengthList, outputLengthList, batchSize, maximumUnrolling, dropout, _ = configTuple
+	if(numSteps <= 0 or len(batches) < 2):
+		return None
+	values = builder.snapshotVariables(session)
+	preparedBatches = [corpusBuilder.prepareTrainingBatch(batches[idx]) for idx in range(min(numSteps + 1, len(batches)))]
+	tokens, loss = 0, 1.0
+	# the first batch is a warm up, not timed
+	for idx, (batch, maximumOutputLength) in enumerate(preparedBatches):
+		if(idx == 1):
+			timer = time.time()
+		trainInput, trainCorrectOutput, trainInputLengthList, trainOutputLengthList, trainDecoderInput = batch
+		feed_dict = {input:trainInput, output:trainCorrectOutput, decoderInput:trainDecoderInput, inputLengthList:trainInputLengthList, outputLengthList:trainOutputLengthList, \
+			batchSize:len(trainInput), maximumUnrolling:maximumOutputLength, dropout:args.dropout}
+		if(args.dynamic_clipping is not False):
+			feed_dict[args.dynamic_clipping] = loss
+		loss, _ = session.run(trainTuple, feed_dict=feed_dict)
+		if(idx > 0):
+			tokens += getBatchPaddingCount(batch)[0]
+	elapsed = time.time() - timer
+	builder.restoreVariables(session, values)
+	# clear the accumulated gradients as well
+	session.run(tf.local_variables_initializer())
+	return tokens / max(elapsed, 1e-6)
+
+def trainParallelWorker(workerIdx, averager, resultQueue, args, embeddingTuple, batchSource, paddingTuple, initialValues):
+	# run in the spawned worker process: build the session, start from the weights of the main process and train on the shard of workerIdx
+	verbose = args.verbose and workerIdx == 0
+	args.print_verbose = lambda *argv, **kwargs: print(*argv, **kwargs) if(verbose) else None
+	timer = time.time()
+	args.time_passed = lambda: time.time() - timer
+	if(args.intra_op_threads == 0 and hasattr(os, 'sched_getaffinity')):
+		# one thread per core pinned to this worker
+		args.intra_op_threads = len(os.sched_getaffinity(0))
+	tf.reset_default_graph()
+	sessionTuple = createSession(args, embeddingTuple)
+	session = sessionTuple[0]
+	builder.restoreVariables(session, initialValues)
+	batches = corpusBuilder.CorpusBatches(batchSource, paddingTuple) if(isinstance(batchSource, str)) else batchSource
+	args.worker_shard = (workerIdx, averager.numWorkers)
+	args.parameter_averager = averager
+	args.averaged_variables = getAveragedVariables()
+	args.trained_tokens = 0
+	# only the first worker record the telemetry, its steps being in lockstep with the others
+	args.telemetry = trainingTelemetry.TrainingTelemetry(args.telemetry_file, args.telemetry_summary_dir, args.telemetry_interval) if(workerIdx == 0 and args.telemetry_file) else None
+	def evaluationFunction(extraArgs):
+		# the weights are averaged first, then the first worker send them to be evaluated in the main process
+		synchronizeWorkers(args, session, force=True)
+		if(workerIdx == 0):
+			resultQueue.put(('evaluate', workerIdx, (extraArgs, builder.snapshotVariables(session))))
+		return True
+	timer = time.time()
+	losses = trainSession(args, sessionTuple, batches, evaluationFunction)
+	if(args.telemetry is not None):
+		args.telemetry.close(args.global_steps)
+	result = {'losses':losses, 'global_steps':args.global_steps, 'tokens':args.trained_tokens, 'train_time':time.time() - timer}
+	if(workerIdx == 0):
+		result['values'] = builder.snapshotVariables(session)
+	session.close()
+	return result
+
+def trainParallelSession(args, workerArgs, sessionTuple, embeddingTuple, batches, batchSource, paddingTuple, evaluationFunction=None):
+	# synchronous data-parallel training in args.workers processes. workerArgs are the settings before createSession, batchSource the corpus directory or the list of batches
+	session = sessionTuple[0]
+	if(args.input_pipeline == 'dataset'):
+		raise Exception("--workers need the feed input pipeline")
+	if(args.shuffle_seed is None):
+		args.shuffle_seed = np.random.randint(1 << 30)
+	# all workers must shuffle the same way to take disjoint shards. The periodic checkpoints are not supported with workers
+	workerArgs.shuffle_seed, workerArgs.save_path, workerArgs.global_steps = args.shuffle_seed, None, args.global_steps
+	baseline = measureTrainingThroughput(args, sessionTuple, batches, args.scaling_baseline_steps)
+	averagedSize = sum(int(np.prod(variable.shape.as_list())) for variable in getAveragedVariables())
+	group = translatorWorkers.WorkerGroup(trainParallelWorker, (workerArgs, embeddingTuple, batchSource, paddingTuple, builder.snapshotVariables(session)), args.workers, averagedSize)
+	print("Started %d training workers, averaging %d values every %d steps, time passed %.2fs" % (args.workers, averagedSize, args.sync_steps, args.time_passed()))
+	def onMessage(workerIdx, kind, data):
+		if(kind == 'evaluate' and evaluationFunction):
+			extraArgs, values = data
+			builder.restoreVariables(session, values)
+			evaluationFunction(extraArgs)
+	results = group.join(onMessage)
+	# the workers end with the same weights, take them from the first
+	builder.restoreVariables(session, results[0]['values'])
+	args.global_steps = results[0]['global_steps']
+	tokensPerSec = sum(result['tokens'] for result in results) / max(max(result['train_time'] for result in results), 1e-6)
+	if(baseline is None):
+		print("Data-parallel training on %d workers: %.1f tokens/s" % (args.workers, tokensPerSec))
+	else:
+		print("Data-parallel training on %d workers: %.1f tokens/s, single process %.1f tokens/s, speedup %.2fx, scaling efficiency %.1f%%" % (args.workers, tokensPerSec, baseline, tokensPerSec / baseline, 100.0 * tokensPerSec / (baseline * args.workers)))
+	return np.mean([result['losses'] for result in results], axis=0).tolist()
+
+def getDatasetFeed(args, epoch):
+	feed_dict = dict(args.dataset_feed)
+	if(args.dataset_shuffle_seed is not None):
+		feed_dict[args.dataset_shuffle_seed] = (args.shuffle_seed + epoch) % (1 << 31)
+	return feed_dict
+
+def trainSessionOnDataset(args, sessionTuple, numBatches, evaluationFunction=None):
+	session, _, configTuple, trainTuple = sessionTuple
+	_, _, _, _, dropout, _ = configTuple
+	iteratorInitializer, realTokensTensor, paddedTokensTensor = args.dataset_pipeline
+	avgLosses = [0]
+	loss = 1.0
+	startEpoch, startCursor = startCheckpointing(args, session)
+	for step in range(startEpoch, args.epoch):
+		realTokens, paddedTokens, stepInEpoch = 0, 0, 0
+		# the shuffle of the dataset is seeded by epoch as getBatchOrder, so a resumed epoch skip the same batches
+		session.run(iteratorInitializer, feed_dict=getDatasetFeed(args, step))
+		if(step == startEpoch):
+			# a resumed epoch skip the batches done before the checkpoint by pulling them from the iterator
+			for _ in range(startCursor):
+				session.run(realTokensTensor)
+			stepInEpoch = startCursor
+		while(True):
+			feed_dict = {dropout:args.dropout}
+			if(args.dynamic_clipping is not False):
+				feed_dict[args.dynamic_clipping] = loss
+			checkHealth = args.debug and (args.global_steps + 1) % (args.debug_steps * args.accumulate_steps) == 0
+			runTimer = time.time()
+			try:
+				(loss, _, batchRealTokens, batchPaddedTokens), healthValues, telemetryValues = runTrainingStep(args, session, trainTuple + [realTokensTensor, paddedTokensTensor], feed_dict, args.global_steps + 1, checkHealth)
+			except tf.errors.OutOfRangeError:
+				# iterator exhausted, end of epoch
+				break
+			runTime = time.time() - runTimer
+			args.global_steps += 1
+			stepInEpoch += 1
+			if(np.isnan(loss)):
+				# the dataset batches have no index in the corpus, their position in the epoch is reported instead
+				print("Loss nan @ global_steps %d, batch at position %d of epoch %d" % (args.global_steps, stepInEpoch - 1, step+1))
+				reportSessionHealth(args, session.run(args.health_ops))
+				sys.exit(0)
+			applyAccumulatedGradients(args, session, loss)
+			avgLosses[-1] += loss
+			realTokens += batchRealTokens; paddedTokens += batchPaddedTokens
+			if(telemetryValues is not None):
+				# the batches are read within the session.run, so the data wait is part of the run time
+				args.telemetry.recordStep(args.global_steps, 0.0, runTime, batchRealTokens, batchPaddedTokens, loss, *telemetryValues)
+			if(args.verbose):
+				if(args.global_steps % 100 == 0):
+					args.print_verbose("Global step %d, last loss on batch %2.4f, time passed %.2f" % (args.global_steps, loss, args.time_passed()))
+			if(checkHealth):
+				reportSessionHealth(args, *healthValues, printFunc=args.print_verbose)
+			saveTrainingCheckpoint(args, session, step, stepInEpoch)
+		# batches made by bucket_by_sequence_length may differ in number from numBatches
+		avgLosses[-1] = avgLosses[-1] / max(stepInEpoch, 1)
+		args.print_verbose("Epoch %d, %d batches from dataset, padding ratio %.2f%% (%d real tokens in %d padded tokens)" % (step+1, stepInEpoch, 100.0 * (1.0 - float(realTokens) / max(paddedTokens, 1)), realTokens, paddedTokens))
+		if(evaluationFunction and (step+1) % args.evaluation_step == 0):
+			# run evaluationFunction every evaluation_step epoch
+			runEvaluation(args, evaluationFunction, (step+1,avgLosses))
+		avgLosses.append(0)
+	applyAccumulatedGradients(args, session, loss, force=True)
+	stopCheckpointing(args, session)
+	return avgLosses
+
 def evaluateSession(args, sessionTuple, dictTuple, sampleBatch):
 	session, inputOutputTuple, configTuple, _ = sessionTuple
 	input, output, decoderInput = inputOutputTuple
@@ -322,112 +728,390 @@ def evaluateSession(args, sessionTuple, dictTuple, sampleBatch):
 	sampleInput, sampleCorrectOutput, sampleInputLengthList, sampleOutputLengthList, sampleDecoderInput = sampleBatch
 	# feed_dict = {input:sampleInput, outputLengthList:sampleOutputLengthList, batchSize:sampleBatch[2], maximumUnrolling:max(sampleBatch[3]), decoderInput:sampleDecoderInput, dropout:1.0}
 	feed_dict = { input:sampleInput, output:sampleCorrectOutput, inputLengthList:sampleInputLengthList, outputLengthList:sampleOutputLengthList, \
-				batchSize:len(sampleInput), maximumUnrolling:max(sampleOutputLengthList), dropout:1.0 }
+				batchSize:len(sampleInput), maximumUnrolling:np.max(sampleOutputLengthList), dropout:1.0 }
 	# print(feed_dict.keys())
 	sampleResult = session.run(outputIds, feed_dict=feed_dict)
 	return sampleResult
 
-def inferenceSession(args, session, data):
+def inferenceSession(args, sessionTuple, data):
+	# Use default values for maximumUnrolling. Defaulted, but just do it to be sure. outputLengthList and decoderInput should not be neccessary as we are calling only GreedyEmbeddingHelper
+	return list(decodeBatches(args, sessionTuple, data))
+
+def decodeBatches(args, sessionTuple, data):
+	# yield the decoded (infInput, infInputLength) batches in order, spread over the session replicas if any
+	if(args.replica_pool is not None):
+		return args.replica_pool.map(data)
+	return (decodeBatch(args, sessionTuple, infInput, infInputLength) for infInput, infInputLength in data)
+
+def decodeBatch(args, sessionTuple, infInput, infInputLength):
 	session, inputOutputTuple, configTuple, _ = sessionTuple
 	input, _, _ = inputOutputTuple
 	inputLengthList, _, batchSize, maximumUnrolling, dropout, outputIds = configTuple
-	inferrenceGreedyOutput, _ = outputIds
-	# Use default values for maximumUnrolling. Defaulted, but just do it to be sure. outputLengthList and decoderInput should not be neccessary as we are calling only GreedyEmbeddingHelper
-	output = []
-	for infInput, infInputLength in data:
-		feed_dict = {input:infInput, inputLengthList:infInputLength, batchSize:len(infInput), maximumUnrolling:args.maximum_sentence_length, dropout:1.0}
-		decodeOutput = session.run(inferrenceGreedyOutput, feed_dict=feed_dict)
-		output.append(decodeOutput)
+	# outputIds are (TrainingHelper ids, GreedyEmbeddingHelper ids)
+	_, inferenceGreedyOutput = outputIds
+	maximumLength = args.maximum_sentence_length
+	if(args.decode_length_setting is not None):
+		# decode each sentence up to ratio * source length + margin, and the batch up to the longest of them
+		ratio, margin, tgtEndTokenId = args.decode_length_setting
+		lengthLimit = corpusBuilder.getDecodeLengthLimit(infInputLength, ratio, margin, args.maximum_sentence_length)
+		maximumLength = int(np.max(lengthLimit))
+	feed_dict = {input:infInput, inputLengthList:infInputLength, batchSize:len(infInput), maximumUnrolling:maximumLength, dropout:1.0}
+	if(args.decode_length_setting is not None):
+		feed_dict[args.decode_length_input] = lengthLimit
+	if(args.shortlist_input is not None):
+		candidates, frequentIds, specialIds = args.shortlist_table
+		feed_dict[args.shortlist_input] = corpusBuilder.createBatchShortlist(candidates, frequentIds, infInput, args.shortlist_size, specialIds)
+	# the inference graph drop the inputs the greedy decoder do not use (input_length without attention)
+	feed_dict = {key:value for key, value in feed_dict.items() if key is not None}
+	output = runSession(args, session, inferenceGreedyOutput, feed_dict, 'infer')
+	if(args.decode_length_setting is not None):
+		# a sentence finished by its limit keep producing ids until the batch end, replace them by the end token
+		output[np.arange(output.shape[1])[None, :] >= lengthLimit[:, None]] = tgtEndTokenId
 	return output
+
+def getDecodeLengthRatio(args, corpusDir, paddingTuple):
+	# ratio of target/source length from the training corpus, saved in save_path.length_ratio.json
+	ratioPath = os.path.join(args.directory, args.save_path + ".length_ratio.json")
+	if(os.path.isfile(ratioPath)):
+		with io.open(ratioPath, 'r', encoding='utf-8') as ratioFile:
+			ratioInfo = json.load(ratioFile)
+		if(ratioInfo['margin'] == args.decode_length_margin and ratioInfo['coverage'] == args.decode_length_coverage):
+			return ratioInfo['ratio']
+	if(corpusBuilder.isCorpusDirectory(corpusDir)):
+		corpus = corpusBuilder.CorpusBatches(corpusDir, paddingTuple)
+		srcLengths, tgtLengths = np.asarray(corpus.srcLengths), np.asarray(corpus.tgtLengths)
+	elif(os.path.isfile(os.path.join(args.directory, args.src_file)) and os.path.isfile(os.path.join(args.directory, args.tgt_file))):
+		lengths = np.array([(len(srcSentence), len(tgtSentence)) for srcSentence, tgtSentence in readSentenceCouplingFromFiles(args, os.path.join(args.directory, args.src_file), os.path.join(args.directory, args.tgt_file))], dtype=np.int32).reshape([-1, 2])
+		srcLengths, tgtLengths = lengths[:, 0], lengths[:, 1]
+	else:
+		return None
+	# +1 for the end token
+	ratio = corpusBuilder.estimateLengthRatio(srcLengths, tgtLengths + 1, args.decode_length_margin, args.decode_length_coverage)
+	with io.open(ratioPath, 'w', encoding='utf-8') as ratioFile:
+		ratioFile.write(json.dumps({'ratio':ratio, 'margin':args.decode_length_margin, 'coverage':args.decode_length_coverage}))
+	return ratio
+
+def exportInferenceGraph(args, sessionTuple, embeddingTuple, graphPath, quantize=False):
+	# freeze the embedding lookups, encoder and greedy decoder into graphPath, with the signature in graphPath.json
+	# if quantize, the embeddings and kernels are stored as int8 with per-channel scales. Storage only, they are float32 again once loaded
+	session = sessionTuple[0]
+	graphDef = builder.freezeGraph(session, [INFERENCE_OUTPUT_NAME])
+	nodeNames = set(node.name for node in graphDef.node)
+	signature = {
+		'inputs': {name:name + ':0' for name in INFERENCE_INPUT_NAMES if name in nodeNames},
+		'outputs': {'output_ids':INFERENCE_OUTPUT_NAME + ':0'},
+		'src_vocab_size': len(embeddingTuple[0][1]), 'tgt_vocab_size': len(embeddingTuple[1][1]),
+		'start_token': args.start_token, 'end_token': args.end_token, 'shortlist_size': args.shortlist_size if('shortlist' in nodeNames) else 0
+	}
+	if(quantize):
+		graphDef, (quantizedNames, originalBytes, quantizedBytes) = builder.quantizeGraphDef(graphDef)
+		signature['quantized'] = quantizedNames
+		args.print_verbose("Quantized %d weights to int8: %.2fMB -> %.2fMB" % (len(quantizedNames), originalBytes / 1048576.0, quantizedBytes / 1048576.0))
+	builder.writeGraphDef(graphDef, graphPath)
+	with io.open(graphPath + '.json', 'w', encoding='utf-8') as signatureFile:
+		signatureFile.write(json.dumps(signature, indent=2))
+	return len(graphDef.node)
+
+def calculateBleuOnBatches(args, sessionTuple, batches):
+	# greedy decode the batches and compare with their target sentences
+	inferOutput = inferenceSession(args, sessionTuple, ((batch[0], batch[2]) for batch in batches))
+	inferOutput = [sentence for batchOutput in inferOutput for sentence in batchOutput]
+	correctOutput = [sentence for batch in batches for sentence in batch[1]]
+	trimLength = np.concatenate([batch[3] for batch in batches])
+	return calculateBleu(correctOutput, inferOutput, trimLength)
+
+def evaluateCheckpoints(args, sessionTuple, devBatches, checkpointDir, metricsPath, startTime=None, parentPid=None):
+	# watch checkpointDir, decode devBatches with each new checkpoint and append its BLEU to metricsPath. Stop after the checkpoint marked complete
+	# checkpoints written before startTime (from a previous run) are ignored. The names are reused between runs and by the final checkpoint, so a checkpoint is known by (file, mtime)
+	# with parentPid, stop once the trainer that started the evaluator is gone (this process is reparented when it exits)
+	evaluated = set()
+	if(os.path.isfile(metricsPath)):
+		with io.open(metricsPath, 'r', encoding='utf-8') as metricsFile:
+			records = [json.loads(line) for line in metricsFile if line.strip()]
+		evaluated = {(record['file'], record['mtime']) for record in records if('mtime' in record and (startTime is None or record['time'] >= startTime))}
+	numSentences = sum(len(batch[0]) for batch in devBatches)
+	while(True):
+		if(parentPid is not None and os.getppid() != parentPid):
+			print("Training process %d is gone, stopping the evaluation" % parentPid)
+			return
+		checkpoints = []
+		for info in builder.readCheckpointList(checkpointDir):
+			checkpointPath = os.path.join(checkpointDir, info['file'])
+			if(not os.path.isfile(checkpointPath)):
+				continue
+			mtime = os.path.getmtime(checkpointPath)
+			if(startTime is None or mtime >= startTime):
+				checkpoints.append((info, mtime))
+		completed = [(info, mtime) for info, mtime in checkpoints if info['complete']]
+		if(len(completed) > 0 and (completed[-1][0]['file'], completed[-1][1]) in evaluated):
+			# the final checkpoint was already evaluated, possibly before the listing marked it complete
+			return
+		pending = [(info, mtime) for info, mtime in checkpoints if (info['file'], mtime) not in evaluated]
+		if(len(pending) == 0):
+			time.sleep(args.evaluator_poll_secs)
+			continue
+		# when decoding is slower than the checkpointing, skip to the newest checkpoint rather than fall further behind
+		info, mtime = pending[-1]
+		evaluated.update((pendingInfo['file'], pendingMtime) for pendingInfo, pendingMtime in pending)
+		try:
+			with np.load(os.path.join(checkpointDir, info['file'])) as checkpointFile:
+				values = {name:checkpointFile[name] for name in checkpointFile.files}
+		except (IOError, OSError, ValueError) as e:
+			# removed by the rotation of the trainer meanwhile
+			print("Checkpoint %s could not be read, skipped: %s" % (info['file'], e))
+			if(info['complete']):
+				return
+			continue
+		builder.restoreVariables(sessionTuple[0], values)
+		timer = time.time()
+		bleu = calculateBleuOnBatches(args, sessionTuple, devBatches)
+		record = {'time':time.time(), 'file':info['file'], 'mtime':mtime, 'global_steps':info['global_steps'], 'epoch':info['epoch'], 'complete':info['complete'], 'bleu':bleu, 'sentences':numSentences, 'decode_time':time.time() - timer}
+		with io.open(metricsPath, 'a', encoding='utf-8') as metricsFile:
+			metricsFile.write(json.dumps(record) + '\n')
+		print("Checkpoint %s (global step %d, epoch %d): dev BLEU %2.2f, decoded %d sentences in %.2fs" % (info['file'], info['global_steps'], info['epoch'] + 1, bleu * 100.0, numSentences, record['decode_time']))
+		if(info['complete']):
+			return
+
+def removeOptions(argv, options):
+	# remove the given options and their values from argv, written either as '--option value' or '--option=value'
+	result, skipNext = [], False
+	for arg in argv:
+		if(skipNext):
+			skipNext = False
+		elif(arg in options):
+			skipNext = True
+		elif(arg.split('=', 1)[0] not in options):
+			result.append(arg)
+	return result
+
+def startBackgroundEvaluator(args):
+	# run this script in evaluate mode with the same arguments, so it build the same graph. It only pick up the checkpoints written from now on
+	if(args.checkpoint_steps <= 0 and args.checkpoint_secs <= 0):
+		raise Exception("--background_evaluation evaluate the periodic checkpoints, set --checkpoint_steps or --checkpoint_secs")
+	if(not args.dev_file_name):
+		raise Exception("--background_evaluation need a dev set (--dev_file_name)")
+	if(args.workers > 1):
+		raise Exception("--background_evaluation is not supported with --workers, which do not write the periodic checkpoints")
+	# the profiled steps are those of the trainer, the evaluator must not write traces beside them
+	command = [sys.executable, os.path.abspath(__file__)] + removeOptions(sys.argv[1:], ['--profile_steps', '--profile_dir'])
+	command += ['--mode', 'evaluate', '--evaluator_start_time', repr(time.time()), '--evaluator_parent_pid', str(os.getpid())]
+	if(args.evaluator_threads > 0):
+		command += ['--intra_op_threads', str(args.evaluator_threads), '--inter_op_threads', '1']
+	return subprocess.Popen(command)
+
+def loadInferenceGraph(args, embeddingTuple, graphPath):
+	# create a sessionTuple usable by decodeBatch from the exported graph, without building the training graph
+	with io.open(graphPath + '.json', 'r', encoding='utf-8') as signatureFile:
+		signature = json.load(signatureFile)
+	# the replicas load the graph without the vocabularies (embeddingTuple None), and skip the check
+	if(embeddingTuple is not None and (signature['src_vocab_size'] != len(embeddingTuple[0][1]) or signature['tgt_vocab_size'] != len(embeddingTuple[1][1]))):
+		raise Exception("Inference graph %s was exported with vocabulary sizes (%d, %d), current are (%d, %d)" % (graphPath, signature['src_vocab_size'], signature['tgt_vocab_size'], len(embeddingTuple[0][1]), len(embeddingTuple[1][1])))
+	graph = builder.loadFrozenGraph(graphPath)
+	getInput = lambda name: graph.get_tensor_by_name(signature['inputs'][name]) if(name in signature['inputs']) else None
+	input, inputLengthList, batchSize, maximumUnrolling, dropout = [getInput(name) for name in ['input', 'input_length', 'batch_size', 'decoder_maximum_length', 'dropout']]
+	outputIds = (None, graph.get_tensor_by_name(signature['outputs']['output_ids']))
+	args.shortlist_input, args.shortlist_size = getInput('shortlist'), signature.get('shortlist_size', 0)
+	args.decode_length_input = getInput('decoder_length_limit')
+	session = tf.Session(graph=graph, config=createSessionConfig(args))
+	return session, [input, None, None], [inputLengthList, None, batchSize, maximumUnrolling, dropout, outputIds], None
+
+def createReplicaDecoder(replicaArgs, graphPath):
+	# run in each replica process: load the inference graph and return the batch decoding function
+	sessionTuple = loadInferenceGraph(replicaArgs, None, graphPath)
+	return lambda infInput, infInputLength: decodeBatch(replicaArgs, sessionTuple, infInput, infInputLength)
+
+def createReplicaPool(args, numReplicas, graphPath):
+	# each replica is pinned to its share of the cores and use them all for its intra_op pool, unless intra_op_threads is set
+	coreSets = translatorReplicas.getCoreSubsets(numReplicas)
+	initArgsList = []
+	for cores in coreSets:
+		replicaArgs = argparse.Namespace(maximum_sentence_length=args.maximum_sentence_length, decode_length_setting=args.decode_length_setting, shortlist_table=args.shortlist_table, replica_pool=None,
+			intra_op_threads=args.intra_op_threads if(args.intra_op_threads > 0) else len(cores), inter_op_threads=args.inter_op_threads if(args.inter_op_threads > 0) else 1)
+		initArgsList.append((replicaArgs, graphPath))
+	return translatorReplicas.ReplicaPool(createReplicaDecoder, initArgsList, coreSets)
+
+def benchmarkReplicaLayouts(args, sessionTuple, embeddingTuple, graphPath):
+	# decode the first benchmark_sentences of the src file with the current session, then with each number of replicas in benchmark_replicas
+	srcWordToId = embeddingTuple[0][0]
+	srcUnknownID = srcWordToId[args.unknown_word]
+	with io.open(args.infer_input or os.path.join(args.directory, args.src_file), 'r', encoding='utf-8') as inputFile:
+		sentences = sorted((getIdsFromSentence(line, srcWordToId, srcUnknownID) for line in itertools.islice(inputFile, args.benchmark_sentences)), key=len)
+	srcEndTokenId = srcWordToId[args.end_token]
+	batches = []
+	for start in range(0, len(sentences), args.batch_size):
+		inputLength = np.fromiter(map(len, sentences[start:start+args.batch_size]), dtype=np.int32)
+		batches.append((padMatrix(sentences[start:start+args.batch_size], srcEndTokenId, inputLength), inputLength))
+	results = []
+	def timeLayout(name, numReplicas, threads):
+		timer = time.time()
+		for _ in decodeBatches(args, sessionTuple, batches):
+			pass
+		sentencesPerSec = len(sentences) / max(time.time() - timer, 1e-6)
+		results.append({'layout':name, 'replicas':numReplicas, 'threads_per_replica':threads, 'sentences_per_sec':sentencesPerSec})
+		print("%-24s %10.2f sentences/sec" % (name, sentencesPerSec))
+	timeLayout("in-process (intra %d, inter %d)" % (args.intra_op_threads, args.inter_op_threads), 1, args.intra_op_threads)
+	for numReplicas in args.benchmark_replicas:
+		args.replica_pool = createReplicaPool(args, numReplicas, graphPath)
+		try:
+			timeLayout("%d replicas" % numReplicas, numReplicas, len(translatorReplicas.getCoreSubsets(numReplicas)[0]))
+		finally:
+			args.replica_pool.close()
+			args.replica_pool = None
+	return results
+
+def getIdsFromSentence(sentence, wordToId, unknownId):
+	return [wordToId.get(word, unknownId) for word in sentence.strip().split(' ')]
+
+def translateIdBatches(args, sessionTuple, embeddingTuple, batchList):
+	# decode lists of id sentences of any length and yield the translated strings of each list, without the end token
+	# sentences found in args.translation_cache skip the decoding
+	cache = args.translation_cache
+	if(cache is None):
+		for translations in decodeIdBatches(args, sessionTuple, embeddingTuple, batchList):
+			yield translations
+		return
+	translationsList = [cache.lookup(batchSentences) for batchSentences in batchList]
+	missIdxList = [[idx for idx, translation in enumerate(translations) if translation is None] for translations in translationsList]
+	decodedBatches = decodeIdBatches(args, sessionTuple, embeddingTuple, [[batchSentences[idx] for idx in missIdx] for batchSentences, missIdx in zip(batchList, missIdxList) if len(missIdx) > 0])
+	for batchSentences, translations, missIdx in zip(batchList, translationsList, missIdxList):
+		if(len(missIdx) > 0):
+			decoded = next(decodedBatches)
+			cache.store([batchSentences[idx] for idx in missIdx], decoded)
+			for idx, translation in zip(missIdx, decoded):
+				translations[idx] = translation
+		yield translations
+
+def decodeIdBatches(args, sessionTuple, embeddingTuple, batchList):
+	srcEndTokenId = embeddingTuple[0][0][args.end_token]
+	tgtEndTokenId, tgtIdToWord = embeddingTuple[1][0][args.end_token], embeddingTuple[1][1]
+	inputLengths = [np.fromiter(map(len, batchSentences), dtype=np.int32, count=len(batchSentences)) for batchSentences in batchList]
+	paddedBatches = ((padMatrix(batchSentences, srcEndTokenId, inputLength), inputLength) for batchSentences, inputLength in zip(batchList, inputLengths))
+	for decodeOutput in decodeBatches(args, sessionTuple, paddedBatches):
+		yield [' '.join(tgtIdToWord[int(wordIdx)] for wordIdx in stripResultArray(sentence, tgtEndTokenId)) for sentence in decodeOutput]
+
+def streamInferenceSession(args, sessionTuple, embeddingTuple, inputFile, outputFile):
+	# Read the input by windows of infer_window sentences, sort each window by length to batch them, and write the translations in the input order
+	# a translation is written as soon as it and all the ones before it are done, so only the current window is kept in memory
+	srcWordToId = embeddingTuple[0][0]
+	srcUnknownID = srcWordToId[args.unknown_word]
+	numSentences = 0
+	while(True):
+		window = [getIdsFromSentence(line, srcWordToId, srcUnknownID) for line in itertools.islice(inputFile, args.infer_window)]
+		if(len(window) == 0):
+			break
+		order = sorted(range(len(window)), key=lambda idx: len(window[idx]))
+		finished, nextIdx = {}, 0
+		batchIdxList = [order[start:start+args.batch_size] for start in range(0, len(order), args.batch_size)]
+		batchList = [[window[idx] for idx in batchIdx] for batchIdx in batchIdxList]
+		for batchIdx, translations in zip(batchIdxList, translateIdBatches(args, sessionTuple, embeddingTuple, batchList)):
+			finished.update(zip(batchIdx, translations))
+			# write those which have all translations before them done
+			while(nextIdx in finished):
+				outputFile.write(finished.pop(nextIdx) + '\n')
+				nextIdx += 1
+			outputFile.flush()
+		numSentences += len(window)
+		sys.stderr.write("Translated %d sentences, time passed %.2fs\n" % (numSentences, args.time_passed()))
+	reportCacheHitRate(args)
+	return numSentences
+
+def reportCacheHitRate(args):
+	cache = args.translation_cache
+	if(cache is not None):
+		sys.stderr.write("Translation cache hit rate %.2f%% (%d hits, %d misses)\n" % (cache.getHitRate() * 100.0, cache.hits, cache.misses))
+
+def serveSession(args, sessionTuple, embeddingTuple):
+	# Keep the session and serve the translation requests, coalescing the concurrent sentences into batches of up to serve_batch_size
+	srcWordToId = embeddingTuple[0][0]
+	srcUnknownID = srcWordToId[args.unknown_word]
+	def translateFunc(sentences):
+		idSentences = [getIdsFromSentence(sentence, srcWordToId, srcUnknownID) for sentence in sentences]
+		# sort by length to reduce padding, then put them back in order
+		order = sorted(range(len(idSentences)), key=lambda idx: len(idSentences[idx]))
+		translations = next(translateIdBatches(args, sessionTuple, embeddingTuple, [[idSentences[idx] for idx in order]]))
+		result = [None] * len(sentences)
+		for idx, translation in zip(order, translations):
+			result[idx] = translation
+		return result
+	batcher = translatorServer.MicroBatcher(translateFunc, args.serve_batch_size, args.serve_flush_ms / 1000.0)
+	metrics = translatorServer.serveForever(batcher, args.serve_host, args.serve_port, args.serve_socket, args.print_verbose)
+	print("Served %d requests (%d sentences in %d batches, mean batch size %.2f), latency p50 %.2fms p99 %.2fms, %.2f sentences/sec" % (metrics['requests'], metrics['sentences'], metrics['batches'], metrics['mean_batch_size'], metrics['latency_p50_ms'], metrics['latency_p99_ms'], metrics['sentences_per_sec']))
+	reportCacheHitRate(args)
+	return metrics
 	
-def findNanSession(args, session):
-	# Search for all variable within the session
-	varList = tf.trainable_variables()
-	for tensor in varList:
-		tensorValue = tensor.eval(session=session)
-		# use dimSize to determine if int or ndarray, flatten if ndarray
-		if(not isinstance(tensorValue, (np.ndarray, list))):
-			if(not np.isfinite(tensorValue)):
-				printNan(args, tensor.name)
-		else:
-			if(not all(np.isfinite(val) for val in tensorValue.flatten())):
-				printNan(args, tensor.name)
-
-def printNan(args, tensorName):
-	print("Tensor %s had nan in its values" % tensorName)
-
-def debugSession(args, session):
-	# Get all independent variables in the sessions
-	tensorList = tf.trainable_variables()
-	# Maximum and minimum values, generate abitrary number to be overwritten
-	maxVal, minVal, maxValTensor, minValTensor = -1e20, 1e20, None, None
-	# Values taken from the session
-	tensorValues = session.run(tensorList)
-	for tensor, values in zip(tensorList, tensorValues):
-		name = tensor.name
-		if(isinstance(values, np.ndarray)):
-			# flatten
-			values = values.flatten()
-		else:
-			# create single length values
-			values = np.array([values])
-		args.print_verbose("Tensor %s, shape when flattened %s" % (name, values.shape))
-		assert len(values.shape) == 1
-		# iterate, record
-		for v in values:
-			if(v > maxVal):
-				maxVal, maxValTensor = v, name
-			elif(v < minVal):
-				minVal, minValTensor = v, name
-	args.print_verbose("Maximum @%s:%.2f; Minimum @%s:%.2f." % (maxValTensor, maxVal, minValTensor, minVal))
-	# Return the values
-	return (maxVal, maxValTensor), (minVal, minValTensor)
-
-def generateBatchesFromSentences(args, data, embeddingTuple, singleBatch=False):
+def reportSessionHealth(args, healthValues, gradientNorm=None, printFunc=print):
+	# healthValues are the fetched args.health_ops. Print the norms and extremes, then a line for each variable with non-finite values. Return their names
+	minimums, maximums, norms, finites, weightNorm = healthValues
+	names = args.health_names
+	nonFinite = np.flatnonzero(np.logical_not(finites))
+	gradientText = ", gradient norm %.4g" % gradientNorm if(gradientNorm is not None) else ""
+	if(len(nonFinite) < len(names)):
+		# extremes among the finite variables only
+		maxIdx = np.argmax(np.where(finites, maximums, -np.inf))
+		minIdx = np.argmin(np.where(finites, minimums, np.inf))
+		printFunc("Weight norm %.4g%s, maximum @%s:%.4g, minimum @%s:%.4g, %d of %d variables non-finite" % (weightNorm, gradientText, names[maxIdx], maximums[maxIdx], names[minIdx], minimums[minIdx], len(nonFinite), len(names)))
+	else:
+		printFunc("Weight norm %.4g%s, all %d variables non-finite" % (weightNorm, gradientText, len(names)))
+	for idx in nonFinite:
+		printFunc("\tTensor %s had nan/inf in its values: minimum %.4g, maximum %.4g, norm %.4g" % (names[idx], minimums[idx], maximums[idx], norms[idx]))
+	return [names[idx] for idx in nonFinite]
+
+def generateBatchesFromSentences(args, data, embeddingTuple, singleBatch=False, isIdData=False):
+	return list(iterateBatchesFromSentences(args, data, embeddingTuple, singleBatch, isIdData))
+
+def iterateBatchesFromSentences(args, data, embeddingTuple, singleBatch=False, isIdData=False):
+	# generator version of generateBatchesFromSentences, yielding each batch as soon as it is full
 	srcDictTuple, tgtDictTuple = embeddingTuple
 	srcWordToId, tgtWordToId = srcDictTuple[0], tgtDictTuple[0]
 	srcUnknownID, tgtUnknownID = srcWordToId[args.unknown_word], tgtWordToId[args.unknown_word]
-	startTokenPad = [tgtWordToId[args.start_token]]
+	paddingTuple = (srcWordToId[args.end_token], tgtWordToId[args.end_token], tgtWordToId[args.start_token])
+	# with batch_tokens, fill the batches up to a padded token budget instead of a fixed number of sentences
+	useTokenBudget = args.batch_tokens > 0 and not singleBatch
 	# data are binding tuples of (s1, s2) for src-tgt, s1/s2 preprocessed into array of respective words
-	batches = []
-	srcBatch, tgtBatch = [], []
+	# batches being filled, keyed by the length bucket of their sentences. Only bucket 0 is used without batch_tokens
+	openBatches = {}
+	# data may also be already converted to ids (isIdData) by createSentenceCouplingFromFile
 	for srcSentence, tgtSentence in data:
-		srcSentence = [srcWordToId.get(word, srcUnknownID) for word in srcSentence]
-		tgtSentence = [tgtWordToId.get(word, tgtUnknownID) for word in tgtSentence]
+		if(not isIdData):
+			srcSentence = [srcWordToId.get(word, srcUnknownID) for word in srcSentence]
+			tgtSentence = [tgtWordToId.get(word, tgtUnknownID) for word in tgtSentence]
+		sentenceLen = max(len(srcSentence), len(tgtSentence))
+		bucket = sentenceLen // args.bucket_width if(useTokenBudget) else 0
+		srcBatch, tgtBatch, maxLen = openBatches.get(bucket, ([], [], 0))
+		if(useTokenBudget and len(srcBatch) > 0 and max(maxLen, sentenceLen) * (len(srcBatch) + 1) > args.batch_tokens):
+			# adding the sentence will go over the budget (max_len x batch_rows), close the batch
+			yield createBatchFromIdSentences(srcBatch, tgtBatch, paddingTuple)
+			srcBatch, tgtBatch, maxLen = [], [], 0
 		srcBatch.append(srcSentence)
 		tgtBatch.append(tgtSentence)
-		if(len(srcBatch) == args.batch_size and not singleBatch):
+		maxLen = max(maxLen, sentenceLen)
+		if(not useTokenBudget and len(srcBatch) == args.batch_size and not singleBatch):
 			# Full batch, begin converting. If singleBatch, will not go here
-			assert len(srcBatch) == len(tgtBatch)
-			inputLengthList = padMatrix(srcBatch, srcWordToId[args.end_token])
-			outputLengthList = padMatrix(tgtBatch, tgtWordToId[args.end_token])
-			tgtInputBatch = [ (startTokenPad + list(tgt))[:-1] for tgt in tgtBatch]
-			batches.append((srcBatch, tgtBatch, inputLengthList, outputLengthList, tgtInputBatch))
-			srcBatch, tgtBatch = [], []
-	# Last batch
-	inputLengthList = padMatrix(srcBatch, srcWordToId[args.end_token])
-	outputLengthList = padMatrix(tgtBatch, tgtWordToId[args.end_token])
-	tgtInputBatch = [ (startTokenPad + list(tgt))[:-1] for tgt in tgtBatch]
-	batchSize = len(srcBatch)
-	batches.append((srcBatch, tgtBatch, inputLengthList, outputLengthList, tgtInputBatch))
-	# Return the processed value
-	return batches
-	
-def checkBatchValidity(args, batch, embeddingTuple):
-	# Check if all input/output values in batch is in the boundary of dictTuple 
-	srcEmbeddingTuple, tgtEmbeddingTuple = embeddingTuple
-	srcIdToWord, tgtIdToWord = srcEmbeddingTuple[1], tgtEmbeddingTuple[1]
-	srcSize, tgtSize = len(srcIdToWord), len(tgtIdToWord)
-	# args.print_verbose("Found srcSize: %d, tgtSize: %d" % (srcSize, tgtSize))
-	# check on 0-1-4: input-output-tgtInput
-	input, output, _, _, tgtInput = batch
-	if(any(idx >= srcSize for idx in np.array(input).flatten())):
-		raise Exception("Caught invalid index @input, full input {} while maximumIdx {}".format(input, srcSize))
-	if(any(idx >= tgtSize for idx in np.array(output).flatten())):
-                raise Exception("Caught invalid index @output, full output {} while maximumIdx {}".format(output, tgtSize))
-	if(any(idx >= tgtSize for idx in np.array(tgtInput).flatten())):
-                raise Exception("Caught invalid index @tgtInput, fullInput {} while maximumIdx {}".format(tgtInput, tgtSize))
+			yield createBatchFromIdSentences(srcBatch, tgtBatch, paddingTuple)
+			srcBatch, tgtBatch, maxLen = [], [], 0
+		openBatches[bucket] = (srcBatch, tgtBatch, maxLen)
+	# Last batches
+	for bucket in sorted(openBatches):
+		srcBatch, tgtBatch, _ = openBatches[bucket]
+		if(len(srcBatch) > 0):
+			yield createBatchFromIdSentences(srcBatch, tgtBatch, paddingTuple)
+
+def createBatchFromIdSentences(srcBatch, tgtBatch, paddingTuple):
+	# build the batch directly as int32 ndarrays, ready to be fed without conversion
+	assert len(srcBatch) == len(tgtBatch)
+	inputPadding, outputPadding, outputStartToken = paddingTuple
+	inputLengthList = np.fromiter(map(len, srcBatch), dtype=np.int32, count=len(srcBatch))
+	outputLengthList = np.fromiter(map(len, tgtBatch), dtype=np.int32, count=len(tgtBatch))
+	srcMatrix = padMatrix(srcBatch, inputPadding, inputLengthList)
+	tgtMatrix = padMatrix(tgtBatch, outputPadding, outputLengthList)
+	tgtInputMatrix = corpusBuilder.createDecoderInput(tgtMatrix, outputStartToken)
+	return srcMatrix, tgtMatrix, inputLengthList, outputLengthList, tgtInputMatrix
 
+def getBatchPaddingCount(batch):
+	# return (real tokens, padded tokens) of both input and output of the batch
+	input, output, inputLengthList, outputLengthList, _ = batch
+	return int(np.sum(inputLengthList) + np.sum(outputLengthList)), np.size(input) + np.size(output)
+	
 def generateRandomBatchesFromSet(args, batches, paddingToken):
 	raise Exception("Unfixed @generateRandomBatchesFromSet")
 	# if batch too small, use first available
@@ -481,16 +1165,12 @@ def generateInferenceInputFromFile(args, embeddingTuple):
 	args.print_verbose("Number of created batches %d" % len(batchedSentences))
 	return batchedSentences
 	
-def padMatrix(matrix, paddingToken):
-	# find the longest line in the matrix to do the padding
-	# TODO plus one for the longest if not crossing abitrary maxLength
-	originalLength = [len(sentence) for sentence in matrix]
-	maxLen = max(originalLength)
-	# pad everything
-	for sentence in matrix:
-		if(len(sentence) < maxLen):
-			sentence.extend([paddingToken] * (maxLen - len(sentence)))
-	return originalLength
+def padMatrix(matrix, paddingToken, originalLength=None):
+	# create the padded int32 matrix, preallocated with paddingToken and filled with the sentences
+	if(originalLength is None):
+		originalLength = np.fromiter(map(len, matrix), dtype=np.int32, count=len(matrix))
+	flatIds = np.fromiter(itertools.chain.from_iterable(matrix), dtype=np.int32, count=int(np.sum(originalLength)))
+	return corpusBuilder.createPaddedMatrix(flatIds, originalLength, paddingToken)
 
 def getWordIdFromVectors(vectors, embedding, embeddingIsNormal=False, savedData=None):
 	# only handle sentence-level vector
@@ -706,13 +1386,13 @@ def strToRange(str):
 		return float(str[0], float(str[1]))
 	
 	
-if __name__ == "__main__":
-	# Run argparse
+def createArgumentParser():
 	parser = argparse.ArgumentParser(description='Create training examples from resource data.')
 	# OVERALL CONFIG
-	parser.add_argument('-m','--mode', type=str, default='train', help='Mode to run the file. Currently only train|infer')
+	parser.add_argument('-m','--mode', type=str, default='train', help='Mode to run the file. Currently only train|infer|serve|export|quantize|benchmark_replicas|evaluate. quantize export the inference graph with int8 weights, only compressing the file: the weights are float32 again once loaded, with the same memory use and speed.')
 	parser.add_argument('--read_mode', type=str, default='embedding', help='Read binary, pickled, dictionary files as embedding, or vocab files. Default embedding')
 	parser.add_argument('--import_default_dict', action='store_false', help='Do not use the varied length original embedding instead of the normalized version.')
+	parser.add_argument('--compile_embedding', action='store_true', help='If specified, write the pickled embedding into the compiled (.npy + .vocab) format beside it. Later runs will memory-map it instead.')
 	parser.add_argument('--train_embedding', action='store_true', help='Train the embedding vectors of words during the training. Will be forced to True in vocab read_mode.')
 	parser.add_argument('--vocab_init', type=str, default='uniform', help='Choose type of initializer for vocab mode. Default uniform, can be normal(gaussian).')
 	parser.add_argument('--initialize_range', type=strToRange, default=(-1.0, 1.0), help='The range to initialize variables, default (-1.0, 1.0).')
@@ -729,12 +1409,58 @@ if __name__ == "__main__":
 	parser.add_argument('--start_token', type=str, default='<s>', help='Key in embedding/vocab standing for the starting token')
 	parser.add_argument('--end_token', type=str, default='<\s>', help='Key in embedding/vocab standing for the ending token')
 	parser.add_argument('-s', '--save_path', type=str, default=None, help='Directory to load and save the trained model. Required in training mode.')
-	parser.add_argument('-b', '--batch_file_name', type=str, default=None, help='The names of created batch file for training. If not specified, will try to look for it in save_path with "bat" extension .')
-	parser.add_argument('--save_batch', action='store_true', help='If specified, the batch will be saved to batch_file_name for future training.')
+	parser.add_argument('-b', '--batch_file_name', type=str, default=None, help='The directory of the compiled corpus for training. If not specified, will try to look for it in save_path with "corpus" extension.')
+	parser.add_argument('--save_batch', action='store_true', help='Kept for compatibility, the training batches are always compiled into the memory-mapped corpus at batch_file_name (default the save path with .corpus extension). Later training reuse it, and rebuild it when the training files, vocab or batching settings change.')
 	parser.add_argument('--epoch', type=int, default=100, help='How many times this model will train on current data. Default 100.')
 	parser.add_argument('--evaluation_step', type=int, default=20, help='For each evaluation_step epoch, run the check for accuracy. Default 20.')
 	parser.add_argument('--maximum_sentence_length', type=int, default=50, help='Maximum length of sentences. Default 50.')
 	parser.add_argument('--batch_size', type=int, default=128, help='Size of mini-batch for training. Default 128.')
+	parser.add_argument('--batch_tokens', type=int, default=0, help='If specified, batches are filled up to this number of padded tokens (max_len x batch_rows) instead of batch_size sentences.')
+	parser.add_argument('--bucket_width', type=int, default=5, help='Width of the sentence length buckets used with batch_tokens. Default 5.')
+	parser.add_argument('--input_pipeline', type=str, default='feed', help='feed|dataset. dataset build the training graph upon a tf.data pipeline reading the compiled corpus instead of feed_dict. Default feed.')
+	parser.add_argument('--prefetch_depth', type=int, default=4, help='Number of batches prepared ahead by background threads during training. 0 to prepare synchronously. Default 4.')
+	parser.add_argument('--prefetch_workers', type=int, default=1, help='Number of threads preparing batches for prefetch_depth. Default 1.')
+	parser.add_argument('--shuffle_batches', action='store_true', help='If specified, shuffle the order of batches each epoch.')
+	parser.add_argument('--shuffle_buffer_size', type=int, default=100000, help='Number of sentences shuffled at once by the dataset input pipeline with shuffle_batches. Default 100000.')
+	parser.add_argument('--checkpoint_steps', type=int, default=0, help='If above 0, save a checkpoint every checkpoint_steps global steps during training, written in the background to save_path.checkpoints. An unfinished run resume from the newest one. Default 0.')
+	parser.add_argument('--checkpoint_secs', type=int, default=0, help='If above 0, save a checkpoint every checkpoint_secs seconds during training. Default 0.')
+	parser.add_argument('--keep_checkpoints', type=int, default=5, help='Number of newest checkpoints kept. Default 5.')
+	parser.add_argument('--shuffle_seed', type=int, default=None, help='Seed of the batch order with shuffle_batches. Default random, kept in the checkpoints for resuming.')
+	parser.add_argument('--workers', type=int, default=1, help='Train with this many processes, each on its shard of the batches and pinned to its share of the cores, averaging their variables every sync_steps. Default 1 (in the main process).')
+	parser.add_argument('--sync_steps', type=int, default=1, help='Steps between the averaging of the variables of the workers. Default 1.')
+	parser.add_argument('--scaling_baseline_steps', type=int, default=20, help='Steps timed in the main process before starting the workers, to report the scaling efficiency against. 0 to skip. Default 20.')
+	parser.add_argument('--background_evaluation', action='store_true', help='Evaluate the dev set BLEU in a separate process watching the periodic checkpoints, instead of stopping the training every evaluation_step epochs.')
+	parser.add_argument('--metrics_file', type=str, default=None, help='JSONL file the evaluate mode append the BLEU of each checkpoint to. Default save_path.metrics.jsonl.')
+	parser.add_argument('--evaluator_poll_secs', type=float, default=30.0, help='Seconds between the checks for new checkpoints in evaluate mode. Default 30.')
+	parser.add_argument('--evaluator_threads', type=int, default=0, help='If above 0, the intra-op threads of the background evaluator. Default 0 (TensorFlow default).')
+	parser.add_argument('--evaluator_start_time', type=float, default=None, help='In evaluate mode, ignore the checkpoints written before this time. Set by background_evaluation.')
+	parser.add_argument('--evaluator_parent_pid', type=int, default=None, help='In evaluate mode, stop when the process of this pid is no longer the parent. Set by background_evaluation.')
+	parser.add_argument('--encode_workers', type=int, default=1, help='Number of processes converting the training files to ids, each on a shard of the files. Default 1 (in the main process).')
+	parser.add_argument('--infer_input', type=str, default=None, help='File to translate in infer mode, - for stdin. If specified, the translation is streamed without BLEU evaluation. Default to the src input file.')
+	parser.add_argument('--infer_output', type=str, default=None, help='File to write the translation in infer mode, - for stdout. Default to the output file name.')
+	parser.add_argument('--infer_window', type=int, default=10000, help='Number of sentences read and sorted by length at once when streaming the inference. Default 10000.')
+	parser.add_argument('--serve_host', type=str, default='127.0.0.1', help='Host to listen on in serve mode. Default 127.0.0.1.')
+	parser.add_argument('--serve_port', type=int, default=8080, help='Port to listen on in serve mode. Default 8080.')
+	parser.add_argument('--serve_socket', type=str, default=None, help='If specified, listen on this Unix socket instead of the host/port in serve mode.')
+	parser.add_argument('--serve_batch_size', type=int, default=32, help='Maximum sentences decoded together in serve mode. Default 32.')
+	parser.add_argument('--serve_flush_ms', type=float, default=10.0, help='Maximum time in ms a sentence wait for others to fill its batch in serve mode. Default 10.')
+	parser.add_argument('--inference_graph', type=str, default=None, help='Inference graph written by export/quantize mode (default to the save path with .inference.pb/.inference.int8.pb extension). If specified in infer/serve mode, load it instead of building the session.')
+	parser.add_argument('--shortlist_size', type=int, default=0, help='If above 0, the greedy decoder outside of training only compute the logits of this many target words, chosen for each batch from the word translation table. Default 0 (full vocabulary).')
+	parser.add_argument('--shortlist_top_k', type=int, default=20, help='Number of target candidates kept per source word in the word translation table. Default 20.')
+	parser.add_argument('--shortlist_frequent', type=int, default=1000, help='Number of most frequent target words always in the shortlist. Default 1000.')
+	parser.add_argument('--decode_length_ratio', type=float, default=None, help='Outside of training, each sentence is decoded up to decode_length_ratio x source length + decode_length_margin. Default estimated from the training corpus. 0 to always decode up to maximum_sentence_length.')
+	parser.add_argument('--decode_length_margin', type=int, default=5, help='Margin added to the decode length limit. Default 5.')
+	parser.add_argument('--decode_length_coverage', type=float, default=0.99, help='Fraction of the training sentence pairs the estimated decode_length_ratio must cover. Default 0.99.')
+	parser.add_argument('--intra_op_threads', type=int, default=0, help='Threads used inside a single op (matmul...). Default 0, chosen by TensorFlow.')
+	parser.add_argument('--inter_op_threads', type=int, default=0, help='Threads running independent ops in parallel. Default 0, chosen by TensorFlow.')
+	parser.add_argument('--session_replicas', type=int, default=1, help='In infer mode, decode with this many processes, each pinned to its share of the cores and loading --inference_graph. Default 1 (the main session).')
+	parser.add_argument('--benchmark_replicas', type=lambda s: [int(num) for num in s.split(',')], default=[1, 2, 4], help='Comma separated numbers of replicas tried by benchmark_replicas mode. Default 1,2,4.')
+	parser.add_argument('--benchmark_sentences', type=int, default=2000, help='Number of sentences of the input decoded for each layout in benchmark_replicas mode. Default 2000.')
+	parser.add_argument('--benchmark_output', type=str, default=None, help='If specified, write the benchmark results as JSON to this file.')
+	parser.add_argument('--translation_cache', dest='translation_cache_enabled', action='store_true', help='If specified, cache the translations of infer/serve mode in memory and in cache_file. The cache is cleared when the checkpoint change. With shortlist_size, a translation depend on the other sentences of the batch it was decoded in, and the cache keep the first one.')
+	parser.add_argument('--cache_size', type=int, default=100000, help='Number of translations kept in the in-memory cache. Default 100000.')
+	parser.add_argument('--cache_file', type=str, default=None, help='Sqlite file of the on-disk cache. Default to the save path with .cache extension.')
+	parser.add_argument('--sort_buffer_size', type=int, default=200000, help='Maximum sentence pairs sorted in memory at once. Larger training files are spilled to temporary files and merge sorted. Default 200000.')
 	
 	parser.add_argument('--layer_size', type=int, default=128, help='Size of hidden layer in each cell. Default to 128. Will be rewritten to size of embedding if in embedding read_mode.')
 	parser.add_argument('--layer_depth', type=int, default=2, help='Depth of the greatest cell (number of sub-cell within it). Default 2.')
@@ -751,6 +1477,8 @@ if __name__ == "__main__":
 	parser.add_argument('--colocate', action='store_true', help='If specified, do colocate regarding gradient calculation.')
 	parser.add_argument('--dropout', type=float, default=1.0, help='The dropout used for training. Will be automatically set to 1.0 in infer mode. Default 1.0')
 	parser.add_argument('--optimizer', type=str, default='SGD', help='The optimizer used for training. List in tf.contrib.layer.optimize_loss function . Default SGD.')
+	parser.add_argument('--loss', type=str, default='softmax', choices=['softmax', 'sampled_softmax'], help='Training loss. sampled_softmax only compute the logits of num_sampled words per step instead of the whole target vocabulary. Evaluation and inference always use the full softmax. Default softmax.')
+	parser.add_argument('--num_sampled', type=int, default=512, help='Number of sampled words per step with sampled_softmax loss. Default 512.')
 	parser.add_argument('--learning_rate', type=float, default=None, help='The learning rate used for training. Default 1.0 for SGD and 0.001 for Adam.')
 	parser.add_argument('--warmup_threshold', type=int, default=0, help='The warmup step used for learning rate (on global steps). If unspecified, will not use warmup.')
 	parser.add_argument('--warmup_steps', type=int, default=0, help='The warmup factor for steps. Default 1/5 of the threshold.')
@@ -758,19 +1486,30 @@ if __name__ == "__main__":
 	parser.add_argument('--decay_steps', type=int, default=1000, help='The steps to staircase the learning rate decay (on global steps). Default 1000.')
 	parser.add_argument('--decay_factor', type=float, default=0.5, help='The factor to multiply at each decay_steps. Default 0.5')
 	parser.add_argument('--gradient_clipping', type=float, default=5.0, help='The maximum value for gradient. Default 5.0')
+	parser.add_argument('--accumulate_steps', type=int, default=1, help='Accumulate the gradients of this many batches before applying them, with the loss normalized by the total token count. The learning rate schedule, checkpoint_steps and debug_steps count the applied updates. Default 1 (apply every batch).')
 	parser.add_argument('--dynamic_clipping', action='store_true', help='If activate, clip the gradients based on the losses multiplying the gradient_clipping variable.')
 	parser.add_argument('--scheduled_sampling_rate', type=float, default=0.0, help='If specified > 0.0, use ScheduledEmbeddingTrainingHelper with the rate with step')
 	parser.add_argument('--scheduled_sampling_step', type=int, default=0, help='If specified a positive integer, use ScheduledEmbeddingTrainingHelper with the step specified')
 	parser.add_argument('--scheduled_sampling_type', type=str, default='linear', help='Use linear|exp|inv_sigmoid in the ScheduledEmbeddingTrainingHelper. Default use linear')
 
+	parser.add_argument('--telemetry_file', type=str, default=None, help='If specified, append the training telemetry (data wait, run time, tokens/sec, padding ratio, learning rate, gradient norm) to this JSONL file.')
+	parser.add_argument('--telemetry_summary_dir', type=str, default=None, help='If specified with telemetry_file, also write the telemetry as TF summaries in this directory.')
+	parser.add_argument('--telemetry_interval', type=int, default=100, help='Number of steps aggregated in each telemetry record. Default 100.')
+	parser.add_argument('--profile_steps', type=lambda s: [int(step) for step in s.split(',')], default=None, help='Comma separated steps (global steps in training, batches in inference) run with a full trace, writing their Chrome trace timelines and a per-op cost table in profile_dir.')
+	parser.add_argument('--profile_dir', type=str, default=None, help='Directory of the profile_steps output. Default save_path.profile.')
+
 	# DEBUG
-	parser.add_argument('--debug', action='store_true', help='When activated, run debugSession function every debug_steps during training.')
+	parser.add_argument('--debug', action='store_true', help='When activated, report the variable extremes, weight and gradient norms every debug_steps during training.')
 	parser.add_argument('--debug_steps', type=int, default=1, help='The step to run debug function. Default to every step (1).')
+	return parser
 
+if __name__ == "__main__":
+	# Run argparse
+	parser = createArgumentParser()
 	args = parser.parse_args()
 	if(args.load_params or args.save_params):
 		tryLoadOrSaveParams(args, ['mode', 'directory'])
-	if(args.mode == 'infer'):
+	if(args.mode in ['infer', 'serve', 'export', 'quantize', 'benchmark_replicas', 'evaluate']):
 		args.dropout = 1.0
 	if(args.learning_rate is None):
 		args.learning_rate = 0.001 if(args.optimizer == 'adam') else 1.0
@@ -811,46 +1550,108 @@ if __name__ == "__main__":
 	def getTimer():
 		return time.time()-timer
 	args.time_passed = getTimer
+	if(args.mode == 'infer' and args.infer_output == '-'):
+		# translations go to stdout, so all the status messages are moved to stderr
+		sys.stdout = sys.stderr
 	
+	# the data-parallel workers build their own session from the settings as given, before createSession replace some of them with tensors
+	workerArgs = argparse.Namespace(**{key:value for key, value in vars(args).items() if not callable(value)}) if(args.mode == 'train' and args.workers > 1) else None
 	# Create the session here
 	tf.reset_default_graph()
 	if(args.read_mode == 'embedding'):
 		embeddingTuple = createEmbeddingCouplingFromFile(args)
 	elif(args.read_mode == 'vocab'):
 		embeddingTuple = createCouplingFromVocabFile(args)
-	sessionTuple = createSession(args, embeddingTuple)
+	paddingTuple = (embeddingTuple[0][0][args.end_token], embeddingTuple[1][0][args.end_token], embeddingTuple[1][0][args.start_token])
+	corpusDir = args.batch_file_name if(args.batch_file_name) else os.path.join(args.directory, args.save_path + ".corpus")
+	if(args.mode == 'train' and args.input_pipeline == 'dataset'):
+		# the graph is built upon the corpus iterator, so the compiled corpus must exist before the session
+		compileTrainingCorpus(args, embeddingTuple, corpusDir)
+		bucketTuple = corpusBuilder.getBucketBatchSizes(args.maximum_sentence_length, args.bucket_width, args.batch_size, args.batch_tokens)
+		dataset, args.dataset_feed, args.dataset_shuffle_seed = corpusBuilder.createCorpusDataset(corpusBuilder.CorpusBatches(corpusDir, paddingTuple), paddingTuple, bucketTuple, args.prefetch_depth, args.shuffle_buffer_size if(args.shuffle_batches) else 0)
+	else:
+		dataset = None
+	savePath = os.path.join(args.directory, args.save_path + ".ckpt")
+	graphPath = args.inference_graph if(args.inference_graph) else os.path.join(args.directory, args.save_path + ".inference.pb")
+	if(args.mode in ['infer', 'serve', 'benchmark_replicas'] and args.inference_graph):
+		# load the exported inference graph, skipping the graph construction and checkpoint restore
+		sessionTuple = loadInferenceGraph(args, embeddingTuple, graphPath)
+		print("Loaded inference graph %s" % graphPath)
+	else:
+		sessionTuple = createSession(args, embeddingTuple, dataset)
+		builder.loadFromPath(sessionTuple[0], savePath)
 	session, inputOutputTuple, configTuple, trainTuple = sessionTuple
-	if(args.save_path):
-		savePath = os.path.join(args.directory, args.save_path + ".ckpt")
-		builder.loadFromPath(session, savePath)
 	print("Creating session done, time passed %.2fs" % getTimer())
+	args.shortlist_table = None
+	if(args.shortlist_input is not None):
+		# build the word translation table from the training corpus on first use
+		shortlistPath = os.path.join(args.directory, args.save_path + ".shortlist.npz")
+		candidates, frequentIds, topK = corpusBuilder.loadShortlistTable(shortlistPath, args.shortlist_frequent) if(os.path.isfile(shortlistPath)) else (None, None, None)
+		if(topK != args.shortlist_top_k):
+			# missing table, or built with another shortlist_top_k
+			if(corpusBuilder.isCorpusDirectory(corpusDir)):
+				coupling = corpusBuilder.CorpusBatches(corpusDir, paddingTuple).iterateSentences()
+			else:
+				coupling = readSentenceCouplingFromFiles(args, os.path.join(args.directory, args.src_file), os.path.join(args.directory, args.tgt_file), embeddingTuple)
+			candidates, tgtCounts = corpusBuilder.buildShortlistTable(coupling, len(embeddingTuple[0][1]), len(embeddingTuple[1][1]), args.shortlist_top_k)
+			corpusBuilder.saveShortlistTable(shortlistPath, candidates, tgtCounts, args.shortlist_top_k)
+			print("Shortlist table saved to %s" % shortlistPath)
+			candidates, frequentIds, topK = corpusBuilder.loadShortlistTable(shortlistPath, args.shortlist_frequent)
+		if(candidates.shape[0] != len(embeddingTuple[0][1])):
+			raise Exception("Shortlist table %s was built with %d source words, current vocab has %d. Remove it to rebuild." % (shortlistPath, candidates.shape[0], len(embeddingTuple[0][1])))
+		# the end token must always be available to finish the sentences
+		tgtWordToId = embeddingTuple[1][0]
+		args.shortlist_table = (candidates, frequentIds, (tgtWordToId[args.end_token], tgtWordToId[args.unknown_word]))
+	args.decode_length_setting = None
+	if(args.mode != 'train' and (args.decode_length_ratio is None or args.decode_length_ratio > 0)):
+		ratio = args.decode_length_ratio if(args.decode_length_ratio is not None) else getDecodeLengthRatio(args, corpusDir, paddingTuple)
+		if(ratio is None):
+			print("No training corpus to estimate the decode length ratio, decoding up to maximum_sentence_length.")
+		else:
+			args.decode_length_setting = (ratio, args.decode_length_margin, embeddingTuple[1][0][args.end_token])
+			args.print_verbose("Decode length limit: %.2f x source length + %d" % (ratio, args.decode_length_margin))
+	args.replica_pool = None
+	if(args.session_replicas > 1 and args.mode == 'infer'):
+		# the replicas load the exported inference graph, as the session of this process cannot be shared with them
+		if(not args.inference_graph):
+			raise Exception("--session_replicas need an exported graph in --inference_graph")
+		args.replica_pool = createReplicaPool(args, args.session_replicas, graphPath)
+		print("Started %d session replicas, time passed %.2fs" % (args.session_replicas, getTimer()))
+	args.translation_cache = None
+	if(args.translation_cache_enabled and args.mode in ['infer', 'serve']):
+		# the exported graph hold the weights itself, the checkpoint .index file the checksum of every saved tensor, so either change whenever the weights do
+		fingerprintPath = graphPath if(trainTuple is None) else savePath + '.index'
+		fingerprint = translationCache.getFileFingerprint(fingerprintPath, "%d %s %d %d %d %s" % (args.maximum_sentence_length, args.end_token, args.shortlist_size, args.shortlist_top_k, args.shortlist_frequent, args.decode_length_setting[:2] if(args.decode_length_setting) else None))
+		if(fingerprint is None):
+			print("No checkpoint at %s, the translation cache is disabled." % fingerprintPath)
+		else:
+			args.translation_cache = translationCache.TranslationCache(fingerprint, args.cache_file or os.path.join(args.directory, args.save_path + ".cache"), args.cache_size)
+	args.profiler = None
+	if(args.profile_steps):
+		# training steps are the global steps, inference steps the decoded batches
+		args.profiler = builder.StepProfiler(args.profile_steps, args.profile_dir or os.path.join(args.directory, args.save_path + ".profile"))
+	args.telemetry = None
+	if(args.telemetry_file and args.mode == 'train' and workerArgs is None):
+		args.telemetry = trainingTelemetry.TrainingTelemetry(args.telemetry_file, args.telemetry_summary_dir, args.telemetry_interval)
 	# testRun(args, sessionTuple, embeddingTuple)
 	
 	
 	if(args.mode == 'train'):
-		# Try to load created batch file as default
-		otherBatchFileName = os.path.join(args.directory, args.save_path + ".bat")
-		if(os.path.isfile(otherBatchFileName) or (args.batch_file_name and os.path.isfile(args.batch_file_name))):
-			# try getting batches saved from previous iteration instead of creating new
-			batchesPath = args.batch_file_name if(not os.path.isfile(otherBatchFileName)) else otherBatchFileName
-			batchesFile = io.open(batchesPath, 'rb')
-			batches = pickle.load(batchesFile)
-			batchesFile.close()
+		compileTrainingCorpus(args, embeddingTuple, corpusDir)
+		# memory-mapped corpus, batches are assembled upon access
+		batches = corpusBuilder.CorpusBatches(corpusDir, paddingTuple)
+		# Check corpus for screwup in idx values directly on the flat arrays
+		vocabSize = (len(embeddingTuple[0][1]), len(embeddingTuple[1][1]))
+		if(batches.info.get('vocabSize') and tuple(batches.info['vocabSize']) != vocabSize):
+			print("Warning: corpus {} compiled with vocab size {}, current vocab size {}".format(corpusDir, batches.info['vocabSize'], vocabSize))
+		srcMaxId, tgtMaxId = batches.getMaximumIds()
+		if(srcMaxId >= vocabSize[0] or tgtMaxId >= vocabSize[1]):
+			raise Exception("Caught invalid index @corpus {}, maximumIdx ({}, {}) while vocab size ({}, {})".format(corpusDir, srcMaxId, tgtMaxId, len(embeddingTuple[0][1]), len(embeddingTuple[1][1])))
+		sampleCoupling = createDevCouplingFromFile(args, embeddingTuple)
+		if(sampleCoupling is not None):
+			sample = generateBatchesFromSentences(args, sampleCoupling, embeddingTuple, isIdData=True)[0]
 		else:
-			# If cannot find the data, create from files in direction
-			#try:
-				# create new batches from the files src_file and tgt_file specified
-				batchesCoupling, sampleCoupling = createSentenceCouplingFromFile(args)
-				batches = generateBatchesFromSentences(args, batchesCoupling, embeddingTuple)
-				if(sampleCoupling is not None):
-					sample = generateBatchesFromSentences(args, sampleCoupling, embeddingTuple)[0]
-				elif(args.mode in ['train', 'test']):
-					sample = generateRandomBatchesFromSet(args, batches, (embeddingTuple[0][0][args.end_token], embeddingTuple[1][0][args.end_token], embeddingTuple[1][0][args.start_token]))
-			#except Exception:
-			#	raise argparse.ArgumentTypeError("Have no saved batches and no new src/tgt files for training. Exiting.")
-		# Check batch for screwup in idx values
-		for batch in batches:
-			checkBatchValidity(args, batch, embeddingTuple)	
+			sample = batches[np.random.randint(len(batches))]
 		print("Batches generated/loaded with no error, time passed %.2f, amount of batches %d" % (getTimer(), len(batches)))
 		args.print_verbose("Size of sampleBatch: %d" % len(sample[2]))
 		
@@ -871,52 +1672,109 @@ if __name__ == "__main__":
 			print("Iteration %d, time passed %.2fs, BLEU score %2.2f(@train) and %2.2f(@infer) " % (iteration, getTimer(), trainResult * 100.0, inferResult * 100.0))
 			print("Losses during this cycle: {}".format(losses[-args.evaluation_step:]))
 			return True
-		# evaluate the initialized model. Expect horrendous result
-		evaluationFunction((0, []))
+		evaluatorProcess = None
+		if(args.background_evaluation):
+			# the evaluator process decode the dev set with the periodic checkpoints, training is not stopped for it
+			evaluatorProcess = startBackgroundEvaluator(args)
+			evaluationFunction = None
+			print("Started the background evaluator, metrics in %s" % (args.metrics_file or os.path.join(args.directory, args.save_path + ".metrics.jsonl")))
+		else:
+			# evaluate the initialized model. Expect horrendous result
+			evaluationFunction((0, []))
 		# execute training
-		totalLossTrack = trainSession(args, sessionTuple, batches, evaluationFunction)
+		if(workerArgs is not None):
+			# the workers reopen the compiled corpus rather than receiving a copy of it
+			batchSource = corpusDir if(isinstance(batches, corpusBuilder.CorpusBatches)) else batches
+			totalLossTrack = trainParallelSession(args, workerArgs, sessionTuple, embeddingTuple, batches, batchSource, paddingTuple, evaluationFunction)
+		else:
+			totalLossTrack = trainSession(args, sessionTuple, batches, evaluationFunction)
+		if(evaluatorProcess is not None):
+			# the last checkpoint is marked complete, the evaluator stop after evaluating it
+			print("Waiting for the background evaluator to finish, time passed %.2fs" % getTimer())
+			evaluatorProcess.wait()
 	elif(args.mode == 'infer'):
 		# infer will try to read input in file input.src and output to file output.tgt
-		# INCOMPLETED
-		if(os.path.isfile(os.path.join(args.directory, args.tgt_file))):
-			# Has coupling possible, use default functions
-			batchesCoupling, _ = createSentenceCouplingFromFile(args)
-			batches = generateBatchesFromSentences(args, batchesCoupling, embeddingTuple)
+		if(args.infer_input is None and os.path.isfile(os.path.join(args.directory, args.tgt_file))):
+			# Has coupling possible, use default functions and calculate BLEU score
+			batchesCoupling, _ = createSentenceCouplingFromFile(args, embeddingTuple)
+			batches = generateBatchesFromSentences(args, batchesCoupling, embeddingTuple, isIdData=True)
 			inferInput = [batch[0] for batch in batches]
 			inferInputLength = [batch[2] for batch in batches]
 			correctOutput = [batch[1] for batch in batches] 
 			args.print_verbose("Go with correctOutput and proper batch")
-		else:
-			inferInput = generateInferenceInputFromFile(args, embeddingTuple)
-			correctOutput = None
-			args.print_verbose("Go without correctOutput")
-		inferOutput = inferenceSession(args, sessionTuple, zip(inferInput, inferInputLength))
-		
-		args.print_verbose("Sample @idx=[0], first batch:", inferInput[0][0], '\n=>', inferOutput[0][0])
-		
-		print(np.shape(correctOutput))
-		# Flatten the inferOutput
-		inferOutput = np.concatenate(inferOutput, axis=0)
-		outputFile = outputInferenceToFile(args, embeddingTuple, inferOutput)
-		
-		if(correctOutput):
+			inferOutput = inferenceSession(args, sessionTuple, zip(inferInput, inferInputLength))
+			
+			args.print_verbose("Sample @idx=[0], first batch:", inferInput[0][0], '\n=>', inferOutput[0][0])
+			
+			# Flatten the inferOutput, each batch may have different length
+			inferOutput = [sentence for batchOutput in inferOutput for sentence in batchOutput]
+			outputFile = outputInferenceToFile(args, embeddingTuple, inferOutput)
 			# Flatten the correctOutput and trimLength as well
-			# correctOutput = np.concatenate(correctOutput, axis=0)
 			correctOutput = [item for sublist in correctOutput for item in sublist]
 			trimLength = np.concatenate([batch[3] for batch in batches])
 			# print(np.shape(correctOutput), np.shape(inferOutput), np.shape(trimLength))
 			inferResult = calculateBleu(correctOutput, inferOutput, trimLength)
 			print("Inference mode ran and saved to %s, BLEU score %2.2f, time passed %.2fs" % (outputFile, inferResult * 100.0, getTimer()))
 		else:
-			print("Inference mode ran and saved to %s, time passed %.2fs" % (outputFile, getTimer()))
+			# Stream from infer_input (default src_file, - for stdin) to infer_output (default output file, - for stdout), keeping the order of the input
+			args.print_verbose("Go without correctOutput")
+			if(args.infer_input == '-'):
+				inputFile = io.open(sys.stdin.fileno(), 'r', encoding='utf-8', closefd=False)
+			else:
+				inputFile = io.open(args.infer_input or os.path.join(args.directory, args.src_file), 'r', encoding='utf-8')
+			if(args.infer_output == '-'):
+				outputFilePath = '<stdout>'
+				outputFile = io.open(sys.__stdout__.fileno(), 'w', encoding='utf-8', closefd=False)
+			else:
+				outputFilePath = args.infer_output or os.path.join(args.directory, args.tgt + args.output_file_name if(args.prefix) else args.output_file_name + '.' + args.tgt)
+				outputFile = io.open(outputFilePath, 'w', encoding='utf-8')
+			numSentences = streamInferenceSession(args, sessionTuple, embeddingTuple, inputFile, outputFile)
+			inputFile.close()
+			outputFile.close()
+			sys.stderr.write("Inference mode ran on %d sentences and saved to %s, time passed %.2fs\n" % (numSentences, outputFilePath, getTimer()))
+	elif(args.mode == 'evaluate'):
+		devCoupling = createDevCouplingFromFile(args, embeddingTuple)
+		if(devCoupling is None or len(devCoupling) == 0):
+			raise Exception("evaluate mode need a dev set (--dev_file_name)")
+		devBatches = generateBatchesFromSentences(args, devCoupling, embeddingTuple, isIdData=True)
+		metricsPath = args.metrics_file or os.path.join(args.directory, args.save_path + ".metrics.jsonl")
+		evaluateCheckpoints(args, sessionTuple, devBatches, os.path.join(args.directory, args.save_path + ".checkpoints"), metricsPath, args.evaluator_start_time, args.evaluator_parent_pid)
+		print("Evaluation of the checkpoints finished, metrics in %s, time passed %.2fs" % (metricsPath, getTimer()))
+	elif(args.mode == 'serve'):
+		serveSession(args, sessionTuple, embeddingTuple)
+	elif(args.mode == 'benchmark_replicas'):
+		if(not args.inference_graph):
+			raise Exception("benchmark_replicas mode need an exported graph in --inference_graph")
+		results = benchmarkReplicaLayouts(args, sessionTuple, embeddingTuple, graphPath)
+		if(args.benchmark_output):
+			with io.open(args.benchmark_output, 'w', encoding='utf-8') as outputFile:
+				outputFile.write(json.dumps(results, indent=2))
+	elif(args.mode == 'quantize'):
+		# export the int8 graph, then compare its BLEU on the dev set with the float session. The file is smaller, the loaded graph run as the float one
+		quantizedPath = args.inference_graph if(args.inference_graph) else os.path.join(args.directory, args.save_path + ".inference.int8.pb")
+		numNodes = exportInferenceGraph(args, sessionTuple, embeddingTuple, quantizedPath, quantize=True)
+		print("Quantized inference graph exported to %s (%d nodes), signature in %s.json" % (quantizedPath, numNodes, quantizedPath))
+		devCoupling = createDevCouplingFromFile(args, embeddingTuple)
+		if(devCoupling is None or len(devCoupling) == 0):
+			print("No dev set (--dev_file_name), skipping the BLEU check.")
+		else:
+			devBatches = generateBatchesFromSentences(args, devCoupling, embeddingTuple, isIdData=True)
+			floatBleu = calculateBleuOnBatches(args, sessionTuple, devBatches)
+			quantizedBleu = calculateBleuOnBatches(args, loadInferenceGraph(args, embeddingTuple, quantizedPath), devBatches)
+			print("Dev BLEU float %2.2f, int8 storage %2.2f (difference %2.2f), time passed %.2fs" % (floatBleu * 100.0, quantizedBleu * 100.0, (quantizedBleu - floatBleu) * 100.0, getTimer()))
+	elif(args.mode == 'export'):
+		numNodes = exportInferenceGraph(args, sessionTuple, embeddingTuple, graphPath)
+		print("Inference graph exported to %s (%d nodes), signature in %s.json" % (graphPath, numNodes, graphPath))
 	else:
 		raise argparse.ArgumentTypeError("Mode not registered. Please recheck.")
-	if(args.save_path):
+	if(args.translation_cache is not None):
+		args.translation_cache.close()
+	if(args.telemetry is not None):
+		args.telemetry.close(args.global_steps)
+	if(args.profiler is not None):
+		args.profiler.writeReport()
+	if(args.replica_pool is not None):
+		args.replica_pool.close()
+	if(args.save_path and trainTuple is not None and args.mode != 'evaluate'):
 		builder.saveToPath(session, savePath)
-		if(batches and args.save_batch):
-			if(not args.batch_file_name):
-				args.batch_file_name = os.path.join(args.directory, args.save_path + ".bat")
-			batchesFile = io.open(args.batch_file_name, 'wb')
-			pickle.dump(batches, batchesFile)
-			batchesFile.close()
 	print("All task completed, total time passed %.2fs" % getTimer())
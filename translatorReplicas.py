@@ -0,0 +1,89 @@
+import os, itertools, multiprocessing
+
+# Run the decoding in several processes, each pinned to its own subset of cores and fed from a shared batch queue
+# processes are spawned rather than forked, as the TensorFlow runtime of the parent must not be copied
+
+def getCoreSubsets(numReplicas, cores=None):
+	# split the usable cores into numReplicas contiguous subsets
+	if(cores is None):
+		cores = sorted(os.sched_getaffinity(0)) if(hasattr(os, 'sched_getaffinity')) else list(range(os.cpu_count() or 1))
+	if(numReplicas > len(cores)):
+		raise Exception("Cannot pin %d replicas on %d cores" % (numReplicas, len(cores)))
+	subsetSize, remainder = divmod(len(cores), numReplicas)
+	subsets, start = [], 0
+	for i in range(numReplicas):
+		end = start + subsetSize + (1 if(i < remainder) else 0)
+		subsets.append(cores[start:end])
+		start = end
+	return subsets
+
+def replicaWorker(cores, initializeFunc, initArgs, taskQueue, resultQueue):
+	# pin before initializeFunc create the session, so its thread pools inherit the affinity
+	if(cores is not None and hasattr(os, 'sched_setaffinity')):
+		os.sched_setaffinity(0, cores)
+	try:
+		decodeFunc = initializeFunc(*initArgs)
+	except Exception as e:
+		resultQueue.put(('ready', None, repr(e)))
+		return
+	resultQueue.put(('ready', None, None))
+	while(True):
+		task = taskQueue.get()
+		if(task is None):
+			break
+		key, batchArgs = task
+		try:
+			resultQueue.put((key, decodeFunc(*batchArgs), None))
+		except Exception as e:
+			resultQueue.put((key, None, repr(e)))
+
+class ReplicaPool:
+	# initializeFunc(*initArgs) is called in each replica and return the function decoding a batch. Both must be picklable
+	def __init__(self, initializeFunc, initArgsList, coreSets, inFlightPerReplica=2):
+		context = multiprocessing.get_context('spawn')
+		self.taskQueue, self.resultQueue = context.Queue(), context.Queue()
+		self.processes = []
+		for initArgs, cores in zip(initArgsList, coreSets):
+			process = context.Process(target=replicaWorker, args=(cores, initializeFunc, initArgs, self.taskQueue, self.resultQueue))
+			process.daemon = True
+			process.start()
+			self.processes.append(process)
+		# wait for all replicas to be ready, so the session creation is not counted as decoding time
+		for _ in self.processes:
+			key, _, error = self.resultQueue.get()
+			if(error is not None):
+				self.close()
+				raise Exception("Replica failed to initialize: %s" % error)
+		self.inFlight = inFlightPerReplica * len(self.processes)
+
+	def __len__(self):
+		return len(self.processes)
+
+	def map(self, batches):
+		# decode the batches (tuples of arguments of the decoding function) and yield the results in order
+		batches = enumerate(batches)
+		pending, finished, nextIdx = 0, {}, 0
+		for key, batchArgs in itertools.islice(batches, self.inFlight):
+			self.taskQueue.put((key, batchArgs))
+			pending += 1
+		while(pending > 0):
+			key, result, error = self.resultQueue.get()
+			pending -= 1
+			if(error is not None):
+				raise Exception("Replica failed on batch %d: %s" % (key, error))
+			finished[key] = result
+			for newKey, batchArgs in itertools.islice(batches, 1):
+				self.taskQueue.put((newKey, batchArgs))
+				pending += 1
+			while(nextIdx in finished):
+				yield finished.pop(nextIdx)
+				nextIdx += 1
+
+	def close(self):
+		for _ in self.processes:
+			self.taskQueue.put(None)
+		for process in self.processes:
+			process.join(timeout=10)
+			if(process.is_alive()):
+				process.terminate()
+		self.processes = []
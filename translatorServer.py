@@ -0,0 +1,192 @@
+import numpy as np
+import os, sys, io, json, time, threading, collections, socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Keep the session resident and serve the translations over a local HTTP or Unix socket API
+# POST /translate with {"sentences": [...]} (or {"text": "..."}) answer {"translations": [...]}, GET /metrics answer the latency and throughput
+
+class LatencyTracker:
+	# Track the latency of the recent requests and the number of sentences/batches done since the start of the server
+	def __init__(self, window=10000):
+		self.lock = threading.Lock()
+		self.latencies = collections.deque(maxlen=window)
+		self.startTime = time.time()
+		self.requests = 0
+		self.sentences = 0
+		self.batches = 0
+
+	def recordRequest(self, latency, numSentences):
+		with self.lock:
+			self.latencies.append(latency)
+			self.requests += 1
+			self.sentences += numSentences
+
+	def recordBatch(self):
+		with self.lock:
+			self.batches += 1
+
+	def getMetrics(self):
+		with self.lock:
+			latencies = np.array(self.latencies, dtype=np.float64) * 1000.0
+			uptime = time.time() - self.startTime
+			return {
+				'requests': self.requests, 'sentences': self.sentences, 'batches': self.batches, 'uptime': uptime,
+				'latency_p50_ms': float(np.percentile(latencies, 50)) if(len(latencies) > 0) else 0.0,
+				'latency_p99_ms': float(np.percentile(latencies, 99)) if(len(latencies) > 0) else 0.0,
+				'sentences_per_sec': self.sentences / max(uptime, 1e-6),
+				'mean_batch_size': self.sentences / max(self.batches, 1)
+			}
+
+class PendingRequest:
+	def __init__(self, numSentences):
+		self.results = [None] * numSentences
+		self.remaining = numSentences
+		self.error = None
+		self.done = threading.Event()
+		if(numSentences == 0):
+			self.done.set()
+
+class MicroBatcher:
+	# Coalesce the sentences of concurrent requests into batches. A batch is run when maxBatchSize sentences are waiting or flushTime seconds passed since the oldest arrived
+	# translateFunc take a list of sentences and return the list of translations. It is only called from the worker thread, so the session is never run concurrently
+	def __init__(self, translateFunc, maxBatchSize=32, flushTime=0.01, tracker=None):
+		self.translateFunc = translateFunc
+		self.maxBatchSize = maxBatchSize
+		self.flushTime = flushTime
+		self.tracker = tracker or LatencyTracker()
+		self.condition = threading.Condition()
+		# each item is (request, index in request, sentence, arrival time)
+		self.waiting = collections.deque()
+		self.running = True
+		self.worker = threading.Thread(target=self.run, name='MicroBatcher')
+		self.worker.daemon = True
+		self.worker.start()
+
+	def submit(self, sentences):
+		# block until all the sentences are translated, and return them in order
+		timer = time.time()
+		request = PendingRequest(len(sentences))
+		with self.condition:
+			for idx, sentence in enumerate(sentences):
+				self.waiting.append((request, idx, sentence, timer))
+			self.condition.notify()
+		request.done.wait()
+		if(request.error is not None):
+			raise request.error
+		self.tracker.recordRequest(time.time() - timer, len(sentences))
+		return request.results
+
+	def takeBatch(self):
+		with self.condition:
+			while(self.running and len(self.waiting) == 0):
+				self.condition.wait()
+			# wait for more sentences until the batch is full or the oldest sentence waited flushTime
+			while(self.running and len(self.waiting) < self.maxBatchSize):
+				remaining = self.waiting[0][3] + self.flushTime - time.time()
+				if(remaining <= 0):
+					break
+				self.condition.wait(remaining)
+			return [self.waiting.popleft() for _ in range(min(len(self.waiting), self.maxBatchSize))]
+
+	def run(self):
+		while(self.running):
+			batch = self.takeBatch()
+			if(len(batch) == 0):
+				continue
+			try:
+				translations = self.translateFunc([item[2] for item in batch])
+				error = None
+			except Exception as e:
+				translations, error = [None] * len(batch), e
+			self.tracker.recordBatch()
+			for (request, idx, _, _), translation in zip(batch, translations):
+				request.results[idx] = translation
+				if(error is not None):
+					request.error = error
+				request.remaining -= 1
+				if(request.remaining == 0):
+					request.done.set()
+
+	def close(self):
+		with self.condition:
+			self.running = False
+			self.condition.notify_all()
+		self.worker.join()
+
+class TranslationRequestHandler(BaseHTTPRequestHandler):
+	def address_string(self):
+		# Unix socket have no client address
+		return self.client_address[0] if(isinstance(self.client_address, tuple)) else 'local'
+
+	def log_message(self, format, *args):
+		self.server.print_verbose("%s - %s" % (self.address_string(), format % args))
+
+	def sendJson(self, code, data):
+		body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		if(self.path == '/metrics'):
+			self.sendJson(200, self.server.batcher.tracker.getMetrics())
+		else:
+			self.sendJson(404, {'error': 'Unknown path %s' % self.path})
+
+	def do_POST(self):
+		if(self.path != '/translate'):
+			self.sendJson(404, {'error': 'Unknown path %s' % self.path})
+			return
+		try:
+			data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+			sentences = data['sentences'] if('sentences' in data) else [data['text']]
+			if(not all(isinstance(sentence, str) for sentence in sentences)):
+				raise ValueError("Sentences must be strings")
+		except (ValueError, KeyError, TypeError) as e:
+			self.sendJson(400, {'error': 'Invalid request: %s' % e})
+			return
+		try:
+			translations = self.server.batcher.submit(sentences)
+		except Exception as e:
+			self.sendJson(500, {'error': str(e)})
+			return
+		self.sendJson(200, {'translations': translations})
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+	def server_bind(self):
+		# remove the stale socket file left by a previous server
+		if(os.path.exists(self.server_address)):
+			os.remove(self.server_address)
+		socketserver.UnixStreamServer.server_bind(self)
+		self.server_name, self.server_port = self.server_address, 0
+
+def createServer(batcher, host='127.0.0.1', port=8080, unixSocket=None, print_verbose=None):
+	if(unixSocket):
+		server = ThreadingUnixHTTPServer(unixSocket, TranslationRequestHandler)
+	else:
+		server = ThreadingHTTPServer((host, port), TranslationRequestHandler)
+	server.batcher = batcher
+	server.print_verbose = print_verbose or (lambda *argv, **kwargs: None)
+	return server
+
+def serveForever(batcher, host='127.0.0.1', port=8080, unixSocket=None, print_verbose=None):
+	# run until interrupted, then return the final metrics
+	server = createServer(batcher, host, port, unixSocket, print_verbose)
+	print("Serving translation on %s" % (unixSocket if(unixSocket) else "http://%s:%d" % (host, port)))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		batcher.close()
+		if(unixSocket and os.path.exists(unixSocket)):
+			os.remove(unixSocket)
+	return batcher.tracker.getMetrics()
@@ -0,0 +1,102 @@
+import os, queue, traceback, multiprocessing
+import numpy as np
+import translatorReplicas
+
+# Synchronous data-parallel training in several processes, each running its own session on a shard of the batches
+# the workers average their variables every few steps through a shared memory buffer, so they all continue from the same weights
+# processes are spawned rather than forked, as the TensorFlow runtime of the parent must not be copied
+
+class ParameterAverager:
+	# the buffer hold one row per worker and a last row for the average. Each worker average its own chunk of the columns, so the work is split between them
+	def __init__(self, context, numWorkers, size):
+		self.numWorkers, self.size = numWorkers, size
+		self.buffer = context.RawArray('f', (numWorkers + 1) * size)
+		self.barrier = context.Barrier(numWorkers)
+		self.workerIdx = None
+
+	def attach(self, workerIdx):
+		self.workerIdx = workerIdx
+		chunkSize = (self.size + self.numWorkers - 1) // self.numWorkers
+		self.chunk = (min(workerIdx * chunkSize, self.size), min((workerIdx + 1) * chunkSize, self.size))
+		self.rows = np.frombuffer(self.buffer, dtype=np.float32).reshape(self.numWorkers + 1, self.size)
+
+	def average(self, values):
+		# values is the flat float32 array of this worker, return the average of all workers. Every worker must call it the same number of times
+		self.rows[self.workerIdx] = values
+		self.barrier.wait()
+		start, end = self.chunk
+		np.mean(self.rows[:self.numWorkers, start:end], axis=0, out=self.rows[self.numWorkers, start:end])
+		# the second wait also keep the average row from being overwritten before everyone read it, as the next writes of it come after the next first wait
+		self.barrier.wait()
+		return self.rows[self.numWorkers].copy()
+
+	def abort(self):
+		# release the other workers waiting for this one
+		self.barrier.abort()
+
+def flattenValues(values):
+	return np.concatenate([np.asarray(value, dtype=np.float32).ravel() for value in values]) if(len(values) > 0) else np.zeros([0], dtype=np.float32)
+
+def unflattenValues(flatValues, shapes):
+	values, start = [], 0
+	for shape in shapes:
+		size = int(np.prod(shape))
+		values.append(flatValues[start:start+size].reshape(shape))
+		start += size
+	return values
+
+def workerMain(workerIdx, cores, trainFunc, trainArgs, averager, resultQueue):
+	# trainFunc(workerIdx, averager, resultQueue, *trainArgs) train on the shard of workerIdx and return its result
+	if(cores is not None and hasattr(os, 'sched_setaffinity')):
+		os.sched_setaffinity(0, cores)
+	averager.attach(workerIdx)
+	try:
+		result = trainFunc(workerIdx, averager, resultQueue, *trainArgs)
+	except BaseException:
+		# also catch the sys.exit of the training loop, the others would wait on the barrier forever otherwise
+		averager.abort()
+		resultQueue.put(('error', workerIdx, traceback.format_exc()))
+		return
+	resultQueue.put(('done', workerIdx, result))
+
+class WorkerGroup:
+	def __init__(self, trainFunc, trainArgs, numWorkers, parameterSize, pinCores=True):
+		context = multiprocessing.get_context('spawn')
+		self.averager = ParameterAverager(context, numWorkers, parameterSize)
+		self.resultQueue = context.Queue()
+		coreSets = translatorReplicas.getCoreSubsets(numWorkers) if(pinCores) else [None] * numWorkers
+		self.processes = []
+		for workerIdx, cores in enumerate(coreSets):
+			process = context.Process(target=workerMain, args=(workerIdx, cores, trainFunc, trainArgs, self.averager, self.resultQueue))
+			process.daemon = True
+			process.start()
+			self.processes.append(process)
+
+	def join(self, messageFunc=None):
+		# wait for all workers to finish and return their results in worker order. Other messages are passed to messageFunc(workerIdx, kind, data)
+		numWorkers, results = len(self.processes), {}
+		while(len(results) < numWorkers):
+			try:
+				kind, workerIdx, data = self.resultQueue.get(timeout=5.0)
+			except queue.Empty:
+				dead = [idx for idx, process in enumerate(self.processes) if(not process.is_alive() and idx not in results)]
+				if(len(dead) > 0):
+					self.close()
+					raise Exception("Workers %s exited without result" % dead)
+				continue
+			if(kind == 'error'):
+				self.close()
+				raise Exception("Worker %d failed:\n%s" % (workerIdx, data))
+			elif(kind == 'done'):
+				results[workerIdx] = data
+			elif(messageFunc is not None):
+				messageFunc(workerIdx, kind, data)
+		self.close()
+		return [results[idx] for idx in range(numWorkers)]
+
+	def close(self):
+		for process in self.processes:
+			process.join(timeout=10)
+			if(process.is_alive()):
+				process.terminate()
+		self.processes = []
@@ -1,20 +1,10 @@
 import ffBuilder as builder
+import exampleBuilder
 import numpy as np
 import tensorflow as tf
 import sys, os, pickle, argparse, io, time, random
 from calculatebleu import *
 
-def getEmbeddingFromFile(fileDir, useDefault=True):
-	file = io.open(fileDir, 'rb')
-	dictTuple = pickle.load(file)
-	file.close()
-	if(isinstance(dictTuple, dict)):
-		return dictTuple
-	elif(isinstance(dictTuple, (tuple, list))):
-		return dictTuple[0 if useDefault else 1]
-	else:
-		raise Exception("Wrong type during pickle read file")
-		
 def getSentencesFromFile(fileDir, splitToken=' '):
 	file = io.open(fileDir, 'r', encoding='utf-8')
 	lines = file.readlines()
@@ -41,31 +31,10 @@ def createSentenceCouplingFromFile(args):
 	return coupling
 
 def createEmbeddingCouplingFromFile(args):
-	srcDict = getEmbeddingFromFile(os.path.join(args.directory, args.src_dict_file), args.use_default_dict)
-	tgtDict = getEmbeddingFromFile(os.path.join(args.directory, args.tgt_dict_file), args.use_default_dict)
 	# Convert the src/tgt dict into normal (word to id), ref (id to word), embeddingVector (id to vector)
-	counter = 0
-	srcWordToId, srcIdToWord = {}, {}
-	srcEmbeddingVector = []
-	for key in srcDict:
-		assert len(srcEmbeddingVector) == counter
-		srcWordToId[key] = counter
-		srcIdToWord[counter] = key
-		srcEmbeddingVector.append(srcDict[key])
-		counter += 1
-	
-	counter = 0
-	tgtWordToId, tgtIdToWord = {}, {}
-	tgtEmbeddingVector = []
-	for key in tgtDict:
-		assert len(tgtEmbeddingVector) == counter
-		tgtWordToId[key] = counter
-		tgtIdToWord[counter] = key
-		tgtEmbeddingVector.append(tgtDict[key])
-		counter += 1
-		
-	
-	return (srcWordToId, srcIdToWord, np.array(srcEmbeddingVector)), (tgtWordToId, tgtIdToWord, np.array(tgtEmbeddingVector))
+	srcEmbeddingTuple = exampleBuilder.getEmbeddingTupleFromFile(os.path.join(args.directory, args.src_dict_file), args.use_default_dict, args.compile_embedding)
+	tgtEmbeddingTuple = exampleBuilder.getEmbeddingTupleFromFile(os.path.join(args.directory, args.tgt_dict_file), args.use_default_dict, args.compile_embedding)
+	return srcEmbeddingTuple, tgtEmbeddingTuple
 
 def createSession(args, embedding):
 	srcEmbedding, tgtEmbedding = embedding
@@ -138,6 +107,12 @@ def debugSession(session, feed_dict):
 			print(vector)
 		print('-------')
 	
+def runSession(args, session, fetches, feed_dict, tag):
+	# same as translator.runSession, the steps being counted per tag
+	if(args.profiler is None):
+		return session.run(fetches, feed_dict=feed_dict)
+	return args.profiler.run(session, fetches, feed_dict, tag)
+
 def trainSessionOneBatch(args, sessionTuple, batch, selector=True):
 	session, inputOutputTuple, configTuple, trainTuple = sessionTuple
 	trainTuple = trainTuple[0 if selector else 1]
@@ -160,7 +135,7 @@ def trainSession(args, sessionTuple, batches, evaluationFunction, selector=False
 		avgLosses = [0]
 		for batch in batches:
 			feed_dict = {input:batch[0], output:batch[1], batchSize:batch[2], outputLengthList:batch[3], maximumUnrolling:max(batch[3]), decoderInput:batch[4]}
-			loss, _ = session.run(trainTuple[0 if selector else 1], feed_dict=feed_dict)
+			loss, _ = runSession(args, session, trainTuple[0 if selector else 1], feed_dict, 'train')
 			avgLosses[-1] += loss
 		avgLosses[-1] = avgLosses[-1] / len(batches)
 		if(evaluationFunction and (step+1) % args.evaluation_step == 0):
@@ -176,7 +151,7 @@ def evaluateSession(args, session, dictTuple, sampleBatch):
 	_, _, tgtEmbeddingVector = dictTuple[1]
 	inferLogits, trainLogits = logits
 	feed_dict = {input:sampleBatch[0], output:sampleBatch[1], batchSize:sampleBatch[2], outputLengthList:sampleBatch[3], maximumUnrolling:max(sampleBatch[3]), decoderInput:sampleBatch[4]}
-	resultInfer, resultTrain = session.run(logits, feed_dict=feed_dict)
+	resultInfer, resultTrain = runSession(args, session, logits, feed_dict, 'infer')
 	# _, savedData = getWordIdFromVectors(resultInfer[0], tgtEmbeddingVector, args.use_default_dict)
 	#print(resultInfer, resultTrain)
 	resultInfer = [getWordIdFromVectors(result, tgtEmbeddingVector, args.use_default_dict) for result in resultInfer]
@@ -400,6 +375,7 @@ def calculateBleu(correct, result, trimData=None):
 if __name__ == "__main__":
 	# Run argparse
 	parser = argparse.ArgumentParser(description='Create training examples from resource data.')
+	parser.add_argument('--profile_steps', type=lambda s: [int(step) for step in s.split(',')], default=None, help='Comma separated steps (batches of training, evaluations) run with a full trace, writing their Chrome trace timelines and a per-op cost table in save_path.profile.')
 	args = parser.parse_args()
 	args.mode = 'train'
 	args.directory = 'data\\vietchina'
@@ -416,6 +392,7 @@ if __name__ == "__main__":
 	args.evaluation_step = 20
 	args.global_steps = 0
 	args.use_default_dict = False
+	args.compile_embedding = False
 	args.maximum_sentence_length = 50
 	args.batch_size = 32
 	timer = time.time()
@@ -435,6 +412,7 @@ if __name__ == "__main__":
 				print("Global step received in graph: %d, synchronizing with current (%d)" % (args.global_steps[0], graphGlobalStep))
 				args.global_steps = graphGlobalStep, args.global_steps[1]
 	print("Creating session done, time passed %.2fs" % getTimer())
+	args.profiler = builder.StepProfiler(args.profile_steps, os.path.join(args.directory, args.save_path + ".profile")) if(args.profile_steps) else None
 	# testRun(args, sessionTuple, embeddingTuple)
 	
 	if(args.mode == 'train'):
@@ -470,6 +448,8 @@ if __name__ == "__main__":
 		pass
 	else:
 		raise argparse.ArgumentTypeError("Mode not registered. Please recheck.")
+	if(args.profiler is not None):
+		args.profiler.writeReport()
 	if(args.save):
 		builder.saveToPath(session, savePath)
 		if(args.src_file and args.tgt_file and batches):